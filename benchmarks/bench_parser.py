@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Benchmark: parse_testo_corsa / pulisci_indirizzo
+#
+#   python benchmarks/bench_parser.py [ripetizioni]
+#
+# Verifica che il parser produca lo stesso risultato della versione
+# precedente (regex compilate a ogni chiamata, sette passate sugli indirizzi)
+# su un corpus di testi incollati, poi confronta i tempi.
+
+import os, re, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+def clean_address_precedente(s):
+    if not s: return s
+    s = re.sub(r'^\s*Cin:\s*[A-Za-z0-9]+,\s*', '', s, flags=re.IGNORECASE)
+    s = re.sub(r'(,\s*)?\b\d{5}\b(?=,|$|\s)', '', s)
+    s = re.sub(r',\s*(Italia|Italy)\s*$', '', s, flags=re.IGNORECASE)
+    s = re.sub(r'\s*,\s*', ', ', s)
+    s = re.sub(r'\s{2,}', ' ', s).strip()
+    s = re.sub(r'(,\s*){2,}', ', ', s)
+    s = re.sub(r',\s*$', '', s)
+    return s
+
+
+def parse_precedente(txt):
+    lines = [l.strip() for l in (txt or "").splitlines() if l.strip()]
+    kv = {}
+    for ln in lines:
+        if '\t' in ln:
+            k, v = ln.split('\t', 1)
+        else:
+            parts = re.split(r'\s{2,}|:\s*', ln, maxsplit=1)
+            if len(parts) != 2: continue
+            k, v = parts
+        kv[k.strip().lower()] = v.strip()
+    ret = {}
+    name = kv.get('passenger name') or kv.get('passeggero') or kv.get('fruitore') or kv.get('rider') or kv.get('cliente')
+    if name: ret["Fruitore servizio"] = name.strip()
+    frm = kv.get('from') or kv.get('partenza') or kv.get('pickup')
+    if frm: ret["Luogo di partenza"] = clean_address_precedente(frm.strip())
+    to = kv.get('destination') or kv.get('destinazione') or kv.get('drop-off') or kv.get('drop off') or kv.get('dropoff')
+    if to:  ret["Luogo di destinazione"] = clean_address_precedente(to.strip())
+    return ret
+
+
+CORPUS = [
+    "Trip # 0f8fad5b-d9cb-469f-a165-70867728950e\n12/03/24 08:15:00 CET\nPassenger name\tMario Rossi\n"
+    "From\tCin: AB12CD, Via Roma 10, 00184 Roma RM, Italia\nDestination\tPiazza Navona 1, 00186 Roma, Italy\nvia\tUber",
+    "Passeggero: Giulia Bianchi\nPartenza: Corso Buenos Aires  33 ,, 20124 Milano\nDestinazione: Stazione Centrale, Milano,\n",
+    "Rider  Luca Verdi\nPickup  Aeroporto di Fiumicino, Terminal 3, 00054 Fiumicino RM, Italia\n"
+    "Drop-off  Via Veneto 125, 00187 Roma\nFare  45,00 €",
+    "cliente:\tAnna\r\nfrom:   Via Garibaldi 5 ,  10122 Torino , Italia\r\ndropoff: Porta Nuova\r\n",
+    "Fruitore: Ospedale San Raffaele\npartenza: Via Olgettina 60, 20132 Milano\ndrop off:\n"
+    "destination: Linate,, Viale Forlanini, 20054 Segrate MI,   Italy  ",
+    "Nota senza chiavi\n\n   \nOra: 10:30\nKm: 12",
+    "",
+]
+
+
+def cronometra(fn, ripetizioni):
+    t0 = time.perf_counter()
+    for _ in range(ripetizioni):
+        fn()
+    return time.perf_counter() - t0
+
+
+def main_bench(ripetizioni=5000):
+    for txt in CORPUS:
+        atteso = parse_precedente(txt)
+        assert main.parse_testo_corsa(txt) == atteso, (txt, atteso)
+        for riga in txt.splitlines():
+            assert main.pulisci_indirizzo(riga) == clean_address_precedente(riga), riga
+    print(f"corpus: {len(CORPUS)} testi, risultati identici")
+
+    def tutti(parse):
+        return lambda: [parse(t) for t in CORPUS]
+
+    t_old = cronometra(tutti(parse_precedente), ripetizioni)
+    t_new = cronometra(tutti(main.parse_testo_corsa), ripetizioni)
+    n = ripetizioni * len(CORPUS)
+    print(f"parse, {n} testi: precedente {t_old*1e6/n:.1f} µs/testo, "
+          f"nuovo {t_new*1e6/n:.1f} µs/testo (x{t_old / max(t_new, 1e-9):.1f})")
+
+    indirizzi = [r.split('\t', 1)[-1] for t in CORPUS for r in t.splitlines() if r]
+    t_old = cronometra(lambda: [clean_address_precedente(a) for a in indirizzi], ripetizioni)
+    t_new = cronometra(lambda: [main.pulisci_indirizzo(a) for a in indirizzi], ripetizioni)
+    n = ripetizioni * len(indirizzi)
+    print(f"indirizzi, {n}: precedente {t_old*1e6/n:.1f} µs, "
+          f"nuovo {t_new*1e6/n:.1f} µs (x{t_old / max(t_new, 1e-9):.1f})")
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Benchmark: adattamento testo nelle celle di build_pdf_cartaceo
+#
+#   python benchmarks/bench_pdf.py [righe]
+#
+# Confronta il vecchio troncamento carattere per carattere con la ricerca
+# binaria + cache delle larghezze, e misura l'esportazione completa.
+
+import os, sys, time, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+def fit_naive(pdf, text, w):
+    """Algoritmo precedente: toglie un carattere alla volta e rimisura"""
+    txt = main._pdf_safe(text)
+    if pdf.get_string_width(txt) <= w - 2: return txt
+    base = txt; ELL = "..."
+    while base and pdf.get_string_width(base + ELL) > w - 2:
+        base = base[:-1]
+    return (base + ELL) if base else ELL
+
+
+def righe_lunghe(n):
+    vie = ["Via Giuseppe Garibaldi", "Corso Vittorio Emanuele II", "Piazza della Repubblica",
+           "Viale Regina Margherita", "Lungotevere dei Mellini"]
+    citta = ["Roma", "Milano", "Torino", "Napoli", "Firenze"]
+    rows = []
+    for i in range(n):
+        via = vie[i % len(vie)]
+        rows.append({
+            "Fruitore servizio": f"Cliente numero {i:05d} – Società Trasporti",
+            "Luogo di partenza": f"{via} {i}, Scala B, Interno {i % 40}, {citta[i % 5]}",
+            "Ora di partenza": "08:15", "KM iniziali": str(1000 + i),
+            "Luogo di destinazione": f"{vie[(i + 2) % 5]} {i * 3}, {citta[(i + 1) % 5]} – Ingresso principale",
+            "Ora di arrivo": "08:55", "KM finali": str(1012 + i),
+        })
+    return rows
+
+
+def cronometra(fn):
+    t0 = time.perf_counter(); fn(); return time.perf_counter() - t0
+
+
+def main_bench(n=1000):
+    from fpdf import FPDF
+    rows = righe_lunghe(n)
+    cols = ["Fruitore servizio", "Luogo di partenza", "Ora di partenza", "KM iniziali",
+            "Luogo di destinazione", "Ora di arrivo", "KM finali"]
+    widths = [40, 62, 31, 26, 62, 31, 25]
+    pdf = FPDF(orientation="L", unit="mm", format="A4")
+    pdf.add_page(); pdf.set_font("Helvetica", "", 10)
+
+    def run(fit):
+        for r in rows:
+            for w, c in zip(widths, cols):
+                fit(pdf, r[c], w)
+
+    # Stesso risultato dei due algoritmi
+    for r in rows[:50]:
+        for w, c in zip(widths, cols):
+            assert fit_naive(pdf, r[c], w) == main._fit_text_ellipsis(pdf, r[c], w), r[c]
+
+    main._GLYPH_CACHE.clear(); main._FIT_CACHE.clear()
+    t_old = cronometra(lambda: run(fit_naive))
+    t_new = cronometra(lambda: run(main._fit_text_ellipsis))
+    print(f"fit testo, {n} righe: vecchio {t_old*1000:.1f} ms, nuovo {t_new*1000:.1f} ms "
+          f"(x{t_old / max(t_new, 1e-9):.1f})")
+
+    with tempfile.TemporaryDirectory() as d:
+        for k in (n // 10, n):
+            t = cronometra(lambda: main.build_pdf_cartaceo(os.path.join(d, "b.pdf"), {}, rows[:k]))
+            print(f"build_pdf_cartaceo, {k} righe: {t*1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Riproduce una traccia GPS registrata (GPX, NMEA, CSV) attraverso
+# CorseScreen._on_location, senza finestra, il più veloce possibile.
+#
+#   python benchmarks/replay_gps.py giornata.gpx
+#   python benchmarks/replay_gps.py giornata.nmea --fermo-kmh 4 --sosta-s 90
+#   python benchmarks/replay_gps.py --sintetica 20000
+#   python benchmarks/replay_gps.py --verifica-modifica
+#
+# Riporta salite e discese rilevate (con l'ora della traccia), km GPS per
+# corsa e fix al secondo. Dopo ogni discesa la corsa viene salvata come
+# farebbe l'autista, così una giornata intera produce tutte le sue corse.
+# Per provare l'app su desktop con una traccia: FDV_REPLAY=giornata.gpx
+# (FDV_REPLAY_VELOCITA=1 per il tempo reale) python main.py
+#
+# --verifica-modifica controlla che modificare una corsa già salvata mentre
+# il GPS registra la successiva non tocchi né l'una né l'altra traccia.
+
+import os, sys, argparse, time
+
+QUI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, QUI)
+
+from run import Contesto, fix_sintetici   # imposta anche l'ambiente senza finestra
+import main
+
+
+def _ora(fix):
+    ts = fix.get("timestamp")
+    return main.datetime.fromtimestamp(ts).strftime("%H:%M:%S") if ts is not None else "--:--:--"
+
+
+def riproduci(fix, fermo_kmh=None, sosta_s=None, raggio_m=None, min_km=None):
+    with Contesto() as ctx:
+        s = ctx.schermo()
+        s._apri_foglio_corrente()
+        for nome, valore in (("SPEED_STILL_KMH", fermo_kmh), ("DWELL_S", sosta_s),
+                             ("START_RADIUS_M", raggio_m), ("MIN_TRAVEL_KM_FOR_DROP", min_km)):
+            if valore is not None:
+                setattr(s, nome, valore)
+        sorgente = main.ReplayGPS(fix)
+        eventi = []
+
+        def on_location(**f):
+            prima = (s._pickup_set, s._drop_set)
+            s._on_location(**f)
+            if not prima[0] and s._pickup_set:
+                eventi.append(("salita", _ora(f), s.gps_km_raw))
+            if not prima[1] and s._drop_set:
+                eventi.append(("discesa", _ora(f), s.gps_km_raw - (s._km_at_pickup or 0.0)))
+                s.salva_corsa()
+
+        sorgente.configure(on_location)
+        t0 = time.perf_counter()
+        sorgente.riproduci_tutto()
+        durata = time.perf_counter() - t0
+        s.track.reset()
+        return eventi, sorgente.consegnati, durata
+
+
+def verifica_modifica_durante_corsa(n=2000):
+    """Errori trovati modificando la prima corsa a metà della registrazione della seconda"""
+    fix = fix_sintetici(n)
+    for i, f in enumerate(fix):
+        f["timestamp"] = 1.7e9 + i
+    errori = []
+    with Contesto() as ctx:
+        s = ctx.schermo()
+        s._apri_foglio_corrente()
+        s._pickup_set = True      # prima corsa: registrata dall'inizio, salvata a metà traccia
+        for f in fix[:n // 2]:
+            s._on_location(**f)
+        s._pt_salita = (fix[0]["lat"], fix[0]["lon"])
+        s.ui.applica()
+        s.campi["Fruitore servizio"].text = "Prima"
+        s.salva_corsa()
+        prima = dict(s.corse[0])
+        cartella = s._cartella_tracce()
+        for f in fix[n // 2:n * 3 // 4]:
+            s._on_location(**f)
+        in_corso = len(s.track)
+
+        s._carica(0)
+        s.campi["Fruitore servizio"].text = "Modificata"
+        s.salva_corsa()
+        dopo = s.corse[0]
+        for chiave in ("_traccia", "_gps", "_gps_partenza", "_gps_arrivo"):
+            if dopo.get(chiave) != prima.get(chiave):
+                errori.append(f"corsa modificata: {chiave} {prima.get(chiave)!r} -> {dopo.get(chiave)!r}")
+        if prima.get("_traccia") and not os.path.exists(os.path.join(cartella, prima["_traccia"])):
+            errori.append("corsa modificata: file della traccia eliminato")
+        if len(s.track) != in_corso:
+            errori.append(f"corsa in registrazione: traccia da {in_corso} a {len(s.track)} punti")
+
+        for f in fix[n * 3 // 4:]:
+            s._on_location(**f)
+        s.ui.applica()
+        s.campi["Fruitore servizio"].text = "Seconda"
+        s.salva_corsa()
+        seconda = len(list(s._punti_traccia_corsa(s.corse[-1])))
+        if seconda != n - n // 2:
+            errori.append(f"corsa in registrazione: archiviati {seconda} punti su {n - n // 2}")
+        s.track.reset()
+    return errori
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Riproduzione offline di una traccia GPS")
+    ap.add_argument("traccia", nargs="?", help="file .gpx, .nmea/.log/.txt o .csv")
+    ap.add_argument("--sintetica", type=int, metavar="N", help="usa N fix sintetici a 1 Hz")
+    ap.add_argument("--fermo-kmh", type=float, help="soglia di fermo (SPEED_STILL_KMH)")
+    ap.add_argument("--sosta-s", type=float, help="durata minima della sosta (DWELL_S)")
+    ap.add_argument("--raggio-m", type=float, help="raggio di salita (START_RADIUS_M)")
+    ap.add_argument("--min-km", type=float, help="km minimi per la discesa (MIN_TRAVEL_KM_FOR_DROP)")
+    ap.add_argument("--verifica-modifica", action="store_true",
+                    help="controlla la modifica di una corsa salvata durante la registrazione")
+    args = ap.parse_args(argv)
+
+    if args.verifica_modifica:
+        errori = verifica_modifica_durante_corsa()
+        for e in errori:
+            print(f"ERRORE {e}")
+        print("modifica durante la registrazione: " + ("ERRORI" if errori else "ok"))
+        return 1 if errori else 0
+
+    if args.sintetica:
+        t0 = time.time() - args.sintetica
+        fix = fix_sintetici(args.sintetica)
+        for i, f in enumerate(fix):
+            f["timestamp"] = t0 + i
+    elif args.traccia:
+        fix = list(main.leggi_traccia(args.traccia))
+    else:
+        ap.error("indicare una traccia o --sintetica N")
+
+    eventi, consegnati, durata = riproduci(fix, args.fermo_kmh, args.sosta_s, args.raggio_m, args.min_km)
+    for tipo, ora, km in eventi:
+        dettaglio = f"{km:.2f} km percorsi" if tipo == "discesa" else f"km GPS {km:.2f}"
+        print(f"{ora}  {tipo:<8} {dettaglio}")
+    corse = sum(1 for e in eventi if e[0] == "discesa")
+    print(f"{consegnati} fix in {durata:.2f} s ({consegnati / max(durata, 1e-9):.0f} fix/s), {corse} corse")
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+# Suite di benchmark dei percorsi critici, senza finestra Kivy visibile.
+#
+#   python benchmarks/run.py                  # esegue e confronta con baseline.json
+#   python benchmarks/run.py --salva-baseline # aggiorna baseline.json
+#   python benchmarks/run.py --casi pdf,gps   # solo i casi il cui nome contiene pdf o gps
+#
+# Per ogni caso riporta tempo (migliore di --ripetizioni esecuzioni) e picco
+# di memoria Python (tracemalloc). Esce con codice 1 se un caso supera la
+# baseline di oltre --soglia volte e di almeno --min-ms millisecondi.
+
+import os, sys
+
+# Prima di importare Kivy: finestra offscreen, niente argomenti né log su console
+os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+os.environ.setdefault("KIVY_NO_ARGS", "1")
+os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+import argparse, contextlib, io, json, math, shutil, tempfile, time, tracemalloc
+
+QUI = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(QUI))
+sys.path.insert(0, QUI)
+
+import main
+from kivy.app import App
+from bench_pdf import righe_lunghe
+from bench_parser import CORPUS
+
+BASELINE = os.path.join(QUI, "baseline.json")
+
+
+class AppBench(main.FDVApp):
+    """FDVApp con dati in una cartella temporanea, senza run()"""
+
+    def __init__(self, cartella, **kw):
+        super().__init__(**kw)
+        self._cartella = cartella
+        self.intestazione = {}
+        self.last_km_final = None
+
+    @property
+    def user_data_dir(self):
+        return self._cartella
+
+
+class Contesto:
+    """Cartella dati temporanea e app corrente per un caso"""
+
+    def __enter__(self):
+        self.cartella = tempfile.mkdtemp(prefix="fdv_bench_")
+        self.app = AppBench(self.cartella)
+        App._running_app = self.app
+        return self
+
+    def schermo(self):
+        s = main.CorseScreen(name="corse")
+        s._msg = lambda *a, **k: None
+        return s
+
+    def __exit__(self, *exc):
+        App._running_app = None
+        shutil.rmtree(self.cartella, ignore_errors=True)
+
+
+def righe_unicode(n):
+    rows = righe_lunghe(n)
+    for i, r in enumerate(rows):
+        if i % 3 == 0:
+            r["Luogo di partenza"] += " – Łódź ‘Ćwiartka’ … 東京駅"
+            r["Fruitore servizio"] = f"Società “Città” {i}"
+    return rows
+
+
+def caso_pdf(n):
+    rows = righe_unicode(n)
+
+    def prepara():
+        main._FIT_CACHE.clear()
+        return tempfile.mkdtemp(prefix="fdv_pdf_")
+
+    def esegui(d):
+        main.build_pdf_cartaceo(os.path.join(d, "f.pdf"), {"Targa": "AB123CD"}, rows)
+
+    def pulisci(d):
+        shutil.rmtree(d, ignore_errors=True)
+
+    return prepara, esegui, pulisci
+
+
+def caso_parser():
+    def esegui(_):
+        for _i in range(200):
+            for t in CORPUS:
+                main.parse_testo_corsa(t)
+    return (lambda: None), esegui, (lambda _: None)
+
+
+def fix_sintetici(n):
+    """Flusso di fix a 1 Hz: tratti in movimento alternati a soste"""
+    lat, lon = 45.4642, 9.1900
+    fix = []
+    for i in range(n):
+        fermo = (i // 60) % 3 == 2
+        if not fermo:
+            lat += 0.00008 * math.cos(i / 50.0)
+            lon += 0.00008 * math.sin(i / 50.0)
+        fix.append({"lat": lat, "lon": lon, "accuracy": 8.0 + (i % 5),
+                    "speed": 0.3 if fermo else 9.0})
+    return fix
+
+
+def caso_gps(n):
+    fix = fix_sintetici(n)
+
+    def prepara():
+        ctx = Contesto().__enter__()
+        return ctx, ctx.schermo()
+
+    def esegui(stato):
+        _ctx, s = stato
+        for f in fix:
+            s._on_location(**f)
+
+    def pulisci(stato):
+        ctx, s = stato
+        s.track.reset()
+        ctx.__exit__()
+
+    return prepara, esegui, pulisci
+
+
+def _archivio_grande(ctx, s, n):
+    """n corse nel foglio di oggi e 30 fogli storici"""
+    archivio = s._get_archivio()
+    for g in range(30):
+        fid = archivio.nuovo_foglio({"Targa": "AB123CD"}, giorno=f"2024-01-{g+1:02d}")
+        for r in righe_lunghe(20):
+            archivio.aggiungi_corsa(fid, r, giorno=f"2024-01-{g+1:02d}")
+    s._apri_foglio_corrente()
+    for r in righe_lunghe(n):
+        archivio.aggiungi_corsa(s.foglio_id, r)
+
+
+def caso_backup_salva(n):
+    def prepara():
+        ctx = Contesto().__enter__()
+        s = ctx.schermo()
+        _archivio_grande(ctx, s, n)
+        s._carica_backup()
+        s._flush_backup(attendi=True)
+        return ctx, s
+
+    def esegui(stato):
+        _ctx, s = stato
+        for i in range(200):
+            s.campi["Luogo di partenza"].text = f"Via Roma {i}"
+            s._salva_backup()
+            s._flush_backup(attendi=True)
+
+    def pulisci(stato):
+        stato[0].__exit__()
+
+    return prepara, esegui, pulisci
+
+
+def caso_backup_carica(n):
+    def prepara():
+        ctx = Contesto().__enter__()
+        s = ctx.schermo()
+        _archivio_grande(ctx, s, n)
+        s._carica_backup()
+        for i in range(300):
+            s.campi["KM iniziali"].text = str(i)
+            s._salva_backup(); s._flush_backup()
+        s._flush_backup(attendi=True)
+        s._get_archivio().chiudi()
+        return ctx
+
+    def esegui(ctx):
+        s = ctx.schermo()
+        s._carica_backup()
+        s._flush_backup(attendi=True)
+        s._get_archivio().chiudi()
+
+    def pulisci(ctx):
+        ctx.__exit__()
+
+    return prepara, esegui, pulisci
+
+
+def caso_elenco(n):
+    def prepara():
+        ctx = Contesto().__enter__()
+        s = ctx.schermo()
+        s.corse = righe_lunghe(n)
+        return ctx, s
+
+    def esegui(stato):
+        _ctx, s = stato
+        s._elenco_rv = None
+        s._elenco_cache.clear()
+        s.popup_elenco()
+        s._p.dismiss()
+
+    def pulisci(stato):
+        stato[0].__exit__()
+
+    return prepara, esegui, pulisci
+
+
+def caso_geocoder(n, ricerche=10000):
+    """Stradario sintetico di n civici attorno a Milano, ricerche lungo fix_sintetici"""
+    import random
+    rnd = random.Random(7)
+    posizioni = [(f["lat"], f["lon"]) for f in fix_sintetici(ricerche)]
+
+    def prepara():
+        cartella = tempfile.mkdtemp(prefix="fdv_geo_")
+        sorgente = os.path.join(cartella, "indirizzi.csv")
+        with open(sorgente, "w", encoding="utf-8") as f:
+            f.write("LON,LAT,NUMBER,STREET,CITY\n")
+            for i in range(n):
+                f.write(f"{9.19 + rnd.uniform(-0.05, 0.05):.6f},{45.46 + rnd.uniform(-0.05, 0.05):.6f},"
+                        f"{i % 200 + 1},Via {i // 200},Milano\n")
+        main.compila_gazetteer(sorgente, os.path.join(cartella, "gazetteer.fdvg"))
+        return cartella, main.GeocoderInverso(os.path.join(cartella, "gazetteer.fdvg"))
+
+    def esegui(stato):
+        cerca = stato[1].cerca
+        for lat, lon in posizioni:
+            cerca(lat, lon)
+
+    def pulisci(stato):
+        stato[1].chiudi()
+        shutil.rmtree(stato[0], ignore_errors=True)
+
+    return prepara, esegui, pulisci
+
+
+def caso_completamento(n):
+    """Indice di n indirizzi distinti, poi i prefissi di una digitazione lettera per lettera"""
+    import random
+    rnd = random.Random(11)
+    vie = ["Roma", "Città di Castello", "Garibaldi", "Dante", "Verdi", "San Raffaele", "Niguarda"]
+    righe = [(f"Via {rnd.choice(vie)} {i}, Comune {i % 300}", rnd.randint(1, 9),
+              f"2025-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}") for i in range(n)]
+    parole = ["via citta di castello 12", "nigu", "comune 29", "san raf", "garibaldi 4"]
+
+    def esegui(_):
+        indice = main.IndicePrefissi(righe)
+        for parola in parole:
+            for k in range(2, len(parola) + 1):
+                indice.suggerisci(parola[:k])
+        for i in range(200):
+            indice.aggiungi(f"Piazza Nuova {i}")
+
+    return (lambda: None), esegui, (lambda _: None)
+
+
+def caso_rilevatore(n):
+    """Analisi a posteriori di una giornata di n fix a 1 Hz (numpy se disponibile)"""
+    fix = fix_sintetici(n)
+    colonne = ([f["lat"] for f in fix], [f["lon"] for f in fix], list(range(n)),
+               [f["speed"] for f in fix], [f["accuracy"] for f in fix])
+
+    def esegui(_):
+        main.RilevatoreCorse(main.IndiceLuoghi()).analizza(*colonne)
+
+    return (lambda: None), esegui, (lambda _: None)
+
+
+CASI = {
+    "pdf_10": lambda: caso_pdf(10),
+    "pdf_100": lambda: caso_pdf(100),
+    "pdf_1000": lambda: caso_pdf(1000),
+    "parser_corpus": caso_parser,
+    "gps_on_location_20000": lambda: caso_gps(20000),
+    "backup_salva_5000": lambda: caso_backup_salva(5000),
+    "backup_carica_5000": lambda: caso_backup_carica(5000),
+    "elenco_popup_5000": lambda: caso_elenco(5000),
+    "geocoder_200000": lambda: caso_geocoder(200000),
+    "completamento_20000": lambda: caso_completamento(20000),
+    "rilevatore_86400": lambda: caso_rilevatore(86400),
+}
+
+
+def misura(nome, ripetizioni):
+    # I messaggi dell'app (print dei salvataggi) non sporcano la tabella
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _misura(nome, ripetizioni)
+
+
+def _misura(nome, ripetizioni):
+    prepara, esegui, pulisci = CASI[nome]()
+    tempi = []
+    for _ in range(ripetizioni):
+        stato = prepara()
+        try:
+            t0 = time.perf_counter(); esegui(stato); tempi.append(time.perf_counter() - t0)
+        finally:
+            pulisci(stato)
+    # Memoria in un'esecuzione separata: tracemalloc rallenta
+    stato = prepara()
+    try:
+        tracemalloc.start()
+        esegui(stato)
+        _cur, picco = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        pulisci(stato)
+    return {"tempo_ms": round(min(tempi) * 1000, 2), "picco_kb": round(picco / 1024, 1)}
+
+
+def main_bench(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark FDV senza finestra")
+    ap.add_argument("--casi", default="", help="filtri separati da virgola sul nome del caso")
+    ap.add_argument("--ripetizioni", type=int, default=3)
+    ap.add_argument("--soglia", type=float, default=1.5,
+                    help="rapporto rispetto alla baseline oltre il quale è una regressione")
+    ap.add_argument("--min-ms", type=float, default=5.0,
+                    help="differenza minima in ms per segnalare una regressione (rumore)")
+    ap.add_argument("--salva-baseline", action="store_true")
+    args = ap.parse_args(argv)
+
+    filtri = [f for f in args.casi.split(",") if f]
+    nomi = [n for n in CASI if not filtri or any(f in n for f in filtri)]
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    risultati, regressioni = {}, []
+    print(f"{'caso':28} {'tempo ms':>10} {'picco KB':>10} {'base ms':>10} {'rapporto':>9}")
+    for nome in nomi:
+        r = risultati[nome] = misura(nome, args.ripetizioni)
+        base = baseline.get(nome)
+        rapporto = ""
+        if base and base.get("tempo_ms"):
+            x = r["tempo_ms"] / base["tempo_ms"]
+            rapporto = f"x{x:.2f}"
+            if x > args.soglia and r["tempo_ms"] - base["tempo_ms"] >= args.min_ms:
+                rapporto += " !"
+                regressioni.append(nome)
+        print(f"{nome:28} {r['tempo_ms']:>10.2f} {r['picco_kb']:>10.1f} "
+              f"{(base or {}).get('tempo_ms', ''):>10} {rapporto:>9}")
+
+    if args.salva_baseline:
+        baseline.update(risultati)
+        with open(BASELINE, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline aggiornata: {BASELINE}")
+    elif regressioni:
+        print(f"Regressioni oltre x{args.soglia}: {', '.join(regressioni)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_bench())
@@ -1,88 +1,358 @@
 # -*- coding: utf-8 -*-
 # FDV – Foglio di Viaggio (Kivy + pyfpdf + plyer)
 
+import time, os, sys
+_T0_AVVIO = time.perf_counter()
+
+# python main.py esporta|gazetteer ...: uso da riga di comando, senza argomenti né log di Kivy
+_RIGA_DI_COMANDO = __name__ == "__main__" and sys.argv[1:2] in (["esporta"], ["gazetteer"])
+if _RIGA_DI_COMANDO:
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+
+from kivy.config import Config
+from kivy.utils import platform
+if platform != "android":
+    # Dimensione impostata prima che la finestra venga creata
+    Config.set('graphics', 'width', '360')
+    Config.set('graphics', 'height', '720')
+
 from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.label import Label
-from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
 from kivy.uix.popup import Popup
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.widget import Widget
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
 from kivy.metrics import dp, sp
-from kivy.core.window import Window
-from kivy.utils import platform
 from kivy.clock import Clock
-from kivy.core.clipboard import Clipboard
 from kivy.animation import Animation
 
-from datetime import datetime
-import os, sys, shutil, subprocess, math, re, json
+from datetime import datetime, timezone
+import shutil, subprocess, math, re, json, threading, sqlite3, queue, csv, heapq, unicodedata
+from array import array
 from math import ceil
+from itertools import accumulate
+from collections import deque
+from bisect import bisect_left
+
+# =============================================================================
+# SERVIZI DI PIATTAFORMA (importati al primo uso) E TEMPI DI AVVIO
+# =============================================================================
 
-try:
+def _import_share():
     from plyer import share
-except Exception:
-    share = None
+    return share
+
+def _import_gps():
+    if os.environ.get("FDV_REPLAY"):
+        # Traccia registrata al posto del GPS reale (FDV_REPLAY_VELOCITA: 1 = tempo reale, vuoto = massima)
+        velocita = os.environ.get("FDV_REPLAY_VELOCITA")
+        return ReplayGPS(os.environ["FDV_REPLAY"], float(velocita) if velocita else None)
+    from plyer import gps
+    return gps
+
+def _import_clipboard():
+    from kivy.core.clipboard import Clipboard
+    return Clipboard
+
+def _import_permessi():
+    from android.permissions import request_permissions, Permission
+    return request_permissions, Permission
+
+def _import_storage():
+    from android.storage import primary_external_storage_path
+    return primary_external_storage_path
+
+def _import_jnius():
+    from jnius import autoclass
+    return autoclass
 
-try:
-    from plyer import gps as plyer_gps
-except Exception:
-    plyer_gps = None
+def _import_numpy():
+    import numpy
+    return numpy
 
-if platform == "android":
+_IMPORT_SERVIZI = {
+    "share": _import_share, "gps": _import_gps, "clipboard": _import_clipboard,
+    "permessi": _import_permessi, "storage": _import_storage, "jnius": _import_jnius,
+    "numpy": _import_numpy,
+}
+_SERVIZI = {}
+
+def _servizio(nome):
+    """Restituisce un servizio di piattaforma importandolo al primo uso (None se assente)"""
+    if nome not in _SERVIZI:
+        t0 = time.perf_counter()
+        try:
+            _SERVIZI[nome] = _IMPORT_SERVIZI[nome]()
+        except Exception:
+            _SERVIZI[nome] = None
+        _TEMPI_AVVIO.setdefault("servizi_ms", {})[nome] = round((time.perf_counter() - t0) * 1000, 1)
+    return _SERVIZI[nome]
+
+def _richiedi_permessi(nomi):
+    """Chiede i permessi Android indicati per nome (no-op altrove)"""
+    if platform != "android":
+        return
+    permessi = _servizio("permessi")
+    if not permessi:
+        return
+    request_permissions, Permission = permessi
     try:
-        from android.permissions import request_permissions, Permission
-        from android.storage import primary_external_storage_path
-        from jnius import autoclass
+        request_permissions([getattr(Permission, n) for n in nomi])
     except Exception:
-        request_permissions = None
-        Permission = None
-        primary_external_storage_path = None
-        autoclass = None
-else:
-    Window.size = (360, 720)
-
-def build_pdf_cartaceo(path_pdf, intest, corse):
+        pass
+
+# Millisecondi dall'avvio del processo per ogni fase (scritti in startup.log)
+_TEMPI_AVVIO = {}
+
+def _fase_avvio(nome):
+    _TEMPI_AVVIO[nome] = round((time.perf_counter() - _T0_AVVIO) * 1000, 1)
+
+# Riconoscimento testo corsa Uber negli appunti
+_RE_TRIP_UUID = re.compile(r"trip\s*#\s*[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.I)
+_RE_TRIP_TIME = re.compile(r"\b\d{2}/\d{2}/\d{2}\s+\d{2}:\d{2}:\d{2}(?:\s+[A-Z]{2,5})?\b")
+
+# =============================================================================
+# PARSER TESTO CORSE (Uber e simili)
+# =============================================================================
+
+# Alias delle chiavi nei testi incollati, per colonna e in ordine di priorità.
+# Per un nuovo formato basta aggiungere qui le sue etichette (in minuscolo).
+ALIAS_CHIAVI = {
+    "Fruitore servizio": ("passenger name", "passeggero", "fruitore", "rider", "cliente", "fruitore servizio"),
+    "Luogo di partenza": ("from", "partenza", "pickup", "luogo di partenza"),
+    "Luogo di destinazione": ("destination", "destinazione", "drop-off", "drop off", "dropoff",
+                              "luogo di destinazione"),
+}
+# Colonne il cui valore è un indirizzo da normalizzare
+COLONNE_INDIRIZZO = ("Luogo di partenza", "Luogo di destinazione")
+
+_ALIAS_NOTI = frozenset(a for alias in ALIAS_CHIAVI.values() for a in alias)
+_RE_SEP_CHIAVE = re.compile(r'\s{2,}|:\s*')
+_RE_CIN = re.compile(r'^\s*Cin:\s*[A-Za-z0-9]+,\s*', re.IGNORECASE)
+_RE_CAP = re.compile(r'(,\s*)?\b\d{5}\b(?=,|$|\s)')
+_RE_PAESE = re.compile(r',\s*(Italia|Italy)\s*$', re.IGNORECASE)
+_RE_SEPARATORI = re.compile(r'\s*(?:,\s*)+|\s{2,}')
+
+def _sep_indirizzo(m):
+    return ', ' if ',' in m.group() else ' '
+
+def pulisci_indirizzo(s: str) -> str:
+    """Normalizza un indirizzo: toglie codice Cin, CAP e paese finale.
+
+    Virgole, spazi multipli e virgole ripetute si sistemano in un solo passaggio.
+    """
+    if not s: return s
+    s = _RE_CIN.sub('', s)
+    s = _RE_CAP.sub('', s)
+    s = _RE_PAESE.sub('', s)
+    s = _RE_SEPARATORI.sub(_sep_indirizzo, s).strip()
+    if s.endswith(','):
+        s = s[:-1]
+    return s
+
+_SOSTITUZIONI_UI = {
+    "\u2026": "...", "\u2013": "-", "\u2014": "-", "\u2019": "'",
+    "\xa0": " ", "\u200b": "", "\u200c": "", "\u200d": "", "\ufeff": ""
+}
+
+def pulisci_ui(s) -> str:
+    """Testo mostrabile: punteggiatura tipografica semplificata, niente caratteri invisibili, spazi singoli"""
+    if s is None: return ""
+    t = str(s)
+    if not (t.isascii() and t.isprintable()):
+        for k, v in _SOSTITUZIONI_UI.items():
+            t = t.replace(k, v)
+        t = "".join(ch for ch in t if (ch.isprintable() or ch in " \t"))
+    return " ".join(t.split())
+
+def _senza_accenti(t: str) -> str:
+    if t.isascii():
+        return t.casefold()
+    t = unicodedata.normalize("NFKD", t)
+    return "".join(ch for ch in t if not unicodedata.combining(ch)).casefold()
+
+def normalizza_ricerca(s) -> str:
+    """Chiave di ricerca: pulisci_ui senza accenti e senza distinzione di maiuscole"""
+    return _senza_accenti(pulisci_ui(s))
+
+def parse_testo_corsa(txt: str) -> dict:
+    """Estrae fruitore, partenza e destinazione da un testo incollato.
+
+    Ogni riga è "chiave<TAB>valore", "chiave: valore" o "chiave  valore";
+    a parità di chiave vale l'ultima riga, a parità di colonna il primo alias
+    di ALIAS_CHIAVI con un valore non vuoto.
+    """
+    trovati = {}
+    for ln in (txt or "").splitlines():
+        ln = ln.strip()
+        if not ln: continue
+        if '\t' in ln:
+            k, _, v = ln.partition('\t')
+        else:
+            m = _RE_SEP_CHIAVE.search(ln)
+            if m is None: continue
+            k = ln[:m.start()]; v = ln[m.end():]
+        k = k.strip().lower()
+        if k in _ALIAS_NOTI:
+            trovati[k] = v.strip()
+    ret = {}
+    for colonna, alias in ALIAS_CHIAVI.items():
+        for a in alias:
+            val = trovati.get(a)
+            if val:
+                ret[colonna] = pulisci_indirizzo(val) if colonna in COLONNE_INDIRIZZO else val
+                break
+    return ret
+
+# Importazione di più corse: un blocco di testo per corsa
+_RE_INIZIO_CORSA = re.compile(r'^[ \t]*trip\s*#', re.IGNORECASE | re.MULTILINE)
+_RE_RIGHE_VUOTE = re.compile(r'\n[ \t]*\n\s*')
+
+def dividi_testo_corse(txt: str) -> list:
+    """Divide un testo con più corse nei marcatori "Trip #" o, se mancano, sulle righe vuote.
+
+    L'eventuale testo prima del primo marcatore resta con la prima corsa.
+    """
+    txt = (txt or "").replace("\r\n", "\n")
+    inizi = [m.start() for m in _RE_INIZIO_CORSA.finditer(txt)]
+    if inizi:
+        tagli = [0] + inizi[1:] + [len(txt)]
+        blocchi = [txt[a:b] for a, b in zip(tagli, tagli[1:])]
+    else:
+        blocchi = _RE_RIGHE_VUOTE.split(txt)
+    return [b.strip() for b in blocchi if b.strip()]
+
+def leggi_file_corse(path: str) -> list:
+    """Blocchi di testo di un file .txt, o righe di un .csv come righe intestazione<TAB>valore"""
+    if path.lower().endswith(".csv"):
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            campione = f.read(4096); f.seek(0)
+            try:
+                dialetto = csv.Sniffer().sniff(campione, delimiters=",;\t")
+            except csv.Error:
+                dialetto = csv.excel
+            lettore = csv.DictReader(f, dialect=dialetto)
+            return ["\n".join(f"{k}\t{v}" for k, v in riga.items() if k and v)
+                    for riga in lettore]
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return dividi_testo_corse(f.read())
+
+def analizza_corse(blocchi) -> tuple:
+    """(corse riconosciute, [(numero blocco, prima riga)] dei blocchi senza dati utili)"""
+    corse, scartati = [], []
+    for i, blocco in enumerate(blocchi, 1):
+        dati = parse_testo_corsa(blocco)
+        if dati:
+            corse.append(dati)
+        else:
+            scartati.append((i, blocco.strip().split("\n", 1)[0][:60] or "(vuoto)"))
+    return corse, scartati
+
+def _pdf_safe(s: str) -> str:
+    if s is None: return ""
+    t = str(s)
+    t = (t.replace("\u2026", "...").replace("\u2013", "-")
+           .replace("\u2014", "-").replace("\u2019", "'")
+           .replace("\xa0", " "))
+    try:
+        t.encode("latin-1")
+    except UnicodeEncodeError:
+        t = t.encode("latin-1", "ignore").decode("latin-1")
+    return t
+
+# Cache per processo: larghezze dei caratteri per font e testi già adattati
+_GLYPH_CACHE = {}      # (famiglia, stile, dimensione) -> [larghezza dei 256 caratteri latin-1]
+_FIT_CACHE = {}        # (famiglia, stile, dimensione, testo, w) -> testo adattato
+_FIT_CACHE_MAX = 4096
+
+def _glyph_widths(pdf):
+    """Larghezze dei caratteri del font corrente, misurate una sola volta per processo"""
+    key = (pdf.font_family, pdf.font_style, pdf.font_size_pt)
+    tabella = _GLYPH_CACHE.get(key)
+    if tabella is None:
+        tabella = _GLYPH_CACHE[key] = [pdf.get_string_width(chr(c)) for c in range(256)]
+    return key, tabella
+
+def _fit_text_ellipsis(pdf, text, w):
+    """Tronca il testo con "..." per farlo stare nella cella larga w.
+
+    Le larghezze vengono dalla tabella del font (_glyph_widths); il punto
+    di taglio si trova con una ricerca binaria sulle somme prefisse.
+    """
+    txt = _pdf_safe(text)
+    font_key, glyphs = _glyph_widths(pdf)
+    memo_key = font_key + (txt, w)
+    hit = _FIT_CACHE.get(memo_key)
+    if hit is not None:
+        return hit
+
+    limit = w - 2
+    ELL = "..."
+    # _pdf_safe garantisce testo latin-1: un byte per carattere
+    prefix = list(accumulate(map(glyphs.__getitem__, txt.encode("latin-1"))))
+
+    if not prefix or prefix[-1] <= limit:
+        res = txt
+    else:
+        ell_w = 3 * glyphs[ord(".")]
+        # Lunghezza massima n tale che i primi n caratteri + "..." stiano nella cella
+        lo, hi = 0, len(txt)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if prefix[mid - 1] + ell_w <= limit:
+                lo = mid
+            else:
+                hi = mid - 1
+        base = txt[:lo]
+        res = (base + ELL) if base else ELL
+
+    if len(_FIT_CACHE) >= _FIT_CACHE_MAX:
+        _FIT_CACHE.clear()
+    _FIT_CACHE[memo_key] = res
+    return res
+
+
+class EsportazioneAnnullata(Exception):
+    """Sollevata da build_pdf_cartaceo quando l'esportazione viene annullata"""
+
+
+# Impaginazione del foglio di viaggio, calcolata una volta per processo
+_PDF_COLONNE = [
+    "Fruitore servizio","Luogo di partenza","Ora di partenza","KM iniziali",
+    "Luogo di destinazione","Ora di arrivo","KM finali"
+]
+_PDF_LARGHEZZE = [40, 62, 31, 26, 62, 31, 25]
+_PDF_OFFSET = [sum(_PDF_LARGHEZZE[:j]) for j in range(len(_PDF_LARGHEZZE) + 1)]
+_PDF_ALLINEA = ["C" if ("Ora" in c) or ("KM" in c) else "L" for c in _PDF_COLONNE]
+_PDF_RIGHE_PAGINA = 16
+_PDF_ALTEZZA_RIGA = 8
+
+def build_pdf_cartaceo(path_pdf, intest, corse, on_page=None, annulla=None):
+    """Genera il PDF del foglio di viaggio.
+
+    La cornice della pagina (titolo, intestazione, titoli e griglia della
+    tabella) viene disegnata sulla prima pagina e il suo contenuto copiato
+    nelle successive; nelle righe si scrivono solo le celle non vuote.
+    on_page(pagina, pagine) viene chiamata dopo ogni pagina; se l'evento
+    `annulla` (threading.Event) viene impostato si solleva EsportazioneAnnullata.
+    """
     try:
         from fpdf import FPDF
     except Exception as e:
         raise RuntimeError("FPDF non installato (pip install fpdf)") from e
 
-    cols = [
-        "Fruitore servizio","Luogo di partenza","Ora di partenza","KM iniziali",
-        "Luogo di destinazione","Ora di arrivo","KM finali"
-    ]
-    widths = [40, 62, 31, 26, 62, 31, 25]
-    ROWS_PER_PAGE = 16
-    ROW_H = 8
-
-    def _pdf_safe(s: str) -> str:
-        if s is None: return ""
-        t = str(s)
-        t = (t.replace("\u2026", "...").replace("\u2013", "-")
-               .replace("\u2014", "-").replace("\u2019", "'")
-               .replace("\xa0", " "))
-        try:
-            t.encode("latin-1")
-        except UnicodeEncodeError:
-            t = t.encode("latin-1", "ignore").decode("latin-1")
-        return t
-
-    def _fit_text_ellipsis(pdf, text, w):
-        txt = _pdf_safe(text)
-        if pdf.get_string_width(txt) <= w - 2: return txt
-        base = txt; ELL = "..."
-        while base and pdf.get_string_width(base + ELL) > w - 2:
-            base = base[:-1]
-        return (base + ELL) if base else ELL
-
-    def _is_centered_col(name):
-        return ("Ora" in name) or ("KM" in name)
-
-    all_rows = [{k: str((r or {}).get(k, "")) for k in cols} for r in (corse or [])]
+    cols = _PDF_COLONNE
+    ROWS_PER_PAGE = _PDF_RIGHE_PAGINA
+    ROW_H = _PDF_ALTEZZA_RIGA
+
+    all_rows = [[str((r or {}).get(k, "")) for k in cols] for r in (corse or [])]
     total_rows = len(all_rows)
     if total_rows == 0:
         pages = 1
@@ -91,8 +361,10 @@ def build_pdf_cartaceo(path_pdf, intest, corse):
 
     pdf = FPDF(orientation="L", unit="mm", format="A4")
     pdf.set_auto_page_break(auto=False)
+    x0 = pdf.l_margin
+    celle = [(x0 + off, w, a) for off, w, a in zip(_PDF_OFFSET, _PDF_LARGHEZZE, _PDF_ALLINEA)]
 
-    def header_page():
+    def cornice():
         pdf.set_font("Helvetica", "B", 16)
         pdf.cell(0, 10, "FOGLIO DI VIAGGIO", ln=1, align="C")
         i = intest or {}
@@ -106,37 +378,2015 @@ def build_pdf_cartaceo(path_pdf, intest, corse):
         pdf.cell(120, 6, f"KM finali rimessa: {i.get('KM finali rimessa','')}", ln=1)
         pdf.ln(4)
         pdf.set_font("Helvetica", "B", 10)
-        for w, h in zip(widths, cols):
+        for w, h in zip(_PDF_LARGHEZZE, cols):
             pdf.cell(w, ROW_H, h, 1, 0, "C")
         pdf.ln(ROW_H)
-        pdf.set_font("Helvetica", "", 10)
+        # Griglia delle righe: una linea per bordo invece di un rettangolo per cella
+        y0 = pdf.get_y(); y1 = y0 + ROWS_PER_PAGE * ROW_H; x1 = x0 + _PDF_OFFSET[-1]
+        for k in range(1, ROWS_PER_PAGE + 1):
+            pdf.line(x0, y0 + k * ROW_H, x1, y0 + k * ROW_H)
+        for off in _PDF_OFFSET:
+            pdf.line(x0 + off, y0, x0 + off, y1)
+        return y0
 
+    frame = None
+    y_righe = None
     pos = 0
     for p in range(pages):
+        if annulla is not None and annulla.is_set():
+            raise EsportazioneAnnullata()
         pdf.add_page(orientation="L")
-        header_page()
-
-        slice_rows = all_rows[pos: pos + ROWS_PER_PAGE]; pos += ROWS_PER_PAGE
-        while len(slice_rows) < ROWS_PER_PAGE:
-            slice_rows.append({k: "" for k in cols})
-        for corsa in slice_rows:
-            for w, name in zip(widths, cols):
-                raw = corsa.get(name, "")
-                txt = _fit_text_ellipsis(pdf, raw, w)
-                align = "C" if _is_centered_col(name) else "L"
-                pdf.cell(w, ROW_H, txt, border=1, ln=0, align=align)
-            pdf.ln(ROW_H)
+        if frame is None:
+            contenuto = pdf.pages.get(pdf.page)
+            inizio = len(contenuto) if isinstance(contenuto, str) else None
+            y_righe = cornice()
+            if inizio is not None:
+                frame = pdf.pages[pdf.page][inizio:]
+        else:
+            pdf.pages[pdf.page] += frame
+        pdf.set_font("Helvetica", "", 10)
+
+        for r, corsa in enumerate(all_rows[pos: pos + ROWS_PER_PAGE]):
+            y = y_righe + r * ROW_H
+            for (x, w, align), raw in zip(celle, corsa):
+                if not raw:
+                    continue
+                pdf.set_xy(x, y)
+                pdf.cell(w, ROW_H, _fit_text_ellipsis(pdf, raw, w), border=0, ln=0, align=align)
+        pos += ROWS_PER_PAGE
         pdf.set_y(-10); pdf.set_font("Helvetica", "", 8)
         pdf.cell(0, 6, f"Pagina {p+1}/{pages}", align="R")
+        if on_page is not None:
+            on_page(p + 1, pages)
 
+    if annulla is not None and annulla.is_set():
+        raise EsportazioneAnnullata()
     pdf.output(path_pdf)
     return path_pdf
 
+# Esportazioni di dati: una riga per corsa, scritta mentre le corse arrivano
+COLONNE_DATI = ["Giorno", "Foglio di servizio N°", "Targa", "Nome e Cognome"] + _PDF_COLONNE
+_PASSO_AVANZAMENTO = 200    # corse tra due controlli di avanzamento/annullamento
+
+def _righe_dati(corse, on_page, annulla):
+    """(corsa, valori delle COLONNE_DATI) per ogni corsa; on_page(corse, None) ogni tanto"""
+    n = 0
+    for c in corse:
+        if n % _PASSO_AVANZAMENTO == 0:
+            if annulla is not None and annulla.is_set():
+                raise EsportazioneAnnullata()
+            if on_page is not None and n:
+                on_page(n, None)
+        n += 1
+        yield c, [str(c.get(k, "") or "") for k in COLONNE_DATI]
+    if annulla is not None and annulla.is_set():
+        raise EsportazioneAnnullata()
+    if on_page is not None:
+        on_page(n, None)
+
+def scrivi_csv(path, intest, corse, on_page=None, annulla=None):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        w.writerow(COLONNE_DATI)
+        for _c, valori in _righe_dati(corse, on_page, annulla):
+            w.writerow(valori)
+    return path
+
+def scrivi_jsonl(path, intest, corse, on_page=None, annulla=None):
+    with open(path, 'w', encoding='utf-8') as f:
+        for c, valori in _righe_dati(corse, on_page, annulla):
+            rec = {"id": c.get("_id")}
+            rec.update(zip(COLONNE_DATI, valori))
+            if "_gps" in c:
+                rec["gps"] = c["_gps"]
+            if c.get("_traccia"):
+                rec["traccia"] = c["_traccia"]
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    return path
+
+_XLSX_INTESTAZIONE_XML = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_XLSX_PARTI = {
+    "[Content_Types].xml":
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    "_rels/.rels":
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    "xl/workbook.xml":
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Corse" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    "xl/_rels/workbook.xml.rels":
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+_RE_XML_NON_VALIDI = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+_RE_INTERO = re.compile(r"-?\d{1,15}")
+_XLSX_NUMERICHE = {i for i, c in enumerate(COLONNE_DATI) if c.startswith("KM")}
+
+def _xlsx_riga(valori):
+    from xml.sax.saxutils import escape
+    celle = []
+    for i, v in enumerate(valori):
+        if i in _XLSX_NUMERICHE and _RE_INTERO.fullmatch(v):
+            celle.append(f'<c t="n"><v>{v}</v></c>')
+        else:
+            celle.append(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_RE_XML_NON_VALIDI.sub("", v))}</t></is></c>')
+    return "<row>" + "".join(celle) + "</row>"
+
+def scrivi_xlsx(path, intest, corse, on_page=None, annulla=None):
+    """Cartella Excel minima (un foglio, stringhe inline), scritta in streaming nello zip"""
+    import zipfile
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for nome, xml in _XLSX_PARTI.items():
+            z.writestr(nome, _XLSX_INTESTAZIONE_XML + xml)
+        with z.open("xl/worksheets/sheet1.xml", 'w') as f:
+            f.write((_XLSX_INTESTAZIONE_XML +
+                     '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                     + _xlsx_riga(COLONNE_DATI)).encode("utf-8"))
+            for _c, valori in _righe_dati(corse, on_page, annulla):
+                f.write(_xlsx_riga(valori).encode("utf-8"))
+            f.write(b"</sheetData></worksheet>")
+    return path
+
+# Formati di esportazione: nome -> (etichetta, estensione, tipo MIME, scrittura).
+# La scrittura riceve (path, intest, corse, on_page, annulla) con `corse`
+# iteratore; il PDF riguarda un solo foglio, gli altri anche più giorni.
+ESPORTATORI = {
+    "pdf": ("PDF", ".pdf", "application/pdf", build_pdf_cartaceo),
+    "csv": ("CSV", ".csv", "text/csv", scrivi_csv),
+    "jsonl": ("JSON Lines", ".jsonl", "application/x-ndjson", scrivi_jsonl),
+    "xlsx": ("Excel", ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", scrivi_xlsx),
+}
+
+class TracciaGPS:
+    """Traccia GPS compatta: array di double in memoria e coda su file binario.
+
+    In memoria restano al più FINESTRA punti; i più vecchi vengono scritti
+    su un file per corsa (record di 3 double: lat, lon, timestamp). Il file
+    viene creato solo al primo riversamento; `percorso` è una funzione che
+    ne restituisce il path.
+    """
+    FINESTRA = 4096     # punti massimi in memoria
+    TIENI = 256         # punti lasciati in memoria dopo un riversamento
+    BLOCCO = 4096       # punti letti per volta dal file
+
+    def __init__(self, percorso=None):
+        self._percorso = percorso
+        self.path = None
+        self.lat = array('d'); self.lon = array('d'); self.ts = array('d')
+        self.su_file = 0    # punti già riversati su file
+
+    def __len__(self):
+        return self.su_file + len(self.lat)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def append(self, pt, ts=0.0):
+        self.lat.append(pt[0]); self.lon.append(pt[1]); self.ts.append(ts)
+        if len(self.lat) >= self.FINESTRA and self._percorso is not None:
+            self._riversa(len(self.lat) - self.TIENI)
+
+    def ultimo(self):
+        """Ultimo punto (lat, lon), o None se la traccia è vuota"""
+        if not self.lat:
+            return None
+        return (self.lat[-1], self.lon[-1])
+
+    def _riversa(self, n):
+        if self.path is None:
+            self.path = self._percorso()
+        buf = array('d', [0.0]) * (3 * n)
+        buf[0::3] = self.lat[:n]; buf[1::3] = self.lon[:n]; buf[2::3] = self.ts[:n]
+        with open(self.path, 'ab') as f:
+            buf.tofile(f)
+        del self.lat[:n]; del self.lon[:n]; del self.ts[:n]
+        self.su_file += n
+
+    def punti(self):
+        """Iteratore (lat, lon, ts) su tutta la traccia, file compreso, a blocchi"""
+        if self.path and self.su_file:
+            with open(self.path, 'rb') as f:
+                while True:
+                    raw = f.read(self.BLOCCO * 3 * 8)
+                    if not raw:
+                        break
+                    buf = array('d'); buf.frombytes(raw[:len(raw) - len(raw) % 24])
+                    for i in range(0, len(buf), 3):
+                        yield (buf[i], buf[i + 1], buf[i + 2])
+        for i in range(len(self.lat)):
+            yield (self.lat[i], self.lon[i], self.ts[i])
+
+    def __iter__(self):
+        for la, lo, _t in self.punti():
+            yield (la, lo)
+
+    def reset(self):
+        """Svuota la traccia ed elimina il file della corsa"""
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self.path = None
+        self.lat = array('d'); self.lon = array('d'); self.ts = array('d')
+        self.su_file = 0
+
+
+# Formato compatto delle tracce archiviate con le corse (.fdvt): intestazione
+# TRACCIA_MAGIC, poi per ogni punto le differenze rispetto al precedente di
+# lat, lon (1e-5 gradi, circa 1 m) e tempo (decimi di secondo), come varint
+# zigzag. Un punto occupa di solito 3-5 byte invece di 24.
+TRACCIA_MAGIC = b"FDVT\x01"
+TRACCIA_SCALA_GRADI = 1e5
+TRACCIA_SCALA_TEMPO = 10.0
+
+def codifica_traccia(punti):
+    """Punti (lat, lon, ts) → bytes nel formato compatto"""
+    buf = bytearray(TRACCIA_MAGIC)
+    prec = [0, 0, 0]
+    for lat, lon, ts in punti:
+        q = (round(lat * TRACCIA_SCALA_GRADI), round(lon * TRACCIA_SCALA_GRADI),
+             round(ts * TRACCIA_SCALA_TEMPO))
+        for i in range(3):
+            d = q[i] - prec[i]
+            z = d * 2 if d >= 0 else -d * 2 - 1
+            while z >= 0x80:
+                buf.append((z & 0x7F) | 0x80); z >>= 7
+            buf.append(z)
+        prec = q
+    return bytes(buf)
+
+def decodifica_traccia(dati):
+    """Iteratore (lat, lon, ts) su una traccia nel formato compatto"""
+    if not dati.startswith(TRACCIA_MAGIC):
+        raise ValueError("Formato traccia non riconosciuto")
+    val = [0, 0, 0]
+    k = n = shift = 0
+    for b in memoryview(dati)[len(TRACCIA_MAGIC):]:
+        n |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        val[k] += (n >> 1) ^ -(n & 1)
+        n = shift = 0
+        k += 1
+        if k == 3:
+            k = 0
+            yield (val[0] / TRACCIA_SCALA_GRADI, val[1] / TRACCIA_SCALA_GRADI,
+                   val[2] / TRACCIA_SCALA_TEMPO)
+
+def scrivi_gpx(path, tracce):
+    """Scrive un GPX con un <trk> per ogni (nome, punti); restituisce le tracce scritte"""
+    from xml.sax.saxutils import escape
+    scritte = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" creator="FDV" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        for nome, punti in tracce:
+            f.write(f"<trk><name>{escape(nome)}</name><trkseg>\n")
+            for lat, lon, ts in punti:
+                ora = ""
+                if ts > 0:
+                    ora = "<time>" + datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ") + "</time>"
+                f.write(f'<trkpt lat="{lat:.5f}" lon="{lon:.5f}">{ora}</trkpt>\n')
+            f.write("</trkseg></trk>\n")
+            scritte += 1
+        f.write("</gpx>\n")
+    return scritte
+
+
+# =============================================================================
+# RIPRODUZIONE DI TRACCE GPS REGISTRATE (GPX, NMEA, CSV)
+# =============================================================================
+
+HDOP_M = 5.0            # metri di accuratezza stimati per unità di HDOP
+NODI_MS = 0.514444      # nodi → m/s
+
+_ALIAS_CSV_TRACCIA = {
+    "lat": ("lat", "latitude", "latitudine"),
+    "lon": ("lon", "lng", "long", "longitude", "longitudine"),
+    "timestamp": ("timestamp", "time", "ts", "ora", "datetime"),
+    "accuracy": ("accuracy", "acc", "accuratezza", "precisione"),
+    "speed": ("speed", "velocita", "velocità"),
+}
+
+def _ts_traccia(s):
+    """Timestamp di una traccia (epoch in secondi o ISO 8601) → epoch"""
+    s = (s or "").strip()
+    try:
+        return float(s)
+    except ValueError:
+        pass
+    if s.endswith("Z"):
+        s = s[:-1] + "+00:00"
+    return datetime.fromisoformat(s).timestamp()
+
+def _leggi_gpx(path):
+    import xml.etree.ElementTree as ET
+    for _ev, el in ET.iterparse(path):
+        if el.tag.rsplit('}', 1)[-1] != 'trkpt':
+            continue
+        fix = {'lat': float(el.get('lat')), 'lon': float(el.get('lon'))}
+        for figlio in el.iter():
+            tag = figlio.tag.rsplit('}', 1)[-1]
+            testo = (figlio.text or "").strip()
+            if not testo:
+                continue
+            if tag == 'time':
+                fix['timestamp'] = _ts_traccia(testo)
+            elif tag == 'speed':
+                fix['speed'] = float(testo)
+            elif tag == 'hdop' and 'accuracy' not in fix:
+                fix['accuracy'] = float(testo) * HDOP_M
+            elif tag in ('accuracy', 'acc'):
+                fix['accuracy'] = float(testo)
+        el.clear()
+        yield fix
+
+def _nmea_gradi(valore, emisfero):
+    v = float(valore)
+    gradi = int(v // 100)
+    g = gradi + (v - gradi * 100) / 60.0
+    return -g if emisfero in ('S', 'W') else g
+
+def _leggi_nmea(path):
+    """Frasi RMC (posizione, ora, velocità) con l'HDOP dell'ultima GGA"""
+    hdop = None
+    with open(path, encoding='ascii', errors='ignore') as f:
+        for riga in f:
+            riga = riga.strip()
+            if not riga.startswith('$'):
+                continue
+            campi = riga[1:].split('*', 1)[0].split(',')
+            tipo = campi[0][2:]
+            try:
+                if tipo == 'GGA' and len(campi) > 8 and campi[8]:
+                    hdop = float(campi[8])
+                elif tipo == 'RMC' and len(campi) > 9 and campi[2] == 'A':
+                    hms, _, frazione = campi[1].partition('.')
+                    ts = datetime.strptime(campi[9] + hms, "%d%m%y%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+                    fix = {
+                        'lat': _nmea_gradi(campi[3], campi[4]),
+                        'lon': _nmea_gradi(campi[5], campi[6]),
+                        'timestamp': ts + (float("0." + frazione) if frazione else 0.0),
+                    }
+                    if campi[7]:
+                        fix['speed'] = float(campi[7]) * NODI_MS
+                    if hdop is not None:
+                        fix['accuracy'] = hdop * HDOP_M
+                    yield fix
+            except ValueError:
+                continue
+
+def _leggi_csv(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        lettore = csv.DictReader(f)
+        colonne = {}
+        for chiave, alias in _ALIAS_CSV_TRACCIA.items():
+            for nome in lettore.fieldnames or []:
+                if nome.strip().lower() in alias:
+                    colonne[chiave] = nome
+                    break
+        if 'lat' not in colonne or 'lon' not in colonne:
+            raise ValueError("CSV senza colonne lat/lon")
+        for riga in lettore:
+            try:
+                fix = {'lat': float(riga[colonne['lat']]), 'lon': float(riga[colonne['lon']])}
+                # Colonna assente: niente riga.get(None), che darebbe i campi in più della riga
+                if 'timestamp' in colonne and riga.get(colonne['timestamp']):
+                    fix['timestamp'] = _ts_traccia(riga[colonne['timestamp']])
+                for chiave in ('accuracy', 'speed'):
+                    if chiave in colonne and riga.get(colonne[chiave]):
+                        fix[chiave] = float(riga[colonne[chiave]])
+            except (TypeError, ValueError):
+                continue
+            yield fix
+
+_LETTORI_TRACCIA = {".gpx": _leggi_gpx, ".nmea": _leggi_nmea, ".log": _leggi_nmea, ".txt": _leggi_nmea, ".csv": _leggi_csv}
+
+def leggi_traccia(path):
+    """Fix di una traccia registrata come dict per `on_location` (lat, lon, timestamp, accuracy, speed).
+
+    La velocità mancante è ricavata dai punti vicini, l'accuratezza mancante vale 10 m.
+    """
+    lettore = _LETTORI_TRACCIA.get(os.path.splitext(path)[1].lower())
+    if lettore is None:
+        raise ValueError(f"Formato traccia non riconosciuto: {path}")
+    prec = None
+    for fix in lettore(path):
+        fix.setdefault('accuracy', 10.0)
+        if 'speed' not in fix:
+            fix['speed'] = 0.0
+            if prec is not None and fix.get('timestamp') is not None and prec.get('timestamp') is not None:
+                dt = fix['timestamp'] - prec['timestamp']
+                if dt > 0:
+                    d_m = CorseScreen._hav_km((prec['lat'], prec['lon']), (fix['lat'], fix['lon'])) * 1000.0
+                    fix['speed'] = d_m / dt
+        prec = fix
+        yield fix
+
+class ReplayGPS:
+    """Sorgente GPS che riproduce una traccia con la stessa interfaccia di plyer.gps.
+
+    I fix passano dallo stesso callback `on_location`, con il timestamp della
+    traccia. `velocita` è il fattore rispetto al tempo reale (1.0 = tempo
+    reale); None riproduce il più veloce possibile, BLOCCO fix per frame.
+    minTime/minDistance di start() filtrano i fix come il provider Android.
+    """
+    BLOCCO = 500
+
+    def __init__(self, traccia, velocita=None):
+        self.fix = list(leggi_traccia(traccia)) if isinstance(traccia, str) else list(traccia)
+        self.velocita = velocita
+        self.pos = 0
+        self.consegnati = 0
+        self.on_location = None; self.on_status = None
+        self._min_time_s = 0.0; self._min_dist_m = 0.0
+        self._ultimo = None
+        self._rif = (0.0, 0.0)  # (perf_counter, timestamp della traccia) all'avvio
+        self._ev = None
+
+    def configure(self, on_location, on_status=None):
+        self.on_location = on_location; self.on_status = on_status
+
+    def start(self, minTime=1000, minDistance=0):
+        self._min_time_s = minTime / 1000.0; self._min_dist_m = float(minDistance)
+        self.stop()
+        if self.on_status is not None:
+            self.on_status('provider-enabled', 'replay')
+        if not self.finita:
+            # La traccia riprende da dove era stata fermata
+            self._rif = (time.perf_counter(), self.fix[self.pos].get('timestamp') or 0.0)
+            self._ev = Clock.schedule_once(self._passo, 0)
+
+    def stop(self):
+        if self._ev is not None:
+            self._ev.cancel(); self._ev = None
+
+    def riavvolgi(self):
+        self.stop()
+        self.pos = 0; self.consegnati = 0; self._ultimo = None
+
+    @property
+    def finita(self):
+        return self.pos >= len(self.fix)
+
+    def _filtra(self, fix):
+        u = self._ultimo
+        if u is None:
+            return True
+        if self._min_time_s and fix.get('timestamp') is not None and u.get('timestamp') is not None:
+            if fix['timestamp'] - u['timestamp'] < self._min_time_s:
+                return False
+        if self._min_dist_m:
+            if CorseScreen._hav_km((u['lat'], u['lon']), (fix['lat'], fix['lon'])) * 1000.0 < self._min_dist_m:
+                return False
+        return True
+
+    def _consegna(self, fix):
+        if self._filtra(fix):
+            self._ultimo = fix
+            self.consegnati += 1
+            self.on_location(**fix)
+
+    def _passo(self, dt):
+        self._ev = None
+        attesa = 0
+        if self.velocita is None:
+            fine = min(self.pos + self.BLOCCO, len(self.fix))
+        else:
+            # Tutti i fix già scaduti rispetto all'orologio della riproduzione
+            ora = self._rif[1] + (time.perf_counter() - self._rif[0]) * self.velocita
+            fine = self.pos
+            while fine < len(self.fix) and fine - self.pos < self.BLOCCO and (self.fix[fine].get('timestamp') or ora) <= ora:
+                fine += 1
+            fine = max(fine, self.pos + 1)
+        while self.pos < fine:
+            fix = self.fix[self.pos]; self.pos += 1
+            self._consegna(fix)
+        if self.finita:
+            if self.on_status is not None:
+                self.on_status('provider-disabled', 'replay')
+            return
+        if self.velocita is not None:
+            ts = self.fix[self.pos].get('timestamp')
+            if ts is not None:
+                ora = self._rif[1] + (time.perf_counter() - self._rif[0]) * self.velocita
+                attesa = max(0.0, (ts - ora) / self.velocita)
+        if self._ev is None:
+            self._ev = Clock.schedule_once(self._passo, attesa)
+
+    def riproduci_tutto(self):
+        """Riproduce subito i fix rimanenti, senza Clock (profilazione offline)"""
+        self.stop()
+        while not self.finita:
+            fix = self.fix[self.pos]; self.pos += 1
+            self._consegna(fix)
+        return self.consegnati
+
+# =============================================================================
+# GEOCODIFICA INVERSA OFFLINE (stradario locale indicizzato a griglia)
+# =============================================================================
+
+# File .fdvg: intestazione, chiavi di cella ordinate (int64), inizio di ogni
+# cella (uint32), lat/lon dei punti in milionesimi di grado (int32), offset
+# degli indirizzi (uint32) e indirizzi UTF-8 già normalizzati. Tutti gli
+# array sono letti direttamente dal file mappato in memoria.
+GAZETTEER_MAGIC = b"FDVG\x01\x00\x00\x00"
+_GAZETTEER_TESTA = "<8sdQQQ"      # magic, lato cella (gradi), celle, punti, byte indirizzi
+_ALIAS_CSV_GAZETTEER = {
+    "lat": ("lat", "latitude", "latitudine", "y"),
+    "lon": ("lon", "lng", "long", "longitude", "longitudine", "x"),
+    "indirizzo": ("indirizzo", "address", "full_address", "display_name"),
+    "via": ("street", "via", "strada", "addr:street"),
+    "civico": ("number", "numero", "civico", "housenumber", "addr:housenumber"),
+    "citta": ("city", "citta", "città", "comune", "addr:city"),
+}
+
+def _cella_gazetteer(lat, lon, lato):
+    return int((lat + 90.0) // lato), int((lon + 180.0) // lato)
+
+def _chiave_cella(ilat, ilon):
+    return ilat * 1000000 + ilon
+
+def compila_gazetteer(path_csv, path_out, lato=0.001):
+    """Compila un CSV di indirizzi (OpenAddresses, estratti OSM o lat,lon,indirizzo) in un file .fdvg.
+
+    Gli indirizzi sono normalizzati con pulisci_indirizzo; `lato` è il lato
+    delle celle della griglia in gradi. Restituisce il numero di punti.
+    Da riga di comando: python main.py gazetteer indirizzi.csv; l'app usa il
+    file se si trova come gazetteer.fdvg nella sua cartella dati (user_data_dir,
+    accanto a fdv.db; su Android la cartella files dell'app).
+    """
+    import struct
+    punti = []
+    with open(path_csv, newline='', encoding='utf-8-sig') as f:
+        lettore = csv.DictReader(f)
+        colonne = {}
+        for chiave, alias in _ALIAS_CSV_GAZETTEER.items():
+            for nome in lettore.fieldnames or []:
+                if nome.strip().lower() in alias:
+                    colonne[chiave] = nome
+                    break
+        if "lat" not in colonne or "lon" not in colonne:
+            raise ValueError("CSV senza colonne lat/lon")
+        for riga in lettore:
+            try:
+                lat = float(riga[colonne["lat"]]); lon = float(riga[colonne["lon"]])
+            except (TypeError, ValueError):
+                continue
+            # Solo colonne presenti: riga.get(None) darebbe i campi in più della riga
+            campo = lambda chiave: (riga.get(colonne[chiave]) or "").strip() if chiave in colonne else ""
+            testo = campo("indirizzo")
+            if not testo:
+                via = " ".join(v for v in (campo("via"), campo("civico")) if v)
+                testo = ", ".join(v for v in (via, campo("citta")) if v)
+            testo = pulisci_indirizzo(testo)
+            if testo:
+                punti.append((_chiave_cella(*_cella_gazetteer(lat, lon, lato)),
+                              round(lat * 1e6), round(lon * 1e6), testo))
+    punti.sort()
+
+    chiavi = array('q'); inizi = array('I')
+    lats = array('i'); lons = array('i'); offset = array('I', [0])
+    blob = bytearray()
+    for i, (k, la, lo, testo) in enumerate(punti):
+        if not chiavi or chiavi[-1] != k:
+            chiavi.append(k); inizi.append(i)
+        lats.append(la); lons.append(lo)
+        blob += testo.encode('utf-8'); offset.append(len(blob))
+    inizi.append(len(punti))
+
+    def allinea(f):
+        f.write(b"\0" * (-f.tell() % 8))
+
+    tmp = path_out + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack(_GAZETTEER_TESTA, GAZETTEER_MAGIC, lato, len(chiavi), len(punti), len(blob)))
+        for arr in (chiavi, inizi, lats, lons, offset):
+            allinea(f)
+            arr.tofile(f)
+        f.write(blob)
+    os.replace(tmp, path_out)
+    return len(punti)
+
+class GeocoderInverso:
+    """Indirizzo più vicino a una posizione, da un file .fdvg mappato in memoria.
+
+    La ricerca parte dalla cella della posizione e si allarga ad anelli di
+    celle finché possono contenere un punto più vicino, fino a `raggio_m`.
+    """
+
+    def __init__(self, path, raggio_m=150.0):
+        import mmap, struct
+        self.path = path
+        self.raggio_m = raggio_m
+        self._f = open(path, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self._mm)
+        testa = struct.calcsize(_GAZETTEER_TESTA)
+        magic, self.lato, n_celle, n_punti, n_blob = struct.unpack_from(_GAZETTEER_TESTA, self._mm, 0)
+        if magic != GAZETTEER_MAGIC:
+            raise ValueError("Stradario non riconosciuto")
+        pos = testa
+
+        def sezione(fmt, n, dim):
+            nonlocal pos
+            pos += -pos % 8
+            vista = mv[pos:pos + n * dim].cast(fmt)
+            pos += n * dim
+            return vista
+
+        self._chiavi = sezione('q', n_celle, 8)
+        self._inizi = sezione('I', n_celle + 1, 4)
+        self._lat = sezione('i', n_punti, 4)
+        self._lon = sezione('i', n_punti, 4)
+        self._offset = sezione('I', n_punti + 1, 4)
+        self._blob = mv[pos:pos + n_blob]
+        self.punti = n_punti
+
+    def chiudi(self):
+        for vista in (self._chiavi, self._inizi, self._lat, self._lon, self._offset, self._blob):
+            vista.release()
+        self._mm.close(); self._f.close()
+
+    def _cella(self, ilat, ilon):
+        """Intervallo [a, b) dei punti di una cella (vuoto se assente)"""
+        k = _chiave_cella(ilat, ilon)
+        chiavi = self._chiavi
+        i = bisect_left(chiavi, k)
+        if i < len(chiavi) and chiavi[i] == k:
+            return self._inizi[i], self._inizi[i + 1]
+        return 0, 0
+
+    def cerca(self, lat, lon):
+        """Indirizzo normalizzato più vicino entro raggio_m, o None"""
+        ilat, ilon = _cella_gazetteer(lat, lon, self.lato)
+        # Distanze in milionesimi di grado, longitudine scalata con la latitudine
+        qla = lat * 1e6; qlo = lon * 1e6
+        kx = math.cos(math.radians(lat))
+        m_per_unita = 0.111195   # metri per milionesimo di grado di latitudine
+        limite = (self.raggio_m / m_per_unita) ** 2
+        migliore = -1; d_migliore = limite
+        lato_u = self.lato * 1e6 * min(1.0, kx)
+        lat_a = self._lat; lon_a = self._lon
+        anelli = int(self.raggio_m / (lato_u * m_per_unita)) + 1
+        for r in range(anelli + 1):
+            # Un anello può migliorare solo se la sua distanza minima è inferiore
+            if r > 1 and ((r - 1) * lato_u) ** 2 >= d_migliore:
+                break
+            for dla in range(-r, r + 1):
+                passo = 1 if abs(dla) == r else 2 * r
+                for dlo in range(-r, r + 1, passo or 1):
+                    a, b = self._cella(ilat + dla, ilon + dlo)
+                    for j in range(a, b):
+                        dy = lat_a[j] - qla; dx = (lon_a[j] - qlo) * kx
+                        d = dy * dy + dx * dx
+                        if d < d_migliore:
+                            d_migliore = d; migliore = j
+        if migliore < 0:
+            return None
+        return bytes(self._blob[self._offset[migliore]:self._offset[migliore + 1]]).decode('utf-8')
+
+# =============================================================================
+# LUOGHI FREQUENTI (dalle coordinate di salita e discesa delle corse salvate)
+# =============================================================================
+
+LATO_CELLA_LUOGHI = 0.001     # gradi, ~110 m in latitudine
+
+def _luoghi_corsa(corsa):
+    """(cella, indirizzo, partenze, arrivi, lat, lon) dei luoghi noti di una corsa"""
+    voci = []
+    for campo, chiave, tipo in (("Luogo di partenza", "_gps_partenza", (1, 0)),
+                                ("Luogo di destinazione", "_gps_arrivo", (0, 1))):
+        indirizzo = pulisci_indirizzo((corsa.get(campo) or "").strip())
+        pos = corsa.get(chiave)
+        if not indirizzo or not pos:
+            continue
+        try:
+            lat, lon = float(pos[0]), float(pos[1])
+        except (TypeError, ValueError, IndexError):
+            continue
+        cella = _chiave_cella(*_cella_gazetteer(lat, lon, LATO_CELLA_LUOGHI))
+        voci.append((cella, indirizzo) + tipo + (lat, lon))
+    return voci
+
+class IndiceLuoghi:
+    """Luoghi frequenti raggruppati in una griglia hash: cella -> {indirizzo: [partenze, arrivi, Σlat, Σlon]}.
+
+    Il punto di un luogo è la media delle posizioni di salita/discesa
+    registrate con quell'indirizzo nella stessa cella.
+    """
+
+    def __init__(self, righe=()):
+        self._celle = {}
+        for r in righe:
+            self._somma(r["cella"], r["indirizzo"], r["partenze"], r["arrivi"], r["lat"], r["lon"])
+
+    def __len__(self):
+        return sum(len(c) for c in self._celle.values())
+
+    def _somma(self, cella, indirizzo, partenze, arrivi, lat, lon):
+        voce = self._celle.setdefault(cella, {}).setdefault(indirizzo, [0, 0, 0.0, 0.0])
+        voce[0] += partenze; voce[1] += arrivi; voce[2] += lat; voce[3] += lon
+
+    def aggiungi_corsa(self, corsa):
+        for cella, indirizzo, partenze, arrivi, lat, lon in _luoghi_corsa(corsa):
+            self._somma(cella, indirizzo, partenze, arrivi, lat, lon)
+
+    def togli_corsa(self, corsa):
+        """Contrario di aggiungi_corsa (corsa modificata o eliminata), come ArchivioCorse._somma_luoghi(..., -1)"""
+        for cella, indirizzo, partenze, arrivi, lat, lon in _luoghi_corsa(corsa):
+            self._somma(cella, indirizzo, -partenze, -arrivi, -lat, -lon)
+            voci = self._celle[cella]
+            if voci[indirizzo][0] + voci[indirizzo][1] <= 0:
+                del voci[indirizzo]
+                if not voci:
+                    del self._celle[cella]
+
+    def vicino(self, lat, lon, raggio_m=80.0, arrivo=False):
+        """(indirizzo, visite, distanza_m) del luogo più frequentato entro raggio_m, o None.
+
+        Con arrivo=True contano le destinazioni, altrimenti le partenze; a
+        parità di visite vince il più vicino.
+        """
+        ilat, ilon = _cella_gazetteer(lat, lon, LATO_CELLA_LUOGHI)
+        # Un luogo può stare a cavallo di due celle: le voci vicine si uniscono per indirizzo
+        vicini = {}
+        for dla in (-1, 0, 1):
+            for dlo in (-1, 0, 1):
+                for indirizzo, voce in self._celle.get(_chiave_cella(ilat + dla, ilon + dlo), {}).items():
+                    somma = vicini.setdefault(indirizzo, [0, 0, 0.0, 0.0])
+                    for i in range(4):
+                        somma[i] += voce[i]
+        kx = math.cos(math.radians(lat))
+        migliore = None
+        for indirizzo, (partenze, arrivi, slat, slon) in vicini.items():
+            visite = arrivi if arrivo else partenze
+            if visite <= 0:
+                continue
+            n = partenze + arrivi
+            d = math.hypot(slat / n - lat, (slon / n - lon) * kx) * 111195.0
+            if d <= raggio_m and (migliore is None or (visite, -d) > (migliore[1], -migliore[2])):
+                migliore = (indirizzo, visite, d)
+        return migliore
+
+# =============================================================================
+# RILEVAMENTO DI SALITE E DISCESE (senza interfaccia, continuo o su traccia intera)
+# =============================================================================
+
+RAGGIO_TERRA_KM = 6371.0
+
+def distanza_km(p1, p2):
+    """Distanza haversine in km tra due punti (lat, lon)"""
+    lat1, lon1 = map(math.radians, p1)
+    lat2, lon2 = map(math.radians, p2)
+    dlat = lat2 - lat1; dlon = lon2 - lon1
+    a = math.sin(dlat/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin(dlon/2)**2
+    return 2 * RAGGIO_TERRA_KM * math.asin(math.sqrt(a))
+
+def _velocita_kmh(v):
+    # Alcuni provider danno m/s, altri già km/h
+    return (v * 3.6) if v <= 60 else v
+
+class RilevatoreCorse:
+    """Salite e discese da fix GPS con orario, senza widget né orologio di sistema.
+
+    fix() elabora un fix alla volta (uso in diretta) e restituisce gli eventi
+    che ne derivano: 'sosta' (inizio di una sosta in un luogo frequente),
+    'salita' e 'discesa', come dict con tipo, ts, lat, lon, km e luogo
+    (le soste anche con arrivo: True se la salita c'è già stata).
+    Dopo una discesa non scatta altro finché non si chiama azzera()
+    (nell'app: al salvataggio della corsa).
+
+    analizza() elabora un'intera traccia registrata come se ogni corsa
+    fosse salvata alla sua discesa; con numpy usa operazioni su array.
+    """
+    PRECISIONE_MAX_M = 100.0    # fix meno precisi vengono ignorati
+    PASSO_MAX_KM = 1.0          # salti più lunghi tra due fix non contano nei km
+
+    def __init__(self, luoghi=None):
+        self.fermo_kmh = 15.0
+        self.sosta_s = 10.0
+        self.sosta_luogo_noto_s = 3.0   # sosta sufficiente in un luogo frequente già noto
+        self.raggio_partenza_m = 50.0
+        self.raggio_luogo_m = 80.0      # distanza massima dal punto medio di un luogo noto
+        self.min_km_discesa = 0.5
+        self.luoghi = luoghi            # IndiceLuoghi, facoltativo
+        self.azzera()
+
+    def azzera(self):
+        """Nuova corsa: km e ultimo punto da capo"""
+        self.km = 0.0
+        self.ultimo = None
+        self.passo_km = 0.0         # km aggiunti dall'ultimo fix
+        self.velocita_kmh = 0.0
+        self.fermo = False
+        self.sosta_ok = False
+        self.azzera_decisioni()
+
+    def azzera_decisioni(self):
+        """Salita e discesa da rilevare di nuovo, senza perdere i km della corsa"""
+        self.salita = False
+        self.discesa = False
+        self.primo = None           # primo fix: la salita senza luogo noto avviene entro raggio_partenza_m
+        self.fermo_da = None
+        self.km_salita = None
+        self.luogo_noto = None      # (indirizzo, visite, distanza) del luogo frequente in cui si è fermi
+
+    def in_sospeso(self):
+        """True se una salita o discesa potrebbe scattare alla prossima sosta"""
+        if not self.salita:
+            return True
+        if self.discesa or self.km_salita is None:
+            return False
+        return (self.km - self.km_salita) >= self.min_km_discesa
+
+    def _evento(self, tipo, ts, pt, km):
+        return {"tipo": tipo, "ts": ts, "lat": pt[0], "lon": pt[1], "km": km,
+                "luogo": self.luogo_noto[0] if self.luogo_noto else None}
+
+    def fix(self, lat, lon, ts, velocita=0.0, precisione=0.0):
+        """Elabora un fix (ts in secondi, velocità in m/s o km/h); restituisce la lista degli eventi"""
+        if precisione > self.PRECISIONE_MAX_M:
+            return []
+        pt = (lat, lon)
+        d = 0.0
+        if self.ultimo is not None:
+            d = distanza_km(self.ultimo, pt)
+            if not (0.0 <= d <= self.PASSO_MAX_KM):
+                d = 0.0
+            self.km += d
+        self.ultimo = pt
+        self.passo_km = d
+        self.velocita_kmh = _velocita_kmh(velocita)
+        self.fermo = self.velocita_kmh <= self.fermo_kmh
+
+        eventi = []
+        if self.primo is None:
+            self.primo = pt
+        if self.fermo:
+            if self.fermo_da is None:
+                self.fermo_da = ts
+                if self.luoghi is not None:
+                    self.luogo_noto = self.luoghi.vicino(lat, lon, self.raggio_luogo_m, arrivo=self.salita)
+                    if self.luogo_noto is not None:
+                        eventi.append(dict(self._evento("sosta", ts, pt, self.km), arrivo=self.salita))
+        else:
+            self.fermo_da = None
+            self.luogo_noto = None
+        # In un luogo frequente la salita/discesa si riconosce con una sosta più breve
+        sosta_s = self.sosta_luogo_noto_s if self.luogo_noto is not None else self.sosta_s
+        self.sosta_ok = self.fermo_da is not None and (ts - self.fermo_da) >= sosta_s
+
+        if not self.salita and self.sosta_ok:
+            if distanza_km(self.primo, pt) * 1000.0 <= self.raggio_partenza_m or self.luogo_noto is not None:
+                self.salita = True; self.km_salita = self.km
+                eventi.append(self._evento("salita", ts, pt, self.km))
+        if self.salita and not self.discesa and self.sosta_ok and self.km_salita is not None:
+            percorsi = max(0.0, self.km - self.km_salita)
+            if percorsi >= self.min_km_discesa:
+                self.discesa = True
+                eventi.append(self._evento("discesa", ts, pt, percorsi))
+        return eventi
+
+    def _copia(self):
+        r = RilevatoreCorse(self.luoghi)
+        for nome in ("fermo_kmh", "sosta_s", "sosta_luogo_noto_s", "raggio_partenza_m",
+                     "raggio_luogo_m", "min_km_discesa"):
+            setattr(r, nome, getattr(self, nome))
+        return r
+
+    def analizza(self, lat, lon, ts, velocita, precisione=None):
+        """Eventi di un'intera traccia (sequenze parallele); lo stato in diretta non cambia"""
+        np = _servizio("numpy")
+        if np is None:
+            return self._analizza_sequenziale(lat, lon, ts, velocita, precisione)
+        return self._analizza_array(np, lat, lon, ts, velocita, precisione)
+
+    def _analizza_sequenziale(self, lat, lon, ts, velocita, precisione=None):
+        r = self._copia()
+        fix = r.fix
+        eventi = []
+        for i in range(len(lat)):
+            nuovi = fix(lat[i], lon[i], ts[i], velocita[i], precisione[i] if precisione is not None else 0.0)
+            if nuovi:
+                eventi.extend(nuovi)
+                if r.discesa:
+                    r.azzera()
+        return eventi
+
+    def _luogo(self, lat, lon, i, arrivo):
+        if self.luoghi is None:
+            return None
+        return self.luoghi.vicino(float(lat[i]), float(lon[i]), self.raggio_luogo_m, arrivo=arrivo)
+
+    def _soglia(self, luogo):
+        return self.sosta_luogo_noto_s if luogo is not None else self.sosta_s
+
+    def _analizza_array(self, np, lat, lon, ts, velocita, precisione=None):
+        lat = np.asarray(lat, dtype=float); lon = np.asarray(lon, dtype=float)
+        ts = np.asarray(ts, dtype=float); v = np.asarray(velocita, dtype=float)
+        if precisione is not None:
+            valido = np.asarray(precisione, dtype=float) <= self.PRECISIONE_MAX_M
+            lat, lon, ts, v = lat[valido], lon[valido], ts[valido], v[valido]
+        n = len(lat)
+        if n == 0:
+            return []
+        fermo = np.where(v <= 60, v * 3.6, v) <= self.fermo_kmh
+        # km cumulati: passi haversine tra fix consecutivi, esclusi i salti
+        rlat = np.radians(lat); rlon = np.radians(lon)
+        a = (np.sin(np.diff(rlat) / 2) ** 2 +
+             np.cos(rlat[:-1]) * np.cos(rlat[1:]) * np.sin(np.diff(rlon) / 2) ** 2)
+        passi = 2 * RAGGIO_TERRA_KM * np.arcsin(np.sqrt(a))
+        passi[passi > self.PASSO_MAX_KM] = 0.0
+        km = np.concatenate(([0.0], np.cumsum(passi)))
+
+        # Soste: inizio e fine (esclusa) di ogni tratto fermo, sosta a cui appartiene ogni fix
+        avvio = fermo.copy(); avvio[1:] &= ~fermo[:-1]
+        chiusura = fermo.copy(); chiusura[:-1] &= ~fermo[1:]
+        inizi = np.flatnonzero(avvio); fini = np.flatnonzero(chiusura) + 1
+        sosta_di = np.maximum(np.cumsum(avvio) - 1, 0)
+        trascorso = ts - ts[inizi[sosta_di]] if len(inizi) else np.zeros(n)
+        # Luogo noto di ogni sosta, cercato come partenza (prima della salita) e come arrivo
+        luoghi_p = [self._luogo(lat, lon, i, False) for i in inizi]
+        luoghi_a = [self._luogo(lat, lon, i, True) for i in inizi]
+        soglie_p = np.array([self._soglia(l) for l in luoghi_p] or [0.0])
+        soglie_a = np.array([self._soglia(l) for l in luoghi_a] or [0.0])
+        noti_p = np.array([l is not None for l in luoghi_p] or [False])
+        ok_p = np.flatnonzero(fermo & (trascorso >= soglie_p[sosta_di]))
+        ok_a = np.flatnonzero(fermo & (trascorso >= soglie_a[sosta_di]))
+
+        eventi = []
+        inizio = 0
+        while inizio < n:
+            primo = (float(lat[inizio]), float(lon[inizio]))
+            # La sosta in corso all'inizio del tratto riparte da qui, come dopo azzera()
+            fine0, luogo0, ok0 = inizio, None, ok_p[:0]
+            if fermo[inizio]:
+                fine0 = int(fini[sosta_di[inizio]])
+                luogo0 = self._luogo(lat, lon, inizio, False)
+                ok0 = inizio + np.flatnonzero(ts[inizio:fine0] - ts[inizio] >= self._soglia(luogo0))
+
+            def cerca_salita(candidati, noto):
+                for a in range(0, len(candidati), 256):
+                    blocco = candidati[a:a + 256]
+                    vicino = self._distanze_da(np, lat[blocco], lon[blocco], *primo) * 1000.0 \
+                        <= self.raggio_partenza_m
+                    trovati = np.flatnonzero(vicino | noto(blocco))
+                    if len(trovati):
+                        return int(blocco[trovati[0]])
+                return None
+
+            salita = cerca_salita(ok0, lambda b: np.full(len(b), luogo0 is not None))
+            if salita is None:
+                salita = cerca_salita(ok_p[np.searchsorted(ok_p, fine0):], lambda b: noti_p[sosta_di[b]])
+
+            discesa = None
+            if salita is not None:
+                # Primo fix a min_km_discesa dalla salita (i km cumulati non decrescono)
+                da = max(int(np.searchsorted(km, km[salita] + self.min_km_discesa - 1e-9)), salita)
+                while da < n and km[da] - km[salita] < self.min_km_discesa:
+                    da += 1
+                # Nella sosta della salita vale la sua soglia, in quelle dopo la soglia del luogo di arrivo
+                if salita < fine0:
+                    fine_s, ok_s = fine0, ok0
+                else:
+                    fine_s, ok_s = int(fini[sosta_di[salita]]), ok_p
+                k = np.searchsorted(ok_s, da)
+                if k < len(ok_s) and ok_s[k] < fine_s:
+                    discesa = int(ok_s[k])
+                else:
+                    k = np.searchsorted(ok_a, max(da, fine_s))
+                    if k < len(ok_a):
+                        discesa = int(ok_a[k])
+
+            def luogo_di(i):
+                """Luogo noto della sosta che contiene il fix i, come lo vede fix()"""
+                if i < fine0:
+                    return luogo0
+                s = int(sosta_di[i])
+                return luoghi_a[s] if salita is not None and inizi[s] > salita else luoghi_p[s]
+
+            fine = discesa if discesa is not None else n - 1
+            tratto = []
+            if self.luoghi is not None:
+                if luogo0 is not None:
+                    tratto.append((inizio, 0, "sosta", luogo0, 0.0, {"arrivo": False}))
+                for s in range(int(np.searchsorted(inizi, inizio, side='right')),
+                               int(np.searchsorted(inizi, fine, side='right'))):
+                    i = int(inizi[s])
+                    if luogo_di(i) is not None:
+                        tratto.append((i, 0, "sosta", luogo_di(i), float(km[i] - km[inizio]),
+                                       {"arrivo": salita is not None and i > salita}))
+            if salita is not None:
+                tratto.append((salita, 1, "salita", luogo_di(salita), float(km[salita] - km[inizio]), {}))
+            if discesa is not None:
+                tratto.append((discesa, 2, "discesa", luogo_di(discesa), float(km[discesa] - km[salita]), {}))
+            for i, _ordine, tipo, luogo, km_evento, altro in sorted(tratto, key=lambda t: t[:2]):
+                eventi.append(dict({"tipo": tipo, "ts": float(ts[i]), "lat": float(lat[i]), "lon": float(lon[i]),
+                                    "km": km_evento, "luogo": luogo[0] if luogo else None}, **altro))
+            if discesa is None:
+                break
+            inizio = discesa + 1
+        return eventi
+
+    @staticmethod
+    def _distanze_da(np, lat, lon, lat0, lon0):
+        rlat = np.radians(lat); r0 = math.radians(lat0)
+        a = (np.sin((rlat - r0) / 2) ** 2 +
+             math.cos(r0) * np.cos(rlat) * np.sin((np.radians(lon) - math.radians(lon0)) / 2) ** 2)
+        return 2 * RAGGIO_TERRA_KM * np.arcsin(np.sqrt(a))
+
+# =============================================================================
+# COMPLETAMENTO PER PREFISSO (fruitori e indirizzi già usati)
+# =============================================================================
+
+# Inizio di una parola di almeno tre caratteri ("di", "3" non servono come chiave)
+_RE_INIZIO_PAROLA = re.compile(r"[\s,;/()'\-]+(?=[^\s,;/()'\-]{3})")
+
+class IndicePrefissi:
+    """Valori già usati, cercati per prefisso con bisect su chiavi normalizzate ordinate.
+
+    Ogni valore è indicizzato dall'inizio e da ogni parola successiva, così
+    "nigu" trova anche "Ospedale Niguarda". Il punteggio è il numero di usi
+    dimezzato ogni MEZZA_VITA_GIORNI dall'ultimo uso; l'ordine che ne deriva
+    non dipende dal giorno corrente, quindi si calcola una volta per valore.
+    """
+    MEZZA_VITA_GIORNI = 60.0
+    PAROLE_MAX = 6
+    CHIAVE_MAX = 24         # caratteri indicizzati per chiave; prefissi più lunghi si verificano sul valore
+    # Oltre questo numero di chiavi col prefisso si scorrono i valori per punteggio
+    AMPIO = 512
+
+    def __init__(self, righe=()):
+        self._chiavi = []       # chiavi normalizzate in ordine...
+        self._n = array('i')    # ...e valore a cui appartiene ciascuna
+        self._voci = []         # [testo mostrato, valore normalizzato, usi, giorno ordinale dell'ultimo uso]
+        self._per_norm = {}     # valore normalizzato -> n
+        self._classifica = array('i')   # valori per punteggio decrescente...
+        self._punti = array('d')        # ...e i loro punteggi cambiati di segno, per bisect
+        oggi = datetime.now().toordinal()
+        coppie = []
+        for valore, usi, giorno in righe:
+            self._registra(valore, usi, self._giorno(giorno, oggi), coppie)
+        coppie.sort()
+        self._chiavi = [c for c, _n in coppie]
+        self._n = array('i', (n for _c, n in coppie))
+        ordine = sorted(range(len(self._voci)), key=self._punteggio, reverse=True)
+        self._classifica = array('i', ordine)
+        self._punti = array('d', (-self._punteggio(n) for n in ordine))
+
+    def __len__(self):
+        return len(self._voci)
+
+    @staticmethod
+    def _giorno(giorno, oggi):
+        try:
+            return datetime.fromisoformat(giorno[:10]).toordinal()
+        except (TypeError, ValueError):
+            return oggi
+
+    def _chiavi_di(self, norm):
+        yield norm
+        for m in list(_RE_INIZIO_PAROLA.finditer(norm))[:self.PAROLE_MAX]:
+            if m.end() < len(norm):
+                yield norm[m.end():]
+
+    def _punteggio(self, n):
+        """log2 del punteggio, a meno di una costante uguale per tutti i valori"""
+        _testo, _norm, usi, giorno = self._voci[n]
+        return math.log2(max(usi, 1)) + giorno / self.MEZZA_VITA_GIORNI
+
+    def _corrisponde(self, n, p):
+        return any(k.startswith(p) for k in self._chiavi_di(self._voci[n][1]))
+
+    def _registra(self, valore, usi, giorno, coppie=None):
+        """Un uso di un valore; durante la costruzione (coppie) le chiavi si ordinano alla fine"""
+        testo = pulisci_ui(valore)
+        norm = _senza_accenti(testo)
+        if not norm:
+            return
+        ordina = coppie is None
+        n = self._per_norm.get(norm)
+        if n is None:
+            n = self._per_norm[norm] = len(self._voci)
+            self._voci.append([testo, norm, 0, giorno])
+            for chiave in self._chiavi_di(norm):
+                chiave = chiave[:self.CHIAVE_MAX]
+                if ordina:
+                    i = bisect_left(self._chiavi, chiave)
+                    self._chiavi.insert(i, chiave)
+                    self._n.insert(i, n)
+                else:
+                    coppie.append((chiave, n))
+        elif ordina:
+            i = bisect_left(self._punti, -self._punteggio(n))
+            while self._classifica[i] != n:
+                i += 1
+            del self._classifica[i]; del self._punti[i]
+        voce = self._voci[n]
+        voce[2] += usi
+        if giorno >= voce[3]:
+            # Si mostra la grafia usata più di recente
+            voce[0] = testo; voce[3] = giorno
+        if ordina:
+            punti = -self._punteggio(n)
+            i = bisect_left(self._punti, punti)
+            self._classifica.insert(i, n); self._punti.insert(i, punti)
+
+    def aggiungi(self, valore, giorno=None):
+        """Registra un uso del valore (giorno 'AAAA-MM-GG', oggi se omesso)"""
+        oggi = datetime.now().toordinal()
+        self._registra(valore, 1, self._giorno(giorno, oggi) if giorno else oggi)
+
+    def suggerisci(self, prefisso, limite=3):
+        """I `limite` valori più usati di recente che iniziano (o hanno una parola che inizia) con il prefisso"""
+        p = normalizza_ricerca(prefisso)
+        if not p:
+            return []
+        chiavi = self._chiavi
+        pc = p[:self.CHIAVE_MAX]
+        a = bisect_left(chiavi, pc)
+        b = bisect_left(chiavi, pc + "\U0010ffff", a)
+        if b - a <= self.AMPIO:
+            candidati = set(self._n[a:b])
+            if len(p) > self.CHIAVE_MAX:
+                candidati = [n for n in candidati if self._corrisponde(n, p)]
+            trovati = heapq.nlargest(limite + 1, candidati, key=self._punteggio)
+        else:
+            # Prefisso corto: i valori che corrispondono sono tanti, i primi per punteggio arrivano presto
+            trovati = []
+            for n in self._classifica:
+                if self._corrisponde(n, p):
+                    trovati.append(n)
+                    if len(trovati) > limite:
+                        break
+        # Il valore già scritto per intero non è un suggerimento
+        return [self._voci[n][0] for n in trovati if self._voci[n][1] != p][:limite]
+
+
+# =============================================================================
+# ARCHIVIO SQLITE DI FOGLI E CORSE
+# =============================================================================
+
+class ArchivioCorse:
+    """Archivio persistente di fogli di servizio (intestazioni) e corse.
+
+    Database SQLite in modalità WAL, con indici su giorno, numero foglio,
+    targa e fruitore. Una connessione vale per un solo thread: chi lavora
+    in background (es. esportazione) apre un proprio ArchivioCorse(path).
+    Con sola_lettura=True il file non viene toccato: niente WAL, schema né
+    ricostruzione dei totali (archivi raccolti dagli autisti).
+    """
+    # Etichette dell'intestazione -> colonne della tabella fogli
+    COLONNE_FOGLIO = {
+        "Data": "data", "Foglio di servizio N°": "numero", "Targa": "targa",
+        "Nome e Cognome": "nome", "KM iniziali rimessa": "km_ini_rimessa",
+        "KM finali rimessa": "km_fin_rimessa",
+    }
+    # Colonne del foglio di viaggio -> colonne della tabella corse
+    COLONNE_CORSA = {
+        "Fruitore servizio": "fruitore", "Luogo di partenza": "partenza",
+        "Ora di partenza": "ora_partenza", "KM iniziali": "km_ini",
+        "Luogo di destinazione": "destinazione", "Ora di arrivo": "ora_arrivo",
+        "KM finali": "km_fin",
+    }
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS fogli (
+            id INTEGER PRIMARY KEY,
+            giorno TEXT NOT NULL,
+            data TEXT DEFAULT '', numero TEXT DEFAULT '', targa TEXT DEFAULT '',
+            nome TEXT DEFAULT '', km_ini_rimessa TEXT DEFAULT '', km_fin_rimessa TEXT DEFAULT ''
+        );
+        CREATE TABLE IF NOT EXISTS corse (
+            id INTEGER PRIMARY KEY,
+            foglio_id INTEGER NOT NULL REFERENCES fogli(id),
+            pos INTEGER NOT NULL,
+            giorno TEXT NOT NULL,
+            fruitore TEXT DEFAULT '', partenza TEXT DEFAULT '', ora_partenza TEXT DEFAULT '',
+            km_ini TEXT DEFAULT '', destinazione TEXT DEFAULT '', ora_arrivo TEXT DEFAULT '',
+            km_fin TEXT DEFAULT '',
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_fogli_giorno ON fogli(giorno);
+        CREATE INDEX IF NOT EXISTS idx_fogli_numero ON fogli(numero);
+        CREATE INDEX IF NOT EXISTS idx_fogli_targa ON fogli(targa);
+        CREATE INDEX IF NOT EXISTS idx_corse_foglio ON corse(foglio_id, pos);
+        CREATE INDEX IF NOT EXISTS idx_corse_giorno ON corse(giorno);
+        CREATE INDEX IF NOT EXISTS idx_corse_fruitore ON corse(fruitore);
+        CREATE TABLE IF NOT EXISTS statistiche (
+            dimensione TEXT NOT NULL,
+            chiave TEXT NOT NULL,
+            corse INTEGER NOT NULL DEFAULT 0,
+            km INTEGER NOT NULL DEFAULT 0,
+            minuti INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimensione, chiave)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS luoghi (
+            cella INTEGER NOT NULL,
+            indirizzo TEXT NOT NULL,
+            partenze INTEGER NOT NULL DEFAULT 0,
+            arrivi INTEGER NOT NULL DEFAULT 0,
+            lat REAL NOT NULL DEFAULT 0,
+            lon REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (cella, indirizzo)
+        ) WITHOUT ROWID;
+    """
+    # Totali mantenuti a ogni inserimento/modifica/eliminazione di corsa
+    DIMENSIONI = ("totale", "giorno", "mese", "fruitore", "targa")
+
+    def __init__(self, path, sola_lettura=False):
+        self.path = path
+        if sola_lettura:
+            from pathlib import Path
+            self.db = sqlite3.connect(Path(os.path.abspath(path)).as_uri() + "?mode=ro", uri=True)
+            self.db.row_factory = sqlite3.Row
+            return
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self._verifica_statistiche()
+        self._verifica_luoghi()
+
+    def chiudi(self):
+        self.db.close()
+
+    # --- fogli -------------------------------------------------------------
+
+    def nuovo_foglio(self, intest=None, giorno=None):
+        giorno = giorno or datetime.now().strftime("%Y-%m-%d")
+        with self.db:
+            cur = self.db.execute("INSERT INTO fogli (giorno) VALUES (?)", (giorno,))
+        fid = cur.lastrowid
+        if intest:
+            self.salva_intestazione(fid, intest)
+        return fid
+
+    def ultimo_foglio(self):
+        row = self.db.execute("SELECT id FROM fogli ORDER BY giorno DESC, id DESC LIMIT 1").fetchone()
+        return row["id"] if row else None
+
+    def intestazione(self, foglio_id):
+        row = self.db.execute("SELECT * FROM fogli WHERE id = ?", (foglio_id,)).fetchone()
+        if row is None:
+            return {}
+        return {k: row[c] or "" for k, c in self.COLONNE_FOGLIO.items()}
+
+    def salva_intestazione(self, foglio_id, intest):
+        campi = [(c, str(intest.get(k, "") or "")) for k, c in self.COLONNE_FOGLIO.items()]
+        sql = "UPDATE fogli SET " + ", ".join(f"{c} = ?" for c, _v in campi) + " WHERE id = ?"
+        row = self.db.execute("SELECT targa FROM fogli WHERE id = ?", (foglio_id,)).fetchone()
+        with self.db:
+            self.db.execute(sql, [v for _c, v in campi] + [foglio_id])
+            targa = dict(campi)["targa"]
+            if row is not None and (row["targa"] or "") != targa:
+                # Le corse del foglio passano alla nuova targa
+                for c in self.db.execute("SELECT * FROM corse WHERE foglio_id = ?", (foglio_id,)).fetchall():
+                    _chiavi, tot = self._contributo(c["giorno"], "", self._valori_riga(c))
+                    self._somma_statistiche([("targa", (row["targa"] or "").strip())], tot, -1)
+                    self._somma_statistiche([("targa", targa.strip())], tot, +1)
+
+    def foglio_del_giorno(self, giorno=None):
+        """Id del foglio di un giorno di servizio (il più recente), o None"""
+        giorno = giorno or datetime.now().strftime("%Y-%m-%d")
+        row = self.db.execute("SELECT id FROM fogli WHERE giorno = ? ORDER BY id DESC LIMIT 1",
+                              (giorno,)).fetchone()
+        return row["id"] if row else None
+
+    def riepilogo_fogli(self, limite=None, offset=0):
+        """Fogli dal più recente con numero di corse, senza caricare le corse"""
+        sql = ("SELECT f.*, COUNT(c.id) AS n_corse FROM fogli f "
+               "LEFT JOIN corse c ON c.foglio_id = f.id "
+               "GROUP BY f.id ORDER BY f.giorno DESC, f.id DESC")
+        args = []
+        if limite is not None:
+            sql += " LIMIT ? OFFSET ?"; args = [limite, offset]
+        out = []
+        for row in self.db.execute(sql, args):
+            d = {k: row[c] or "" for k, c in self.COLONNE_FOGLIO.items()}
+            d["id"] = row["id"]; d["giorno"] = row["giorno"]; d["n_corse"] = row["n_corse"]
+            out.append(d)
+        return out
+
+    def cerca_fogli(self, giorno=None, numero=None, targa=None, giorno_da=None, giorno_a=None):
+        """Fogli che corrispondono ai filtri, dal più recente: [{'id', 'giorno', ...intestazione}]"""
+        where, args = [], []
+        for cond, val in (("giorno = ?", giorno), ("numero = ?", numero), ("targa = ?", targa),
+                          ("giorno >= ?", giorno_da), ("giorno <= ?", giorno_a)):
+            if val is not None:
+                where.append(cond); args.append(val)
+        sql = "SELECT * FROM fogli"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY giorno DESC, id DESC"
+        out = []
+        for row in self.db.execute(sql, args):
+            d = {k: row[c] or "" for k, c in self.COLONNE_FOGLIO.items()}
+            d["id"] = row["id"]; d["giorno"] = row["giorno"]
+            out.append(d)
+        return out
+
+    # --- corse -------------------------------------------------------------
+
+    def _corsa_da_riga(self, row):
+        c = {k: row[col] or "" for k, col in self.COLONNE_CORSA.items()}
+        if row["extra"]:
+            c.update(json.loads(row["extra"]))
+        c["_id"] = row["id"]
+        return c
+
+    def _valori_corsa(self, corsa):
+        valori = [str(corsa.get(k, "") or "") for k in self.COLONNE_CORSA]
+        extra = {k: v for k, v in corsa.items() if k not in self.COLONNE_CORSA and k != "_id"}
+        return valori, (json.dumps(extra, ensure_ascii=False) if extra else None)
+
+    def corse_foglio(self, foglio_id):
+        """Iteratore sulle corse di un foglio, nell'ordine di inserimento"""
+        cur = self.db.execute("SELECT * FROM corse WHERE foglio_id = ? ORDER BY pos, id", (foglio_id,))
+        for row in cur:
+            yield self._corsa_da_riga(row)
+
+    def corsa(self, corsa_id):
+        row = self.db.execute("SELECT * FROM corse WHERE id = ?", (corsa_id,)).fetchone()
+        return self._corsa_da_riga(row) if row else None
+
+    def cerca_corse(self, fruitore=None, targa=None, giorno_da=None, giorno_a=None):
+        """Iteratore sulle corse filtrate per fruitore, targa del foglio e intervallo di giorni"""
+        where, args = [], []
+        if fruitore is not None:
+            where.append("c.fruitore = ?"); args.append(fruitore)
+        if targa is not None:
+            where.append("f.targa = ?"); args.append(targa)
+        if giorno_da is not None:
+            where.append("c.giorno >= ?"); args.append(giorno_da)
+        if giorno_a is not None:
+            where.append("c.giorno <= ?"); args.append(giorno_a)
+        sql = "SELECT c.* FROM corse c JOIN fogli f ON f.id = c.foglio_id"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY c.giorno, c.foglio_id, c.pos, c.id"
+        for row in self.db.execute(sql, args):
+            yield self._corsa_da_riga(row)
+
+    def corse_esportazione(self, foglio_id=None, giorno_da=None, giorno_a=None):
+        """Iteratore sulle corse di un foglio o di un intervallo di giorni, con giorno e dati del foglio"""
+        where, args = [], []
+        for cond, val in (("c.foglio_id = ?", foglio_id), ("c.giorno >= ?", giorno_da), ("c.giorno <= ?", giorno_a)):
+            if val is not None:
+                where.append(cond); args.append(val)
+        sql = ("SELECT c.*, f.numero AS f_numero, f.targa AS f_targa, f.nome AS f_nome "
+               "FROM corse c JOIN fogli f ON f.id = c.foglio_id")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY c.giorno, c.foglio_id, c.pos, c.id"
+        for row in self.db.execute(sql, args):
+            c = self._corsa_da_riga(row)
+            c["Giorno"] = row["giorno"]
+            c["Foglio di servizio N°"] = row["f_numero"] or ""
+            c["Targa"] = row["f_targa"] or ""
+            c["Nome e Cognome"] = row["f_nome"] or ""
+            yield c
+
+    def aggiungi_corsa(self, foglio_id, corsa, giorno=None):
+        return self.aggiungi_corse(foglio_id, [corsa], giorno)[0]
+
+    def aggiungi_corse(self, foglio_id, corse, giorno=None):
+        """Aggiunge in coda al foglio più corse in una sola transazione; restituisce gli id"""
+        giorno = giorno or datetime.now().strftime("%Y-%m-%d")
+        cols = ", ".join(self.COLONNE_CORSA.values())
+        sql = (f"INSERT INTO corse (foglio_id, pos, giorno, {cols}, extra) "
+               f"VALUES (?, ?, ?, {', '.join('?' * len(self.COLONNE_CORSA))}, ?)")
+        targa = self._targa(foglio_id)
+        ids = []
+        with self.db:
+            pos = self.db.execute("SELECT COALESCE(MAX(pos), -1) FROM corse WHERE foglio_id = ?",
+                                  (foglio_id,)).fetchone()[0]
+            for corsa in corse:
+                pos += 1
+                valori, extra = self._valori_corsa(corsa)
+                cur = self.db.execute(sql, [foglio_id, pos, giorno] + valori + [extra])
+                ids.append(cur.lastrowid)
+                self._somma_statistiche(*self._contributo(giorno, targa, valori), +1)
+                self._somma_luoghi(_luoghi_corsa(corsa), +1)
+        return ids
+
+    def aggiorna_corsa(self, corsa_id, corsa):
+        valori, extra = self._valori_corsa(corsa)
+        sets = ", ".join(f"{c} = ?" for c in self.COLONNE_CORSA.values())
+        prima = self._riga_statistiche(corsa_id)
+        with self.db:
+            self.db.execute(f"UPDATE corse SET {sets}, extra = ? WHERE id = ?",
+                            valori + [extra, corsa_id])
+            if prima is not None:
+                self._somma_statistiche(*self._contributo(prima["giorno"], prima["targa"], self._valori_riga(prima)), -1)
+                self._somma_statistiche(*self._contributo(prima["giorno"], prima["targa"], valori), +1)
+                self._somma_luoghi(_luoghi_corsa(self._corsa_da_riga(prima)), -1)
+            self._somma_luoghi(_luoghi_corsa(corsa), +1)
+
+    def elimina_corsa(self, corsa_id):
+        prima = self._riga_statistiche(corsa_id)
+        with self.db:
+            self.db.execute("DELETE FROM corse WHERE id = ?", (corsa_id,))
+            if prima is not None:
+                self._somma_statistiche(*self._contributo(prima["giorno"], prima["targa"], self._valori_riga(prima)), -1)
+                self._somma_luoghi(_luoghi_corsa(self._corsa_da_riga(prima)), -1)
+
+    # --- statistiche -------------------------------------------------------
+
+    @staticmethod
+    def _minuti(ora):
+        try:
+            h, m = ora.strip().split(":")[:2]
+            return int(h) * 60 + int(m)
+        except (AttributeError, ValueError):
+            return None
+
+    def _valori_riga(self, row):
+        return [row[c] or "" for c in self.COLONNE_CORSA.values()]
+
+    def _targa(self, foglio_id):
+        row = self.db.execute("SELECT targa FROM fogli WHERE id = ?", (foglio_id,)).fetchone()
+        return (row["targa"] or "") if row else ""
+
+    def _riga_statistiche(self, corsa_id):
+        return self.db.execute("SELECT c.*, f.targa AS targa FROM corse c JOIN fogli f ON f.id = c.foglio_id "
+                               "WHERE c.id = ?", (corsa_id,)).fetchone()
+
+    def _contributo(self, giorno, targa, valori):
+        """Chiavi (dimensione, chiave) e totali (corse, km, minuti) di una corsa"""
+        campi = dict(zip(self.COLONNE_CORSA.values(), valori))
+        km = 0
+        try:
+            km = max(0, int(campi["km_fin"]) - int(campi["km_ini"]))
+        except ValueError:
+            pass
+        minuti = 0
+        p, a = self._minuti(campi["ora_partenza"]), self._minuti(campi["ora_arrivo"])
+        if p is not None and a is not None:
+            minuti = (a - p) % 1440     # corse a cavallo della mezzanotte
+        chiavi = [("totale", ""), ("giorno", giorno), ("mese", giorno[:7]),
+                  ("fruitore", campi["fruitore"].strip()), ("targa", (targa or "").strip())]
+        return chiavi, (1, km, minuti)
+
+    def _somma_statistiche(self, chiavi, totali, segno):
+        corse, km, minuti = totali
+        self.db.executemany(
+            "INSERT INTO statistiche (dimensione, chiave, corse, km, minuti) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(dimensione, chiave) DO UPDATE SET corse = corse + excluded.corse, "
+            "km = km + excluded.km, minuti = minuti + excluded.minuti",
+            [(d, k, segno * corse, segno * km, segno * minuti) for d, k in chiavi])
+        if segno < 0:
+            self.db.executemany("DELETE FROM statistiche WHERE dimensione = ? AND chiave = ? AND corse <= 0",
+                                chiavi)
+
+    def ricostruisci_statistiche(self):
+        """Ricalcola da zero tutti i totali (archivi creati prima dell'indice)"""
+        with self.db:
+            self.db.execute("DELETE FROM statistiche")
+            for row in self.db.execute("SELECT c.*, f.targa AS targa FROM corse c "
+                                       "JOIN fogli f ON f.id = c.foglio_id").fetchall():
+                self._somma_statistiche(*self._contributo(row["giorno"], row["targa"], self._valori_riga(row)), +1)
+
+    def _verifica_statistiche(self):
+        if self.db.execute("SELECT 1 FROM statistiche LIMIT 1").fetchone() is None and \
+                self.db.execute("SELECT 1 FROM corse LIMIT 1").fetchone() is not None:
+            self.ricostruisci_statistiche()
+
+    def statistiche(self, dimensione, chiave=None, limite=None):
+        """Totali {'chiave', 'corse', 'km', 'minuti'} di una dimensione (o di una sua chiave), per km"""
+        if chiave is not None:
+            row = self.db.execute("SELECT * FROM statistiche WHERE dimensione = ? AND chiave = ?",
+                                  (dimensione, chiave)).fetchone()
+            return dict(row) if row else {"dimensione": dimensione, "chiave": chiave, "corse": 0, "km": 0, "minuti": 0}
+        sql = "SELECT * FROM statistiche WHERE dimensione = ? ORDER BY km DESC, corse DESC"
+        args = [dimensione]
+        if limite is not None:
+            sql += " LIMIT ?"; args.append(limite)
+        return [dict(r) for r in self.db.execute(sql, args)]
+
+    def valori_frequenti(self, *colonne):
+        """(valore, corse, ultimo giorno) per ogni valore distinto delle colonne indicate della tabella corse"""
+        sql = " UNION ALL ".join(f"SELECT {c}, COUNT(*), MAX(giorno) FROM corse WHERE {c} != '' GROUP BY {c}"
+                                 for c in colonne)
+        return self.db.execute(sql).fetchall()
+
+    # --- luoghi frequenti --------------------------------------------------
+
+    def _somma_luoghi(self, voci, segno):
+        if not voci:
+            return
+        self.db.executemany(
+            "INSERT INTO luoghi (cella, indirizzo, partenze, arrivi, lat, lon) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(cella, indirizzo) DO UPDATE SET partenze = partenze + excluded.partenze, "
+            "arrivi = arrivi + excluded.arrivi, lat = lat + excluded.lat, lon = lon + excluded.lon",
+            [(c, i, segno * p, segno * a, segno * la, segno * lo) for c, i, p, a, la, lo in voci])
+        if segno < 0:
+            self.db.executemany("DELETE FROM luoghi WHERE cella = ? AND indirizzo = ? AND partenze + arrivi <= 0",
+                                [v[:2] for v in voci])
+
+    # Corse con almeno una posizione di salita o discesa registrata
+    _CON_POSIZIONI = "instr(extra, '\"_gps_partenza\"') > 0 OR instr(extra, '\"_gps_arrivo\"') > 0"
+
+    def ricostruisci_luoghi(self):
+        """Raggruppa da zero le posizioni di salita/discesa di tutte le corse"""
+        with self.db:
+            self.db.execute("DELETE FROM luoghi")
+            for row in self.db.execute(f"SELECT * FROM corse WHERE {self._CON_POSIZIONI}").fetchall():
+                self._somma_luoghi(_luoghi_corsa(self._corsa_da_riga(row)), +1)
+
+    def _verifica_luoghi(self):
+        if self.db.execute("SELECT 1 FROM luoghi LIMIT 1").fetchone() is None and \
+                self.db.execute(f"SELECT 1 FROM corse WHERE {self._CON_POSIZIONI} LIMIT 1").fetchone() is not None:
+            self.ricostruisci_luoghi()
+
+    def indice_luoghi(self):
+        """IndiceLuoghi in memoria con tutti i luoghi dell'archivio"""
+        return IndiceLuoghi(self.db.execute("SELECT * FROM luoghi"))
+
+# =============================================================================
+# RIGA DI COMANDO (senza interfaccia): esportazione su più processi, stradario
+# =============================================================================
+#
+#   python main.py esporta raccolta/ [--uscita pdf/] [--processi 4] [--forza]
+#   python main.py gazetteer indirizzi.csv [gazetteer.fdvg] [--lato 0.001]
+#
+# gazetteer compila lo stradario di GeocoderInverso (vedi compila_gazetteer).
+# Cerca nella cartella e nelle sottocartelle gli archivi fdv.db e i backup
+# app_state.json raccolti dagli autisti e scrive un PDF per foglio (autista e
+# giorno). Nella cartella di uscita indice.json elenca i PDF prodotti con la
+# firma dei file da cui vengono: al giro successivo i file non cambiati si saltano.
+
+INDICE_ESPORTAZIONE = "indice.json"
+
+def leggi_journal(path, seq_snapshot=0):
+    """Record del journal successivi allo snapshot, in ordine (usato dall'app e dalla riga di comando)"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                return  # ultima riga troncata da un crash: si ignora
+            if int(rec.get('seq', 0)) > seq_snapshot:
+                yield rec
+
+def applica_record_corse(corse, rec):
+    """Riapplica a `corse` un record add/set/del (journal precedenti all'archivio SQLite).
+
+    Restituisce False per i record che non riguardano le corse (es. 'stato').
+    """
+    op = rec.get('op')
+    if op == 'add':
+        corse.append(rec['corsa'])
+    elif op == 'set':
+        if 0 <= rec['idx'] < len(corse):
+            corse[rec['idx']] = rec['corsa']
+    elif op == 'del':
+        if 0 <= rec['idx'] < len(corse):
+            corse.pop(rec['idx'])
+    else:
+        return False
+    return True
+
+def leggi_backup_json(path):
+    """(corse, giorno) di un app_state.json, con le modifiche del journal accanto.
+
+    Questi backup non contengono l'intestazione del foglio (stava solo in
+    memoria, oggi sta nell'archivio): il PDF esce con l'intestazione vuota.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        stato = json.load(f)
+    corse = list(stato.get('corse') or [])
+    for rec in leggi_journal(os.path.join(os.path.dirname(path), "app_state.journal"),
+                             int(stato.get('seq', 0))):
+        applica_record_corse(corse, rec)
+    giorno = (stato.get('timestamp') or "")[:10]
+    if not giorno:
+        giorno = datetime.fromtimestamp(os.path.getmtime(path)).strftime("%Y-%m-%d")
+    return corse, giorno
+
+def _firma_ingresso(path):
+    """Dimensione e data di modifica del file e dei suoi compagni (WAL dell'archivio, journal)"""
+    if path.endswith(".json"):
+        compagni = [path, os.path.join(os.path.dirname(path), "app_state.journal")]
+    else:
+        compagni = [path, path + "-wal"]
+    firma = []
+    for p in compagni:
+        try:
+            st = os.stat(p)
+        except OSError:
+            continue
+        firma.append([os.path.basename(p), st.st_size, st.st_mtime_ns])
+    return firma
+
+def _autista_da_cartella(path):
+    """Nome della cartella dell'autista (quella che contiene backup/, se il file sta lì)"""
+    cartella = os.path.dirname(os.path.abspath(path))
+    if os.path.basename(cartella) == "backup":
+        cartella = os.path.dirname(cartella)
+    return os.path.basename(cartella)
+
+def _nome_pdf(giorno, autista, numero, usati):
+    base = "_".join(re.sub(r"[^\w-]+", "_", str(p)).strip("_") for p in (giorno, autista, numero) if p)
+    nome, n = base + ".pdf", 1
+    while nome in usati:
+        n += 1
+        nome = f"{base}_{n}.pdf"
+    usati.add(nome)
+    return nome
+
+def _fogli_ingresso(path):
+    """Fogli con almeno una corsa: [(foglio_id o None, giorno, intestazione)]"""
+    if path.endswith(".json"):
+        corse, giorno = leggi_backup_json(path)
+        return [(None, giorno, {})] if corse else []
+    archivio = ArchivioCorse(path, sola_lettura=True)
+    try:
+        return [(f["id"], f["giorno"], archivio.intestazione(f["id"]))
+                for f in reversed(archivio.riepilogo_fogli()) if f["n_corse"]]
+    finally:
+        archivio.chiudi()
+
+def _esporta_foglio(lavoro):
+    """Eseguita in un processo del pool: scrive il PDF di un foglio, restituisce il numero di corse"""
+    path, foglio_id, path_pdf = lavoro
+    tmp = path_pdf + ".part"
+    try:
+        if foglio_id is None:
+            corse, _giorno = leggi_backup_json(path)
+            build_pdf_cartaceo(tmp, {}, corse)
+        else:
+            archivio = ArchivioCorse(path, sola_lettura=True)
+            try:
+                intest = archivio.intestazione(foglio_id)
+                corse = list(archivio.corse_foglio(foglio_id))
+                build_pdf_cartaceo(tmp, intest, corse)
+            finally:
+                archivio.chiudi()
+        os.replace(tmp, path_pdf)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return len(corse)
+
+def _esporta_foglio_sicuro(lavoro):
+    # Un foglio che fallisce non ferma gli altri: l'errore torna come testo
+    try:
+        return _esporta_foglio(lavoro)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+def esporta_cartella(cartella, uscita, processi=None, forza=False):
+    """Scrive in `uscita` i PDF di tutti i fogli trovati in `cartella` e aggiorna l'indice.
+
+    Restituisce (pdf scritti, file saltati perché invariati, errori).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    cartella = os.path.abspath(cartella); uscita = os.path.abspath(uscita)
+    os.makedirs(uscita, exist_ok=True)
+    path_indice = os.path.join(uscita, INDICE_ESPORTAZIONE)
+    indice = {}
+    if not forza and os.path.exists(path_indice):
+        with open(path_indice, 'r', encoding='utf-8') as f:
+            indice = json.load(f).get("ingressi", {})
+
+    ingressi = []
+    for radice, cartelle, file in os.walk(cartella):
+        cartelle[:] = sorted(c for c in cartelle if os.path.join(radice, c) != uscita)
+        ingressi += [os.path.join(radice, n) for n in sorted(file) if n in ("fdv.db", "app_state.json")]
+
+    # I PDF dei file invariati restano; quelli dei file cambiati si rifanno da capo
+    nuovo_indice, da_fare, saltati, errori = {}, [], 0, []
+    usati = set()
+    for path in ingressi:
+        chiave = os.path.relpath(path, cartella)
+        voce = indice.pop(chiave, None)
+        if voce is not None and voce["firma"] == _firma_ingresso(path) and \
+                all(os.path.exists(os.path.join(uscita, p["file"])) for p in voce["pdf"]):
+            nuovo_indice[chiave] = voce
+            usati.update(p["file"] for p in voce["pdf"])
+            saltati += 1
+        else:
+            if voce is not None:
+                indice[chiave] = voce   # i suoi vecchi PDF vengono rimossi sotto
+            da_fare.append((chiave, path))
+    for voce in indice.values():
+        for p in voce["pdf"]:
+            if p["file"] not in usati:
+                try:
+                    os.remove(os.path.join(uscita, p["file"]))
+                except OSError:
+                    pass
+
+    # Letto in sola lettura, un archivio WAL si ritrova -wal (vuoto) e -shm: a fine giro
+    # si tolgono quelli che prima non c'erano
+    compagni_nuovi = [path + est for _c, path in da_fare if path.endswith(".db")
+                      for est in ("-wal", "-shm") if not os.path.exists(path + est)]
+    lavori = []     # (chiave, voce pdf, (path, foglio_id, path_pdf))
+    for chiave, path in da_fare:
+        try:
+            # Firma presa prima della lettura: se il file cambia intanto, il prossimo giro lo rifà
+            firma = _firma_ingresso(path)
+            fogli = _fogli_ingresso(path)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            errori.append(f"{chiave}: {e}")
+            continue
+        nuovo_indice[chiave] = {"firma": firma, "pdf": []}
+        for foglio_id, giorno, intest in fogli:
+            autista = intest.get("Nome e Cognome") or _autista_da_cartella(path)
+            numero = intest.get("Foglio di servizio N°") or foglio_id
+            nome = _nome_pdf(giorno, autista, numero, usati)
+            voce = {"file": nome, "giorno": giorno, "autista": autista,
+                    "targa": intest.get("Targa", ""), "numero": intest.get("Foglio di servizio N°", "")}
+            lavori.append((chiave, voce, (path, foglio_id, os.path.join(uscita, nome))))
+
+    scritti = 0
+    if lavori:
+        with ProcessPoolExecutor(max_workers=processi) as pool:
+            esiti = pool.map(_esporta_foglio_sicuro, [lavoro for _c, _v, lavoro in lavori])
+            for (chiave, voce, _lavoro), esito in zip(lavori, esiti):
+                if isinstance(esito, str):
+                    errori.append(f"{chiave} → {voce['file']}: {esito}")
+                    # Senza firma il file viene ritentato al prossimo giro
+                    nuovo_indice[chiave]["firma"] = None
+                    continue
+                voce["corse"] = esito
+                nuovo_indice[chiave]["pdf"].append(voce)
+                scritti += 1
+    for compagno in compagni_nuovi:
+        try:
+            if os.path.getsize(compagno) == 0 or compagno.endswith("-shm"):
+                os.remove(compagno)
+        except OSError:
+            pass
+
+    tmp = path_indice + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({"generato": datetime.now().isoformat(timespec="seconds"), "ingressi": nuovo_indice},
+                  f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path_indice)
+    return scritti, saltati, errori
+
+def main_esporta(argv=None):
+    import argparse
+    ap = argparse.ArgumentParser(prog="main.py esporta",
+                                 description="PDF dei fogli di viaggio da archivi e backup raccolti, senza interfaccia")
+    ap.add_argument("cartella", help="cartella con i file fdv.db / app_state.json (anche in sottocartelle)")
+    ap.add_argument("--uscita", help="cartella dei PDF e di indice.json (default: <cartella>/pdf)")
+    ap.add_argument("--processi", type=int, help="processi in parallelo (default: uno per CPU)")
+    ap.add_argument("--forza", action="store_true", help="rigenera anche i PDF dei file invariati")
+    args = ap.parse_args(argv)
+    if not os.path.isdir(args.cartella):
+        ap.error(f"cartella inesistente: {args.cartella}")
+
+    t0 = time.perf_counter()
+    scritti, saltati, errori = esporta_cartella(args.cartella, args.uscita or os.path.join(args.cartella, "pdf"),
+                                                args.processi, args.forza)
+    for e in errori:
+        print(f"❌ {e}")
+    print(f"✅ {scritti} PDF scritti, {saltati} file invariati saltati, "
+          f"{len(errori)} errori in {time.perf_counter() - t0:.1f} s")
+    return 1 if errori else 0
+
+def main_gazetteer(argv=None):
+    import argparse
+    ap = argparse.ArgumentParser(prog="main.py gazetteer",
+                                 description="Compila lo stradario offline da un CSV di indirizzi",
+                                 epilog="Per usarlo, copiare il file come gazetteer.fdvg nella cartella dati "
+                                        "dell'app (accanto a fdv.db; su Android la cartella files dell'app).")
+    ap.add_argument("csv", help="CSV con lat/lon e indirizzo (o via, civico, città)")
+    ap.add_argument("uscita", nargs="?", default="gazetteer.fdvg", help="file .fdvg (default: gazetteer.fdvg)")
+    ap.add_argument("--lato", type=float, default=0.001, help="lato delle celle della griglia in gradi")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    try:
+        punti = compila_gazetteer(args.csv, args.uscita, args.lato)
+    except (OSError, ValueError) as e:
+        print(f"❌ {e}")
+        return 1
+    print(f"{'✅' if punti else '⚠️'} {punti} indirizzi in {args.uscita} ({os.path.getsize(args.uscita) // 1024} KB) "
+          f"in {time.perf_counter() - t0:.1f} s")
+    return 0 if punti else 1
+
+# Sottocomandi di python main.py <comando> ...
+_COMANDI = {"esporta": main_esporta, "gazetteer": main_gazetteer}
+
+# =============================================================================
+# STATO OSSERVABILE DELL'INTERFACCIA (aggiornamenti raggruppati per frame)
+# =============================================================================
+
+class StatoUI:
+    """Valori mostrati dai widget, applicati al più una volta per frame.
+
+    imposta() si può chiamare da qualsiasi thread (es. un lavoro in
+    background): conserva solo l'ultimo valore per chiave e
+    chiede un frame al Clock. Gli osservatori girano sul thread principale;
+    una chiave con `intervallo` non viene applicata più spesso di così.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pendenti = {}      # chiave -> ultimo valore non ancora applicato
+        self._osservatori = {}   # chiave -> [callback(valore)]
+        self._intervalli = {}    # chiave -> secondi minimi tra due applicazioni
+        self._applicato_ts = {}
+        self._rinvio_ev = None
+        self._richiesto = False  # frame già chiesto al Clock
+        self._trigger = Clock.create_trigger(self._applica, 0)
+
+    def osserva(self, chiave, callback, intervallo=0.0):
+        self._osservatori.setdefault(chiave, []).append(callback)
+        if intervallo:
+            self._intervalli[chiave] = intervallo
+
+    def imposta(self, chiave, valore):
+        with self._lock:
+            self._pendenti[chiave] = valore
+            richiedi = not self._richiesto
+            self._richiesto = True
+        if richiedi:
+            self._trigger()
+
+    def valore(self, chiave, predefinito=None):
+        """Valore in attesa di essere applicato, altrimenti `predefinito`"""
+        with self._lock:
+            return self._pendenti.get(chiave, predefinito)
+
+    def applica(self):
+        """Applica subito tutti i valori in attesa (thread principale)"""
+        self._applica(forza=True)
+
+    def _applica(self, *_dt, forza=False):
+        with self._lock:
+            pendenti, self._pendenti = self._pendenti, {}
+            self._richiesto = False
+        ora = time.perf_counter()
+        rinvio = None
+        for chiave, valore in pendenti.items():
+            intervallo = self._intervalli.get(chiave, 0.0)
+            trascorso = ora - self._applicato_ts.get(chiave, float("-inf"))
+            if not forza and trascorso < intervallo:
+                with self._lock:
+                    # Un valore arrivato nel frattempo è più recente
+                    self._pendenti.setdefault(chiave, valore)
+                attesa = intervallo - trascorso
+                rinvio = attesa if rinvio is None else min(rinvio, attesa)
+                continue
+            self._applicato_ts[chiave] = ora
+            for cb in self._osservatori.get(chiave, ()):
+                cb(valore)
+        if rinvio is not None and (self._rinvio_ev is None or not self._rinvio_ev.is_triggered):
+            self._rinvio_ev = Clock.schedule_once(self._applica, rinvio)
+
+
+class RigaCorsa(RecycleDataViewBehavior, BoxLayout):
+    """Riga riutilizzabile dell'elenco corse: la RecycleView crea solo quelle visibili"""
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.size_hint_y = None
+        self.height = dp(44)
+        self.spacing = dp(6)
+        self.index = 0
+        self.rv = None
+        self.lbl = Label(shorten=True, shorten_from='right', size_hint_x=1)
+        self.lbl.bind(size=lambda inst, _v: setattr(inst, "text_size", inst.size))
+        self.chip = Button(size_hint=(None, 1), width=dp(78),
+                           background_normal="", background_color=(0.45,0.45,0.52,1),
+                           color=(1,1,1,1), disabled=True)
+        b1 = Button(text="Apri", size_hint=(None,1), width=dp(80),
+                    background_normal="", background_color=(0.55,0.55,0.60,1))
+        b2 = Button(text="Elimina", size_hint=(None,1), width=dp(90),
+                    background_normal="", background_color=(0.85,0.30,0.30,1))
+        b1.bind(on_release=lambda _w: self.rv.schermo._carica(self.index))
+        b2.bind(on_release=lambda _w: self.rv.schermo._del(self.index))
+        self.add_widget(self.lbl); self.add_widget(self.chip)
+        self.add_widget(b1); self.add_widget(b2)
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.index = index
+        self.rv = rv
+        self.lbl.text = f"{index+1}. {data['desc']}"
+        self.chip.text = data['chip'] or "-"
+        self.chip.background_color = (0.90,0.60,0.15,1) if data.get('attesa') else (0.45,0.45,0.52,1)
+
+
+class RigaFoglio(RecycleDataViewBehavior, BoxLayout):
+    """Riga dello storico: un foglio di servizio per giorno"""
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.size_hint_y = None
+        self.height = dp(44)
+        self.spacing = dp(6)
+        self.foglio_id = None
+        self.rv = None
+        self.lbl = Label(shorten=True, shorten_from='right', size_hint_x=1)
+        self.lbl.bind(size=lambda inst, _v: setattr(inst, "text_size", inst.size))
+        b1 = Button(text="Corse", size_hint=(None,1), width=dp(80),
+                    background_normal="", background_color=(0.55,0.55,0.60,1))
+        b2 = Button(text="PDF", size_hint=(None,1), width=dp(70),
+                    background_normal="", background_color=(0.20,0.55,0.90,1))
+        b3 = Button(text="GPX", size_hint=(None,1), width=dp(60),
+                    background_normal="", background_color=(0.20,0.60,0.35,1))
+        b1.bind(on_release=lambda _w: self.rv.schermo._storico_corse(self.foglio_id))
+        b2.bind(on_release=lambda _w: self.rv.schermo.esporta_pdf(foglio_id=self.foglio_id))
+        b3.bind(on_release=lambda _w: self.rv.schermo.esporta_gpx(foglio_id=self.foglio_id))
+        self.add_widget(self.lbl); self.add_widget(b1); self.add_widget(b2); self.add_widget(b3)
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.rv = rv
+        self.foglio_id = data['foglio_id']
+        self.lbl.text = data['desc']
+
+
+class RigaStorico(RecycleDataViewBehavior, BoxLayout):
+    """Riga in sola lettura delle corse di un foglio, con esportazione GPX della traccia"""
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.size_hint_y = None
+        self.height = dp(36)
+        self.spacing = dp(6)
+        self.corsa_id = None
+        self.rv = None
+        self.lbl = Label(shorten=True, shorten_from='right', size_hint_x=1)
+        self.lbl.bind(size=lambda inst, _v: setattr(inst, "text_size", inst.size))
+        self.b_gpx = Button(text="GPX", size_hint=(None,1), width=dp(60),
+                            background_normal="", background_color=(0.20,0.60,0.35,1))
+        self.b_gpx.bind(on_release=lambda _w: self.rv.schermo.esporta_gpx(corsa_id=self.corsa_id))
+        self.add_widget(self.lbl); self.add_widget(self.b_gpx)
+
+    def refresh_view_attrs(self, rv, index, data):
+        self.rv = rv
+        self.corsa_id = data['corsa_id']
+        self.lbl.text = data['text']
+        self.b_gpx.disabled = not data['traccia']
+
+
+def _delega_rilevatore(nome):
+    """Attributo di CorseScreen tenuto dal RilevatoreCorse (nomi storici, usati anche dallo stato salvato)"""
+    return property(lambda self: getattr(self.rilevatore, nome),
+                    lambda self, valore: setattr(self.rilevatore, nome, valore))
+
 class CorseScreen(Screen):
     COLONNE = [
         "Fruitore servizio","Luogo di partenza","Ora di partenza","KM iniziali",
         "Luogo di destinazione","Ora di arrivo","KM finali"
     ]
+    # Polling appunti di riserva: intervallo raddoppiato finché nulla cambia
+    CLIP_POLL_MIN_S = 1.5
+    CLIP_POLL_MAX_S = 12.0
+    CLIP_GESTITI_MAX = 8        # hash di testi già proposti ricordati
+    # Numero di record nel journal oltre il quale si riscrive lo snapshot
+    JOURNAL_MAX_RECORDS = 500
+    # Le richieste di salvataggio entro questa finestra diventano una sola scrittura
+    PERSIST_FINESTRA_S = 0.5
+    # Profili di campionamento GPS: (minTime ms, minDistance m)
+    GPS_PROFILI = {
+        'fermo': (5000, 10),      # auto ferma, nessuna decisione in sospeso
+        'marcia': (2000, 5),      # in movimento a velocità urbana
+        'veloce': (1000, 10),     # oltre SPEED_FAST_KMH
+        'decisione': (1000, 0),   # in sosta con salita/discesa da confermare
+    }
+    # Aggiornamenti al secondo, al più, dell'etichetta km durante la marcia
+    KM_LABEL_HZ = 2.0
+    # Campi con completamento dai valori già usati -> indice condiviso
+    CAMPI_COMPLETAMENTO = {"Fruitore servizio": "fruitore",
+                           "Luogo di partenza": "indirizzo", "Luogo di destinazione": "indirizzo"}
+
+    # Stato e soglie di salita/discesa: vivono in self.rilevatore
+    gps_km_raw = _delega_rilevatore("km")
+    _pickup_set = _delega_rilevatore("salita")
+    _drop_set = _delega_rilevatore("discesa")
+    _first_fix = _delega_rilevatore("primo")
+    _still_since = _delega_rilevatore("fermo_da")
+    _km_at_pickup = _delega_rilevatore("km_salita")
+    _luogo_noto = _delega_rilevatore("luogo_noto")
+    _luoghi = _delega_rilevatore("luoghi")
+    SPEED_STILL_KMH = _delega_rilevatore("fermo_kmh")
+    DWELL_S = _delega_rilevatore("sosta_s")
+    DWELL_LUOGO_NOTO_S = _delega_rilevatore("sosta_luogo_noto_s")
+    START_RADIUS_M = _delega_rilevatore("raggio_partenza_m")
+    RAGGIO_LUOGO_M = _delega_rilevatore("raggio_luogo_m")
+    MIN_TRAVEL_KM_FOR_DROP = _delega_rilevatore("min_km_discesa")
 
     def __init__(self, **kw):
         super().__init__(**kw)
@@ -145,21 +2395,44 @@ class CorseScreen(Screen):
         self.corsa_corrente = None
         self.campi = {}
         self.inputs = []
+        self.ui = StatoUI()
+        self._km_pubblicati = None
         self.gps_on = False
-        self.track = []
-        self.gps_km_raw = 0.0
-        self._pickup_set = False
-        self._drop_set = False
-        self._first_fix = None
-        self._still_since = None
-        self._km_at_pickup = None
-        self.SPEED_STILL_KMH = 15.0
-        self.DWELL_S = 10.0
-        self.START_RADIUS_M = 50.0
-        self.MIN_TRAVEL_KM_FOR_DROP = 0.5
+        self.track = TracciaGPS(self._nuovo_file_traccia)
+        # Fix consegnati dal thread del provider GPS, elaborati sul thread principale
+        # (append/popleft di deque sono atomici: niente lock per fix)
+        self._fix_coda = deque()
+        self._thread_principale = threading.get_ident()
+        self._trigger_fix = Clock.create_trigger(self._elabora_coda_fix, 0)
+        self.rilevatore = RilevatoreCorse(IndiceLuoghi())   # salite/discese; luoghi caricati con il foglio
+        self._pt_salita = None          # posizioni GPS di salita e discesa della corsa corrente
+        self._pt_discesa = None
+        self.SPEED_FAST_KMH = 50.0
+        self.GPS_CAMBIO_MIN_S = 20.0    # intervallo minimo prima di rallentare il campionamento
+        self._gps_profilo = None
+        self._gps_profilo_ts = 0.0
+        self._gps_fix_ricevuti = 0      # fix arrivati nella corsa corrente
+        self._gps_fix_elaborati = 0     # fix accettati (precisione sufficiente)
+        self._gps_riavvii = 0           # cambi di profilo nella corsa corrente
         self._clip_ev = None
-        self._last_clip = ""
-        self._last_clip_used = ""
+        self._export_thread = None      # worker dell'esportazione PDF in corso
+        self._export_annulla = None     # threading.Event per annullarla
+        self._elenco_rv = None          # RecycleView dell'elenco, creata alla prima apertura
+        self._elenco_cache = {}         # testi già puliti per le righe dell'elenco
+        self._archivio = None           # ArchivioCorse (SQLite), aperto al primo uso
+        self._stradario = None          # GeocoderInverso su gazetteer.fdvg (False se assente)
+        self._completamenti = None      # "fruitore"/"indirizzo" -> IndicePrefissi, costruiti al primo uso
+        self._completamenti_thread = None   # costruzione in corso
+        self._completamenti_in_attesa = []  # valori salvati mentre gli indici si costruiscono
+        self._righe_suggerimenti = {}   # campo -> riga di pulsanti con i completamenti
+        self.foglio_id = None           # foglio di servizio corrente
+        self._foglio_stato = None       # foglio a cui si riferisce lo stato ripristinato
+        self._clip_hash = None          # hash dell'ultimo contenuto letto dagli appunti
+        self._clip_gestiti = deque(maxlen=self.CLIP_GESTITI_MAX)   # hash degli ultimi testi proposti
+        self._clip_attivo = False
+        self._clip_listener = None      # listener Android sul cambio appunti
+        self._clip_listener_tentato = False
+        self._clip_intervallo = self.CLIP_POLL_MIN_S
         
         # MODIFICA: KM ora sono interi
         self._anchor_value = 0          # ultimo valore confermato (manuale o auto) - INTERO
@@ -169,14 +2442,21 @@ class CorseScreen(Screen):
         # NUOVO: Sistema backup
         self._backup_ev = None
         self._gps_button_anim = None
+        self._journal_seq = 0           # progressivo dell'ultimo record scritto
+        self._journal_count = 0         # record nel journal dall'ultima compattazione
+        self._stato_persistito = {}     # ultimo stato scritto, per salvare solo le differenze
+        self._persist_dirty = False     # stato modificato, salvataggio da fare
+        self._persist_ev = None         # flush programmato a fine finestra
+        self._persist_coda = None       # coda del thread di scrittura su disco
         
         # UI Setup
         self._setup_ui()
         
-        # NUOVO: Carica backup all'avvio
-        Clock.schedule_once(lambda dt: self._carica_backup(), 0.5)
+        # Ripristino backup, timer e watcher partono dopo il primo frame (avvio_differito)
 
     def _setup_ui(self):
+        # Import qui: kivy.uix.textinput crea la finestra già all'import del modulo
+        from kivy.uix.textinput import TextInput
         root = BoxLayout(orientation='vertical')
         
         # Form principale
@@ -211,6 +2491,13 @@ class CorseScreen(Screen):
             self.inputs.append(ti)
             form.add_widget(ti)
 
+            if campo in self.CAMPI_COMPLETAMENTO:
+                riga = BoxLayout(size_hint_y=None, height=0, spacing=dp(4))
+                self._righe_suggerimenti[campo] = riga
+                form.add_widget(riga)
+                aggiorna = Clock.create_trigger(lambda _dt, c=campo: self._mostra_suggerimenti(c), 0.15)
+                ti.bind(text=lambda *_a, t=aggiorna: t(), focus=lambda *_a, t=aggiorna: t())
+
         # Configurazione navigazione tra campi
         for i, ti in enumerate(self.inputs):
             if i < len(self.inputs) - 1:
@@ -238,7 +2525,7 @@ class CorseScreen(Screen):
         bar.add_widget(mkbtn("Intest", self.apri_intestazione_popup))
         bar.add_widget(mkbtn("Nuova", self.nuova_corsa, (0.95,0.60,0.20,1)))
         bar.add_widget(mkbtn("Inizia", self.inizia_corsa, (0.20,0.55,0.20,1)))
-        bar.add_widget(mkbtn("Esporta", self.esporta_pdf, (0.20,0.55,0.90,1)))
+        bar.add_widget(mkbtn("Esporta", self.popup_esporta, (0.20,0.55,0.90,1)))
         bar.add_widget(mkbtn("Elenco", self.popup_elenco))
         bar.add_widget(mkbtn("Completa", self.completa_corsa, (0.85,0.30,0.30,1)))
         bar.add_widget(mkbtn("Salva", self.salva_corsa, (0.30,0.70,0.30,1)))
@@ -248,6 +2535,8 @@ class CorseScreen(Screen):
         bar.add_widget(self.gps_btn)
         
         bar.add_widget(mkbtn("Importa\nUber", self.importa_da_uber, (0.50,0.40,0.80,1)))
+        bar.add_widget(mkbtn("Storico", self.popup_storico))
+        bar.add_widget(mkbtn("Statistiche", self.popup_statistiche))
         
         root.add_widget(bar)
 
@@ -257,11 +2546,24 @@ class CorseScreen(Screen):
         root.add_widget(Widget(size_hint_y=None, height=dp(0)))
         
         self.add_widget(root)
-        
+
+        # Widget aggiornati dal GPS: solo tramite self.ui, una volta per frame
+        self.ui.osserva("km", self._mostra_km, intervallo=1.0 / self.KM_LABEL_HZ)
+        for nome, ti in self.campi.items():
+            self.ui.osserva("campo:" + nome, lambda v, ti=ti: self._mostra_testo(ti, v))
+        for nome in COLONNE_INDIRIZZO:
+            self.ui.osserva("suggerimento:" + nome, lambda v, ti=self.campi[nome]: setattr(ti, "hint_text", v or ""))
+
+    def avvio_differito(self):
+        """Lavoro di avvio non necessario al primo frame"""
+        t0 = time.perf_counter()
+        self._carica_backup()
+        _TEMPI_AVVIO["ripristino_backup_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
         # Avvia watcher clipboard su Android
         if platform == "android":
             self._start_clipboard_watcher()
-            
+
         # NUOVO: Avvia sistema backup
         self._start_backup_system()
 
@@ -276,76 +2578,321 @@ class CorseScreen(Screen):
         os.makedirs(backup_dir, exist_ok=True)
         return os.path.join(backup_dir, "app_state.json")
     
+    def _get_journal_path(self):
+        """Restituisce il percorso del journal delle modifiche (append-only)"""
+        return os.path.join(os.path.dirname(self._get_backup_path()), "app_state.journal")
+
+    def _stato_scalare(self):
+        """Stato corrente esclusa la lista corse (salvata a parte, record per record)"""
+        return {
+            'foglio_id': self.foglio_id,
+            'corsa_corrente': self.corsa_corrente,
+            'campi_correnti': {k: v.text for k, v in self.campi.items()},
+            'gps_on': self.gps_on,
+            'gps_km_raw': self.gps_km_raw,
+            '_anchor_value': self._anchor_value,
+            '_gps_total': self._gps_total,
+            '_gps_total_anchor': self._gps_total_anchor,
+            '_pickup_set': self._pickup_set,
+            '_drop_set': self._drop_set,
+            '_gps_fix_ricevuti': self._gps_fix_ricevuti,
+            '_gps_fix_elaborati': self._gps_fix_elaborati,
+            '_gps_riavvii': self._gps_riavvii,
+        }
+
+    # --- scrittura su disco in background ---------------------------------
+
+    def _persist_job(self, job):
+        """Accoda una scrittura al thread dedicato (avviato al primo uso)"""
+        if self._persist_coda is None:
+            self._persist_coda = queue.Queue()
+            threading.Thread(target=self._persist_worker, name="fdv-persist", daemon=True).start()
+        self._persist_coda.put(job)
+
+    def _persist_worker(self):
+        # Un solo thread: le scritture avvengono nell'ordine in cui sono accodate
+        while True:
+            job = self._persist_coda.get()
+            try:
+                job()
+            except Exception as e:
+                print(f"❌ Errore salvataggio backup: {e}")
+            finally:
+                self._persist_coda.task_done()
+
+    @staticmethod
+    def _fsync_dir(path):
+        try:
+            fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _scrivi_journal(path, line):
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    @classmethod
+    def _scrivi_snapshot(cls, path, journal_path, stato):
+        """Scrittura atomica: file temporaneo, fsync, rename; poi svuota il journal"""
+        tmp = path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(stato, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        cls._fsync_dir(path)
+        # Lo snapshot contiene già tutto: il journal riparte vuoto
+        open(journal_path, 'w').close()
+
+    # --- richieste di salvataggio -------------------------------------------
+
+    def _journal_append(self, rec):
+        """Accoda un record al journal; il costo dipende solo dalla modifica"""
+        self._journal_seq += 1
+        rec['seq'] = self._journal_seq
+        rec['ts'] = datetime.now().isoformat()
+        line = json.dumps(rec, ensure_ascii=False, separators=(',', ':'))
+        path = self._get_journal_path()
+        self._persist_job(lambda: self._scrivi_journal(path, line))
+        self._journal_count += 1
+        if self._journal_count >= self.JOURNAL_MAX_RECORDS:
+            self._compatta_backup()
+
     def _salva_backup(self):
-        """Salva lo stato corrente dell'app"""
+        """Segna lo stato come modificato: le richieste vicine si uniscono in una scrittura"""
+        self._persist_dirty = True
+        if self._persist_ev is None:
+            self._persist_ev = Clock.schedule_once(lambda dt: self._flush_backup(),
+                                                   self.PERSIST_FINESTRA_S)
+
+    def _flush_backup(self, attendi=False):
+        """Registra nel journal solo lo stato cambiato dall'ultimo salvataggio.
+
+        Con attendi=True blocca finché tutte le scritture accodate sono su disco.
+        """
+        if self._persist_ev is not None:
+            self._persist_ev.cancel()
+            self._persist_ev = None
+        if self._persist_dirty:
+            self._persist_dirty = False
+            self.ui.applica()
+            try:
+                # Lo stato si legge qui, sul thread principale; il thread scrive solo
+                stato = self._stato_scalare()
+                prev = self._stato_persistito
+                delta = {}
+                for k, v in stato.items():
+                    if k == 'campi_correnti':
+                        prev_campi = prev.get(k, {})
+                        campi = {c: t for c, t in v.items() if prev_campi.get(c) != t}
+                        if campi: delta[k] = campi
+                    elif k not in prev or prev[k] != v:
+                        delta[k] = v
+                if delta:
+                    self._journal_append({'op': 'stato', **delta})
+                    self._stato_persistito = stato
+                    print("✅ Backup salvato automaticamente")
+
+            except Exception as e:
+                print(f"❌ Errore salvataggio backup: {e}")
+        if attendi and self._persist_coda is not None:
+            self._persist_coda.join()
+
+    def _compatta_backup(self):
+        """Accoda uno snapshot completo dello stato e lo svuotamento del journal"""
         try:
             stato = {
-                'corse': self.corse,
-                'corsa_corrente': self.corsa_corrente,
-                'campi_correnti': {k: v.text for k, v in self.campi.items()},
-                'gps_on': self.gps_on,
-                'gps_km_raw': self.gps_km_raw,
-                '_anchor_value': self._anchor_value,
-                '_gps_total': self._gps_total,
-                '_gps_total_anchor': self._gps_total_anchor,
-                '_pickup_set': self._pickup_set,
-                '_drop_set': self._drop_set,
+                **self._stato_scalare(),
+                'seq': self._journal_seq,
                 'timestamp': datetime.now().isoformat()
             }
-            
-            with open(self._get_backup_path(), 'w', encoding='utf-8') as f:
-                json.dump(stato, f, ensure_ascii=False, indent=2)
-                
-            print("✅ Backup salvato automaticamente")
-            
+            path = self._get_backup_path()
+            journal_path = self._get_journal_path()
+            self._persist_job(lambda: self._scrivi_snapshot(path, journal_path, stato))
+            self._journal_count = 0
+            self._stato_persistito = self._stato_scalare()
+
         except Exception as e:
-            print(f"❌ Errore salvataggio backup: {e}")
-    
+            print(f"❌ Errore compattazione backup: {e}")
+
+    def _applica_stato(self, stato):
+        """Applica allo schermo le chiavi presenti in uno snapshot o record 'stato'"""
+        if 'corsa_corrente' in stato:
+            self.corsa_corrente = stato['corsa_corrente']
+        if 'foglio_id' in stato:
+            self._foglio_stato = stato['foglio_id']
+        for campo, valore in (stato.get('campi_correnti') or {}).items():
+            if campo in self.campi:
+                self.campi[campo].text = valore
+        for k in ('gps_on', 'gps_km_raw', '_anchor_value', '_gps_total',
+                  '_gps_total_anchor', '_pickup_set', '_drop_set',
+                  '_gps_fix_ricevuti', '_gps_fix_elaborati', '_gps_riavvii'):
+            if k in stato:
+                setattr(self, k, stato[k])
+
+    def _applica_record(self, rec):
+        """Riapplica un record del journal (add/set/del: journal precedenti all'archivio SQLite)"""
+        if not applica_record_corse(self.corse, rec) and rec.get('op') == 'stato':
+            self._applica_stato(rec)
+
+    def _get_archivio(self):
+        """Archivio SQLite di fogli e corse, aperto al primo uso"""
+        if self._archivio is None:
+            app = App.get_running_app()
+            os.makedirs(app.user_data_dir, exist_ok=True)
+            self._archivio = ArchivioCorse(os.path.join(app.user_data_dir, "fdv.db"))
+        return self._archivio
+
+    def _get_stradario(self):
+        """Geocoder offline su user_data_dir/gazetteer.fdvg, o None se lo stradario non c'è"""
+        if self._stradario is None:
+            path = os.path.join(App.get_running_app().user_data_dir, "gazetteer.fdvg")
+            try:
+                self._stradario = GeocoderInverso(path)
+            except (OSError, ValueError):
+                self._stradario = False
+        return self._stradario or None
+
+    def _luogo_gps(self, nome, pt):
+        """Compila un luogo vuoto: luogo frequente in cui si è fermi, altrimenti l'indirizzo più vicino"""
+        if self._campo(nome).strip():
+            return
+        if self._luogo_noto is not None:
+            self._imposta_campo(nome, self._luogo_noto[0])
+            return
+        stradario = self._get_stradario()
+        if stradario is not None:
+            indirizzo = stradario.cerca(*pt)
+            if indirizzo:
+                self._imposta_campo(nome, indirizzo)
+
+    def _apri_foglio_corrente(self):
+        """Carica solo il foglio del giorno di servizio corrente; gli altri restano su disco"""
+        archivio = self._get_archivio()
+        app = App.get_running_app()
+        self.foglio_id = archivio.foglio_del_giorno()
+        if self.foglio_id is None:
+            # Nuovo giorno: targa e conducente restano quelli dell'ultimo foglio
+            precedente = archivio.ultimo_foglio()
+            intest = dict(getattr(app, "intestazione", {}) or {})
+            if precedente is not None:
+                prec = archivio.intestazione(precedente)
+                for k in ("Targa", "Nome e Cognome"):
+                    intest.setdefault(k, prec.get(k, ""))
+            self.foglio_id = archivio.nuovo_foglio(intest)
+        app.intestazione = archivio.intestazione(self.foglio_id)
+        self.corse = list(archivio.corse_foglio(self.foglio_id))
+        self._luoghi = archivio.indice_luoghi()
+        self._completamenti = None
+        self._elenco_rv = None
+        self._elenco_cache = {}
+
+    def _carica_completamenti(self):
+        """Costruisce gli indici di completamento in un thread, con una propria connessione all'archivio"""
+        path = self._get_archivio().path
+
+        def lavoro():
+            try:
+                archivio = ArchivioCorse(path)
+                try:
+                    indici = {"fruitore": IndicePrefissi(archivio.valori_frequenti("fruitore")),
+                              "indirizzo": IndicePrefissi(archivio.valori_frequenti("partenza", "destinazione"))}
+                finally:
+                    archivio.chiudi()
+            except sqlite3.Error as e:
+                print(f"⚠️ Completamenti non disponibili: {e}")
+                Clock.schedule_once(lambda _dt: setattr(self, "_completamenti_thread", None), 0)
+                return
+            Clock.schedule_once(lambda _dt: self._completamenti_pronti(indici), 0)
+
+        self._completamenti_in_attesa = []
+        self._completamenti_thread = threading.Thread(target=lavoro, daemon=True)
+        self._completamenti_thread.start()
+
+    def _completamenti_pronti(self, indici):
+        for tipo, valore in self._completamenti_in_attesa:
+            indici[tipo].aggiungi(valore)
+        self._completamenti_in_attesa = []
+        self._completamenti = indici
+        self._completamenti_thread = None
+        for campo in self._righe_suggerimenti:
+            if self.campi[campo].focus:
+                self._mostra_suggerimenti(campo)
+
     def _carica_backup(self):
-        """Carica lo stato salvato dell'app"""
+        """Apre il foglio corrente, carica lo snapshot e riapplica la coda del journal"""
         try:
+            self._apri_foglio_corrente()
+            corse_archivio = self.corse
+            # La traccia in memoria non sopravvive al riavvio: i suoi file sono orfani
+            self._pulisci_tracce_orfane()
+
             backup_path = self._get_backup_path()
-            if not os.path.exists(backup_path):
+            journal_path = self._get_journal_path()
+            if not os.path.exists(backup_path) and not os.path.exists(journal_path):
                 print("ℹ️ Nessun backup trovato")
                 return
-                
-            with open(backup_path, 'r', encoding='utf-8') as f:
-                stato = json.load(f)
-            
-            # Ripristina dati
-            self.corse = stato.get('corse', [])
-            self.corsa_corrente = stato.get('corsa_corrente')
-            
-            # Ripristina campi correnti
-            campi_correnti = stato.get('campi_correnti', {})
-            for campo, valore in campi_correnti.items():
-                if campo in self.campi:
-                    self.campi[campo].text = valore
-            
-            # Ripristina stato GPS
-            self.gps_on = stato.get('gps_on', False)
-            self.gps_km_raw = stato.get('gps_km_raw', 0.0)
-            self._anchor_value = stato.get('_anchor_value', 0)
-            self._gps_total = stato.get('_gps_total', 0.0)
-            self._gps_total_anchor = stato.get('_gps_total_anchor', 0.0)
-            self._pickup_set = stato.get('_pickup_set', False)
-            self._drop_set = stato.get('_drop_set', False)
-            
+
+            # Backup precedenti all'archivio SQLite: le corse stavano nel JSON
+            self.corse = []
+            seq_snapshot = 0
+            if os.path.exists(backup_path):
+                with open(backup_path, 'r', encoding='utf-8') as f:
+                    stato = json.load(f)
+                # Ripristina dati
+                self.corse = stato.get('corse', [])
+                self._applica_stato({
+                    'corsa_corrente': None, 'gps_on': False, 'gps_km_raw': 0.0,
+                    '_anchor_value': 0, '_gps_total': 0.0, '_gps_total_anchor': 0.0,
+                    '_pickup_set': False, '_drop_set': False, **stato
+                })
+                seq_snapshot = int(stato.get('seq', 0))
+
+            # Riapplica le modifiche successive allo snapshot
+            replay = 0
+            self._journal_seq = max(self._journal_seq, seq_snapshot)
+            for rec in leggi_journal(journal_path, seq_snapshot):
+                self._applica_record(rec)
+                self._journal_seq = max(self._journal_seq, int(rec.get('seq', 0)))
+                replay += 1
+
+            # Migrazione una tantum delle corse dal vecchio backup
+            if self.corse and not corse_archivio:
+                archivio = self._get_archivio()
+                for c in self.corse:
+                    archivio.aggiungi_corsa(self.foglio_id, c)
+                corse_archivio = list(archivio.corse_foglio(self.foglio_id))
+                print(f"✅ {len(corse_archivio)} corse migrate nell'archivio")
+            self.corse = corse_archivio
+            # Corsa in modifica di un altro giorno: l'indice non vale per il foglio di oggi
+            if self._foglio_stato not in (None, self.foglio_id):
+                self.corsa_corrente = None
+
+            # Riparte da uno snapshot pulito
+            self._compatta_backup()
+
             # Aggiorna UI
             self._aggiorna_ui_da_backup()
-            
-            print("✅ Backup caricato con successo")
+
+            print(f"✅ Backup caricato con successo ({replay} modifiche dal journal)")
             self._msg("Stato precedente ripristinato", "Backup")
-            
+
         except Exception as e:
             print(f"❌ Errore caricamento backup: {e}")
-    
+
     def _aggiorna_ui_da_backup(self):
         """Aggiorna l'UI dopo il caricamento del backup"""
         # Aggiorna label KM
-        km_total_int = int(ceil(self.gps_km_raw))
-        km_since_anchor_int = self._km_since_anchor()
-        self.lbl_km.text = f"KM GPS: {km_total_int} (+{km_since_anchor_int} dall'ancora)"
+        self._pubblica_km()
         
         # Aggiorna animazione bottone GPS
         if self.gps_on:
@@ -365,6 +2912,7 @@ class CorseScreen(Screen):
     def _setup_android_lifecycle(self):
         """Configura il rilevamento dello stato dell'app su Android"""
         try:
+            autoclass = _servizio("jnius")
             if autoclass:
                 PythonActivity = autoclass('org.kivy.android.PythonActivity')
                 activity = PythonActivity.mActivity
@@ -413,25 +2961,66 @@ class CorseScreen(Screen):
         return (t[:n] + "...") if len(t) > n else t
 
     def _ui_clean(self, s):
-        if s is None: return ""
-        t = str(s)
-        repl = {
-            "\u2026": "...", "\u2013": "-", "\u2014": "-", "\u2019": "'",
-            "\xa0": " ", "\u200b": "", "\u200c": "", "\u200d": "", "\ufeff": ""
-        }
-        for k, v in repl.items(): 
-            t = t.replace(k, v)
-        t = "".join(ch for ch in t if (ch.isprintable() or ch in " \t"))
-        t = " ".join(t.split())
-        return t
+        return pulisci_ui(s)
+
+    def _mostra_suggerimenti(self, campo):
+        """Fino a tre completamenti per il campo in scrittura, come pulsanti sotto di esso"""
+        ti = self.campi[campo]
+        riga = self._righe_suggerimenti[campo]
+        voci = []
+        if ti.focus and self._completamenti is None and self._completamenti_thread is None:
+            self._carica_completamenti()
+        if ti.focus and self._completamenti is not None and len(ti.text.strip()) >= 2:
+            voci = self._completamenti[self.CAMPI_COMPLETAMENTO[campo]].suggerisci(ti.text, limite=3)
+        riga.clear_widgets()
+        for testo in voci:
+            b = Button(text=self._short(testo, 24), font_size=sp(13), background_color=(0.30,0.40,0.55,1))
+            b.bind(on_release=lambda _b, c=campo, t=testo: self._scegli_suggerimento(c, t))
+            riga.add_widget(b)
+        riga.height = dp(40) if voci else 0
+
+    def _scegli_suggerimento(self, campo, testo):
+        self.campi[campo].text = testo
+        self._righe_suggerimenti[campo].clear_widgets()
+        self._righe_suggerimenti[campo].height = 0
 
     def _scroll_on_focus(self, ti, focused):
+        # Un tocco su un luogo vuoto accetta l'indirizzo proposto
+        if focused and not ti.text and ti.hint_text:
+            ti.text = ti.hint_text
+            ti.hint_text = ""
         if focused and hasattr(self, 'scroll'):
             Clock.schedule_once(lambda dt: self.scroll.scroll_to(ti, padding=dp(90), animate=True), 0)
 
     def _msg(self, text, title="Info"):
         Popup(title=title, content=Label(text=text), size_hint=(0.9, 0.5)).open()
 
+    @staticmethod
+    def _mostra_testo(widget, testo):
+        # Nessun nuovo layout/texture se il testo non cambia
+        if widget.text != testo:
+            widget.text = testo
+
+    def _mostra_km(self, km):
+        if km is None:
+            self._mostra_testo(self.lbl_km, "KM GPS: 0")
+        else:
+            self._mostra_testo(self.lbl_km, f"KM GPS: {km[0]} (+{km[1]} dall'ancora)")
+
+    def _pubblica_km(self):
+        km = (int(ceil(self.gps_km_raw)), self._km_since_anchor())
+        if km != self._km_pubblicati:
+            self._km_pubblicati = km
+            self.ui.imposta("km", km)
+
+    def _imposta_campo(self, nome, valore):
+        """Valore di un campo deciso dal GPS: il widget si aggiorna al prossimo frame"""
+        self.ui.imposta("campo:" + nome, valore)
+
+    def _campo(self, nome):
+        """Testo di un campo, compreso un valore GPS non ancora mostrato"""
+        return self.ui.valore("campo:" + nome, self.campi[nome].text or "")
+
     # METODI PER GESTIONE KM INTERI
     def _km_since_anchor(self) -> int:
         """Restituisce i KM percorsi dall'ultima ricalibrazione (arrotondati per eccesso)"""
@@ -506,35 +3095,10 @@ class CorseScreen(Screen):
             pass
 
     def clean_address(self, s: str) -> str:
-        if not s: return s
-        s = re.sub(r'^\s*Cin:\s*[A-Za-z0-9]+,\s*', '', s, flags=re.IGNORECASE)
-        s = re.sub(r'(,\s*)?\b\d{5}\b(?=,|$|\s)', '', s)
-        s = re.sub(r',\s*(Italia|Italy)\s*$', '', s, flags=re.IGNORECASE)
-        s = re.sub(r'\s*,\s*', ', ', s)
-        s = re.sub(r'\s{2,}', ' ', s).strip()
-        s = re.sub(r'(,\s*){2,}', ', ', s)
-        s = re.sub(r',\s*$', '', s)
-        return s
+        return pulisci_indirizzo(s)
 
     def parse_uber_text(self, txt: str):
-        lines = [l.strip() for l in (txt or "").splitlines() if l.strip()]
-        kv = {}
-        for ln in lines:
-            if '\t' in ln:
-                k, v = ln.split('\t', 1)
-            else:
-                parts = re.split(r'\s{2,}|:\s*', ln, maxsplit=1)
-                if len(parts) != 2: continue
-                k, v = parts
-            kv[k.strip().lower()] = v.strip()
-        ret = {}
-        name = kv.get('passenger name') or kv.get('passeggero') or kv.get('fruitore') or kv.get('rider') or kv.get('cliente')
-        if name: ret["Fruitore servizio"] = name.strip()
-        frm = kv.get('from') or kv.get('partenza') or kv.get('pickup')
-        if frm: ret["Luogo di partenza"] = self.clean_address(frm.strip())
-        to = kv.get('destination') or kv.get('destinazione') or kv.get('drop-off') or kv.get('drop off') or kv.get('dropoff')
-        if to:  ret["Luogo di destinazione"] = self.clean_address(to.strip())
-        return ret
+        return parse_testo_corsa(txt)
 
     def import_from_text(self, txt: str, silent=False) -> bool:
         data = self.parse_uber_text(txt or "")
@@ -548,19 +3112,88 @@ class CorseScreen(Screen):
         return True
 
     def importa_da_uber(self, *_):
+        from kivy.uix.textinput import TextInput
         root = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(10))
         root.add_widget(Label(text="Incolla qui i dettagli corsa (testo):", size_hint_y=None, height=dp(24)))
         ti = TextInput(multiline=True, size_hint=(1, 1)); root.add_widget(ti)
         btns = BoxLayout(size_hint_y=None, height=dp(48), spacing=dp(8))
         b_ok = Button(text="Compila", background_normal="", background_color=(0.30,0.70,0.30,1))
+        b_tutte = Button(text="Tutte", background_normal="", background_color=(0.50,0.40,0.80,1))
+        b_file = Button(text="Da file")
         b_no = Button(text="Annulla")
-        btns.add_widget(b_no); btns.add_widget(b_ok)
+        btns.add_widget(b_no); btns.add_widget(b_file); btns.add_widget(b_tutte); btns.add_widget(b_ok)
         root.add_widget(btns)
         pop = Popup(title="Importa da Uber", content=root, size_hint=(0.95, 0.85))
         b_ok.bind(on_release=lambda *_: (self.import_from_text(ti.text), pop.dismiss()))
+        b_tutte.bind(on_release=lambda *_: (pop.dismiss(), self.importa_corse(dividi_testo_corse(ti.text))))
+        b_file.bind(on_release=lambda *_: (pop.dismiss(), self.popup_importa_file()))
         b_no.bind(on_release=lambda *_: pop.dismiss())
         pop.open()
 
+    def popup_importa_file(self, *_):
+        from kivy.uix.filechooser import FileChooserListView
+        root = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(10))
+        iniziale = os.path.expanduser("~")
+        if platform == "android":
+            storage = _servizio("storage")
+            iniziale = os.path.join(storage() if storage else "/sdcard", "Download")
+        fc = FileChooserListView(path=iniziale if os.path.isdir(iniziale) else "/", filters=["*.txt", "*.csv"])
+        root.add_widget(fc)
+        btns = BoxLayout(size_hint_y=None, height=dp(48), spacing=dp(8))
+        b_ok = Button(text="Importa", background_normal="", background_color=(0.30,0.70,0.30,1))
+        b_no = Button(text="Annulla")
+        btns.add_widget(b_no); btns.add_widget(b_ok)
+        root.add_widget(btns)
+        pop = Popup(title="Importa corse da file (.txt, .csv)", content=root, size_hint=(0.95, 0.9))
+
+        def conferma(*_a):
+            if not fc.selection:
+                return
+            pop.dismiss()
+            self.importa_file(fc.selection[0])
+
+        b_ok.bind(on_release=conferma)
+        b_no.bind(on_release=lambda *_a: pop.dismiss())
+        pop.open()
+
+    def importa_file(self, path):
+        try:
+            blocchi = leggi_file_corse(path)
+        except (OSError, UnicodeError, csv.Error) as e:
+            self._msg(f"File non leggibile:\n{e}", title="Importa")
+            return
+        self.importa_corse(blocchi)
+
+    def importa_corse(self, blocchi):
+        """Aggiunge al foglio corrente una corsa da completare per ogni blocco riconosciuto.
+
+        Tutte le corse entrano nell'archivio in una transazione e nello stato
+        con un solo salvataggio; alla fine un riepilogo dei blocchi scartati.
+        """
+        corse, scartati = analizza_corse(blocchi)
+        if corse:
+            if self.foglio_id is None:
+                self._apri_foglio_corrente()
+            for c in corse:
+                c["_in_attesa"] = True     # segnata nell'elenco finché non si salva dal modulo
+            ids = self._get_archivio().aggiungi_corse(self.foglio_id, corse)
+            for c, cid in zip(corse, ids):
+                c["_id"] = cid
+                self.corse.append(c)
+                self._registra_completamenti(c)
+                if self._elenco_rv is not None:
+                    self._elenco_rv.data.append(self._elenco_riga(c))
+            if self._elenco_rv is not None:
+                self._elenco_vuoto()
+            self._salva_backup()
+        testo = f"Corse importate: {len(corse)}"
+        if scartati:
+            testo += f"\nNon riconosciute: {len(scartati)}\n" + "\n".join(
+                f"#{n}: {riga}" for n, riga in scartati[:8])
+            if len(scartati) > 8:
+                testo += f"\n... e altre {len(scartati) - 8}"
+        self._msg(testo, title="Importa")
+
     # Metodi GPS (modificati per animazione)
     def gps_toggle(self, *_):
         if not self._gps_available():
@@ -572,19 +3205,19 @@ class CorseScreen(Screen):
             self._gps_start()
 
     def _gps_available(self):
-        return platform == "android" and (plyer_gps is not None)
+        return (platform == "android" or bool(os.environ.get("FDV_REPLAY"))) and (_servizio("gps") is not None)
 
     def _gps_start(self):
-        self._pickup_set = False; self._drop_set = False
-        self._first_fix = None; self._still_since = None; self._km_at_pickup = None
-        try:
-            if request_permissions and Permission:
-                request_permissions([Permission.ACCESS_FINE_LOCATION, Permission.ACCESS_COARSE_LOCATION])
-        except Exception:
-            pass
+        self.rilevatore.azzera_decisioni()
+        _richiedi_permessi(["ACCESS_FINE_LOCATION", "ACCESS_COARSE_LOCATION"])
+        plyer_gps = _servizio("gps")
         try:
             plyer_gps.configure(on_location=self._on_location, on_status=self._on_gps_status)
-            plyer_gps.start(minTime=1000, minDistance=5)
+            # In attesa della salita: campionamento fitto
+            self._gps_profilo = 'decisione'
+            self._gps_profilo_ts = None   # fissato dal primo fix, con l'orologio della sorgente
+            min_time, min_dist = self.GPS_PROFILI[self._gps_profilo]
+            plyer_gps.start(minTime=min_time, minDistance=min_dist)
             self.gps_on = True
             self._start_gps_animation()  # NUOVO: Avvia animazione
             self._msg("GPS avviato")
@@ -594,98 +3227,206 @@ class CorseScreen(Screen):
 
     def _gps_stop(self):
         try: 
-            plyer_gps.stop()
+            _servizio("gps").stop()
         except Exception: 
             pass
         self.gps_on = False
+        self._gps_profilo = None
         self._stop_gps_animation()  # NUOVO: Ferma animazione
         self._msg("GPS fermato")
         self._salva_backup()  # NUOVO: Salva stato
 
+    # =========================================================================
+    # NUOVO: CAMPIONAMENTO GPS ADATTIVO
+    # =========================================================================
+
+    def _scegli_profilo_gps(self, speed_kmh, is_still, dwell_ok):
+        if is_still:
+            if not dwell_ok and self.rilevatore.in_sospeso():
+                return 'decisione'
+            return 'fermo'
+        return 'veloce' if speed_kmh >= self.SPEED_FAST_KMH else 'marcia'
+
+    def _aggiorna_campionamento(self, profilo, now_ts):
+        """Cambia profilo GPS; i rallentamenti sono limitati da GPS_CAMBIO_MIN_S"""
+        if self._gps_profilo_ts is None:
+            self._gps_profilo_ts = now_ts
+        if not self.gps_on or profilo == self._gps_profilo:
+            return
+        attuale = self.GPS_PROFILI.get(self._gps_profilo, (0, 0))
+        piu_lento = self.GPS_PROFILI[profilo][0] > attuale[0]
+        if piu_lento and (now_ts - self._gps_profilo_ts) < self.GPS_CAMBIO_MIN_S:
+            return
+        self._gps_profilo = profilo
+        self._gps_profilo_ts = now_ts
+        # Il riavvio avviene fuori dal callback del provider
+        Clock.schedule_once(lambda dt: self._gps_riavvia(profilo), 0)
+
+    def _gps_riavvia(self, profilo):
+        """Riavvia il provider con i parametri del profilo (totali km invariati)"""
+        if not self.gps_on or profilo != self._gps_profilo:
+            return
+        min_time, min_dist = self.GPS_PROFILI[profilo]
+        plyer_gps = _servizio("gps")
+        try:
+            plyer_gps.stop()
+            plyer_gps.start(minTime=min_time, minDistance=min_dist)
+            self._gps_riavvii += 1
+        except Exception as e:
+            print(f"⚠️ Cambio campionamento GPS non riuscito: {e}")
+
+    def _gps_statistiche(self):
+        return {
+            'fix_ricevuti': self._gps_fix_ricevuti,
+            'fix_elaborati': self._gps_fix_elaborati,
+            'riavvii': self._gps_riavvii,
+        }
+
+    def _cartella_tracce(self):
+        cartella = os.path.join(App.get_running_app().user_data_dir, "tracce")
+        os.makedirs(cartella, exist_ok=True)
+        return cartella
+
+    def _nuovo_file_traccia(self):
+        """Percorso del file binario per la traccia della corsa corrente"""
+        return os.path.join(self._cartella_tracce(), datetime.now().strftime("traccia_%Y%m%d_%H%M%S_%f.bin"))
+
+    def _pulisci_tracce_orfane(self):
+        """Elimina i file di riversamento (e gli .fdvt.tmp) lasciati da un crash a corsa in corso"""
+        cartella = os.path.join(App.get_running_app().user_data_dir, "tracce")
+        try:
+            nomi = os.listdir(cartella)
+        except OSError:
+            return
+        for nome in nomi:
+            path = os.path.join(cartella, nome)
+            if ((nome.startswith("traccia_") and nome.endswith(".bin") and path != self.track.path)
+                    or nome.endswith(".fdvt.tmp")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _salva_traccia_corsa(self):
+        """Archivia la traccia corrente in formato compatto; restituisce il nome del file"""
+        nome = datetime.now().strftime("corsa_%Y%m%d_%H%M%S_%f.fdvt")
+        path = os.path.join(self._cartella_tracce(), nome)
+        with open(path + ".tmp", 'wb') as f:
+            f.write(codifica_traccia(self.track.punti()))
+        os.replace(path + ".tmp", path)
+        return nome
+
+    def _elimina_traccia_corsa(self, corsa):
+        if corsa and corsa.get("_traccia"):
+            try:
+                os.remove(os.path.join(self._cartella_tracce(), corsa["_traccia"]))
+            except OSError:
+                pass
+
+    def _punti_traccia_corsa(self, corsa):
+        """Iteratore (lat, lon, ts) sulla traccia archiviata di una corsa (vuoto se assente)"""
+        try:
+            with open(os.path.join(self._cartella_tracce(), corsa["_traccia"]), 'rb') as f:
+                dati = f.read()
+        except (KeyError, OSError):
+            return iter(())
+        return decodifica_traccia(dati)
+
     def _on_gps_status(self, stype, status): 
         pass
 
     @staticmethod
     def _hav_km(p1, p2):
-        R = 6371.0
-        lat1, lon1 = map(math.radians, p1)
-        lat2, lon2 = map(math.radians, p2)
-        dlat = lat2 - lat1; dlon = lon2 - lon1
-        a = math.sin(dlat/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin(dlon/2)**2
-        return 2 * R * math.asin(math.sqrt(a))
+        return distanza_km(p1, p2)
+
+    @staticmethod
+    def _ora_fix(kwargs):
+        """Ora del fix: il timestamp della traccia in riproduzione, altrimenti l'ora attuale"""
+        ts = kwargs.get("timestamp")
+        if ts is not None:
+            try:
+                return datetime.fromtimestamp(float(ts))
+            except (TypeError, ValueError, OverflowError, OSError):
+                pass
+        return datetime.now()
 
     def _on_location(self, **kwargs):
+        """Callback del provider GPS: traccia, rilevatore e campi cambiano solo sul thread principale"""
+        if threading.get_ident() == self._thread_principale:
+            if self._fix_coda:
+                self._elabora_coda_fix(0)
+            self._elabora_fix(kwargs)
+            return
+        # Thread del provider (Android): l'ora del fix si prende adesso, il resto al prossimo frame
+        kwargs.setdefault("timestamp", time.time())
+        self._fix_coda.append(kwargs)
+        self._trigger_fix()
+
+    def _elabora_coda_fix(self, _dt):
+        coda = self._fix_coda
+        while coda:
+            self._elabora_fix(coda.popleft())
+
+    def _elabora_fix(self, kwargs):
+        self._gps_fix_ricevuti += 1
         try:
             lat = float(kwargs.get("lat")); lon = float(kwargs.get("lon"))
             acc = float(kwargs.get("accuracy", 9999))
             spd = float(kwargs.get("speed", 0.0))
         except Exception:
             return
-        if acc > 100: return
+        if acc > RilevatoreCorse.PRECISIONE_MAX_M: return
+        self._gps_fix_elaborati += 1
+        now = self._ora_fix(kwargs)
+        now_ts = now.timestamp()
 
         pt = (lat, lon)
-        d = 0.0
-        if self.track:
-            d = self._hav_km(self.track[-1], pt)
-            if 0.0 <= d <= 1.0: 
-                self.gps_km_raw += d
-                self._gps_total += d  # Aggiorna il totale GPS (float per precisione)
-        
-        self.track.append(pt)
+        r = self.rilevatore
+        eventi = r.fix(lat, lon, now_ts, spd, acc)
+        self._gps_total += r.passo_km  # Aggiorna il totale GPS (float per precisione)
+        self.track.append(pt, now_ts)
 
-        # Aggiorna label con valori interi
-        km_total_int = int(ceil(self.gps_km_raw))
-        km_since_anchor_int = self._km_since_anchor()
-        self.lbl_km.text = f"KM GPS: {km_total_int} (+{km_since_anchor_int} dall'ancora)"
+        # Label con valori interi, applicata al più KM_LABEL_HZ volte al secondo
+        self._pubblica_km()
+        self._aggiorna_campionamento(self._scegli_profilo_gps(r.velocita_kmh, r.fermo, r.sosta_ok), now_ts)
 
-        speed_kmh = (spd * 3.6) if spd <= 60 else spd
-        is_still = speed_kmh <= self.SPEED_STILL_KMH
-        now_ts = datetime.now().timestamp()
-
-        if self._first_fix is None: 
-            self._first_fix = pt
-        if is_still:
-            if self._still_since is None: 
-                self._still_since = now_ts
-        else:
-            self._still_since = None
-        dwell_ok = (self._still_since is not None) and ((now_ts - self._still_since) >= self.DWELL_S)
-
-        if not self._pickup_set and dwell_ok and self._first_fix is not None:
-            d0_km = self._hav_km(self._first_fix, pt)
-            if d0_km * 1000.0 <= self.START_RADIUS_M:
-                self.campi["Ora di partenza"].text = datetime.now().strftime("%H:%M")
-                self._pickup_set = True; self._km_at_pickup = self.gps_km_raw
+        for ev in eventi:
+            if ev["tipo"] == "sosta":
+                # Fermi in un luogo frequente: se ne propone l'indirizzo
+                nome = "Luogo di destinazione" if ev["arrivo"] else "Luogo di partenza"
+                self.ui.imposta("suggerimento:" + nome, ev["luogo"])
+            elif ev["tipo"] == "salita":
+                self._imposta_campo("Ora di partenza", now.strftime("%H:%M"))
+                self._pt_salita = pt
+                self._luogo_gps("Luogo di partenza", pt)
                 try:
-                    if not (self.campi["KM iniziali"].text or "").strip():
+                    if not self._campo("KM iniziali").strip():
                         app = App.get_running_app()
                         if getattr(app, "last_km_final", None) is not None:
                             # MODIFICA: Converti a intero
-                            self.campi["KM iniziali"].text = f"{int(app.last_km_final)}"
+                            self._imposta_campo("KM iniziali", f"{int(app.last_km_final)}")
                         else:
                             # MODIFICA: Usa calcolo con interi
                             auto_val = self._anchor_value + self._km_since_anchor()
-                            self.campi["KM iniziali"].text = f"{auto_val}"
+                            self._imposta_campo("KM iniziali", f"{auto_val}")
+                except Exception:
+                    pass
+            elif ev["tipo"] == "discesa":
+                self._imposta_campo("Ora di arrivo", now.strftime("%H:%M"))
+                self._pt_discesa = pt
+                self._luogo_gps("Luogo di destinazione", pt)
+                try:
+                    km_ini_txt = self._campo("KM iniziali").strip()
+                    km_ini_val = int(km_ini_txt) if km_ini_txt else 0
+                    # MODIFICA: Calcola KM finali con interi
+                    km_fin_val = km_ini_val + self._km_since_anchor()
+                    self._imposta_campo("KM finali", f"{km_fin_val}")
+                    app = App.get_running_app(); app.last_km_final = km_fin_val
                 except Exception:
                     pass
-
-        if self._pickup_set and not self._drop_set and dwell_ok:
-            if self._km_at_pickup is not None:
-                traveled = max(0.0, self.gps_km_raw - self._km_at_pickup)
-                if traveled >= self.MIN_TRAVEL_KM_FOR_DROP:
-                    self.campi["Ora di arrivo"].text = datetime.now().strftime("%H:%M")
-                    self._drop_set = True
-                    try:
-                        km_ini_txt = (self.campi["KM iniziali"].text or "").strip()
-                        km_ini_val = int(km_ini_txt) if km_ini_txt else 0
-                        # MODIFICA: Calcola KM finali con interi
-                        km_fin_val = km_ini_val + self._km_since_anchor()
-                        self.campi["KM finali"].text = f"{km_fin_val}"
-                        app = App.get_running_app(); app.last_km_final = km_fin_val
-                    except Exception:
-                        pass
 
     def _prep_next_corsa(self, start_gps: bool):
+        self.ui.applica()
         app = App.get_running_app()
         try:
             app.last_km_final = int((self.campi["KM finali"].text or "").strip())
@@ -693,10 +3434,12 @@ class CorseScreen(Screen):
             pass
         for t in self.campi.values(): 
             t.text = ""
-        self.track = []; self.gps_km_raw = 0.0
-        self._pickup_set = False; self._drop_set = False
-        self._first_fix = None; self._still_since = None; self._km_at_pickup = None
-        self.lbl_km.text = "KM GPS: 0"
+        self.track.reset(); self.rilevatore.azzera()
+        self._gps_fix_ricevuti = 0; self._gps_fix_elaborati = 0; self._gps_riavvii = 0
+        self._pt_salita = None; self._pt_discesa = None
+        self._km_pubblicati = None; self.ui.imposta("km", None)
+        for nome in COLONNE_INDIRIZZO:
+            self.ui.imposta("suggerimento:" + nome, "")
 
         if start_gps and self._gps_available() and not self.gps_on:
             self._gps_start()
@@ -705,6 +3448,7 @@ class CorseScreen(Screen):
         self._salva_backup()
 
     def salva_corsa(self, *_):
+        self.ui.applica()
         app = App.get_running_app()
         c = {k: (self.campi[k].text or "") for k in self.COLONNE}
         
@@ -719,56 +3463,121 @@ class CorseScreen(Screen):
                 pass
         
         if any((v or "").strip() for v in c.values()):
+            # Traccia, statistiche GPS e posizioni in diretta appartengono alla corsa in
+            # registrazione: una corsa vecchia aperta in modifica tiene le sue
+            in_corso = self.corsa_corrente is None
+            precedente = {} if in_corso else self.corse[self.corsa_corrente]
+            c.update((k, v) for k, v in precedente.items() if k not in self.COLONNE and k != "_id")
+            # Confermata dal modulo, una corsa importata non è più da completare
+            c.pop("_in_attesa", None)
+            if in_corso:
+                # Statistiche GPS della corsa, per misurare il risparmio del campionamento
+                if self._gps_fix_ricevuti:
+                    c["_gps"] = self._gps_statistiche()
+                # Traccia della corsa, conservata per eventuali verifiche sui km
+                if self.track:
+                    try:
+                        c["_traccia"] = self._salva_traccia_corsa()
+                    except OSError as e:
+                        print(f"⚠️ Traccia della corsa non salvata: {e}")
+                # Posizioni di salita e discesa, per l'indice dei luoghi frequenti
+                for chiave, pt in (("_gps_partenza", self._pt_salita), ("_gps_arrivo", self._pt_discesa)):
+                    if pt is not None:
+                        c[chiave] = [round(pt[0], 6), round(pt[1], 6)]
+            archivio = self._get_archivio()
+            if self.foglio_id is None:
+                self._apri_foglio_corrente()
             if self.corsa_corrente is None:
+                c["_id"] = archivio.aggiungi_corsa(self.foglio_id, c)
+                self._luoghi.aggiungi_corsa(c)
+                self._registra_completamenti(c)
                 self.corse.append(dict(c))
+                if self._elenco_rv is not None:
+                    self._elenco_rv.data.append(self._elenco_riga(c))
             else:
-                self.corse[self.corsa_corrente] = dict(c); self.corsa_corrente = None
+                c["_id"] = self.corse[self.corsa_corrente].get("_id")
+                archivio.aggiorna_corsa(c["_id"], c)
+                self._luoghi.togli_corsa(precedente)
+                self._luoghi.aggiungi_corsa(c)
+                self._registra_completamenti(c, precedente)
+                self.corse[self.corsa_corrente] = dict(c)
+                if self._elenco_rv is not None:
+                    self._elenco_rv.data[self.corsa_corrente] = self._elenco_riga(c)
+                self.corsa_corrente = None
             self._msg("Corsa salvata")
-            self._prep_next_corsa(start_gps=False)
-            if self.gps_on: 
-                self._gps_stop()
+            if in_corso:
+                self._prep_next_corsa(start_gps=False)
+                if self.gps_on: 
+                    self._gps_stop()
+            else:
+                # Modifica conclusa: la registrazione GPS in corso prosegue
+                for t in self.campi.values():
+                    t.text = ""
             # NUOVO: Salva backup dopo salvataggio corsa
             self._salva_backup()
         else:
             self._msg("Compila almeno un campo")
 
+    def _registra_completamenti(self, corsa, precedente=None):
+        """Aggiunge agli indici di completamento i valori nuovi o cambiati della corsa"""
+        for campo, tipo in self.CAMPI_COMPLETAMENTO.items():
+            valore = (corsa.get(campo) or "").strip()
+            if not valore or valore == (precedente or {}).get(campo, "").strip():
+                continue
+            if self._completamenti is not None:
+                self._completamenti[tipo].aggiungi(valore)
+            elif self._completamenti_thread is not None:
+                self._completamenti_in_attesa.append((tipo, valore))
+
     def nuova_corsa(self, *_):
         self._prep_next_corsa(start_gps=False)
 
+    def _elenco_riga(self, corsa):
+        """Testi di una riga dell'elenco, calcolati una volta per contenuto"""
+        key = (corsa.get('Luogo di partenza',''), corsa.get('Luogo di destinazione',''),
+               corsa.get('Fruitore servizio',''), bool(corsa.get('_in_attesa')))
+        riga = self._elenco_cache.get(key)
+        if riga is None:
+            part = self._ui_clean(key[0])
+            dest = self._ui_clean(key[1])
+            # Corse importate e non ancora confermate dal modulo
+            desc = f"{part} → {dest}" if not key[3] else f"Da completare · {part} → {dest}"
+            riga = {'desc': desc, 'chip': self._short(self._ui_clean(key[2]), 7), 'attesa': key[3]}
+            # Le modifiche lasciano voci vecchie: oltre il doppio delle corse del foglio si riparte
+            if len(self._elenco_cache) >= 2 * len(self.corse) + 32:
+                self._elenco_cache.clear()
+            self._elenco_cache[key] = riga
+        return riga
+
+    def _elenco_vuoto(self):
+        self._elenco_lbl_vuoto.text = "" if self.corse else "Nessuna corsa"
+        self._elenco_lbl_vuoto.height = 0 if self.corse else dp(44)
+
     def popup_elenco(self, *_):
-        box = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(10), size_hint_y=None)
-        box.bind(minimum_height=box.setter('height'))
-        if not self.corse:
-            box.add_widget(Label(text="Nessuna corsa"))
-        else:
-            for i, corsa in enumerate(self.corse):
-                r = BoxLayout(size_hint_y=None, height=dp(44), spacing=dp(6))
-                part = self._ui_clean(corsa.get('Luogo di partenza',''))
-                dest = self._ui_clean(corsa.get('Luogo di destinazione',''))
-                desc = f"{i+1}. {part} → {dest}"
-                lbl = Label(text=desc, shorten=True, shorten_from='right', size_hint_x=1)
-                lbl.bind(size=lambda inst, _v: setattr(inst, "text_size", inst.size))
-                r.add_widget(lbl)
-                chip_txt = self._short(self._ui_clean(corsa.get('Fruitore servizio','')), 7)
-                chip = Button(text=chip_txt or "-", size_hint=(None, 1), width=dp(78),
-                              background_normal="", background_color=(0.45,0.45,0.52,1),
-                              color=(1,1,1,1), disabled=True)
-                r.add_widget(chip)
-                b1 = Button(text="Apri", size_hint=(None,1), width=dp(80),
-                            background_normal="", background_color=(0.55,0.55,0.60,1))
-                b2 = Button(text="Elimina", size_hint=(None,1), width=dp(90),
-                            background_normal="", background_color=(0.85,0.30,0.30,1))
-                b1.bind(on_release=lambda _w, idx=i: self._carica(idx))
-                b2.bind(on_release=lambda _w, idx=i: self._del(idx))
-                r.add_widget(b1); r.add_widget(b2)
-                box.add_widget(r)
-        scr = ScrollView(size_hint=(1,1)); scr.add_widget(box)
-        self._p = Popup(title="Elenco corse", content=scr, size_hint=(0.9,0.9)); self._p.open()
+        if self._elenco_rv is None:
+            # Costruita una sola volta: poi si aggiornano solo le righe toccate
+            rv = RecycleView(viewclass=RigaCorsa, size_hint=(1,1))
+            rv.schermo = self
+            lm = RecycleBoxLayout(orientation='vertical', spacing=dp(8), padding=dp(10),
+                                  default_size=(None, dp(44)), default_size_hint=(1, None),
+                                  size_hint_y=None)
+            lm.bind(minimum_height=lm.setter('height'))
+            rv.add_widget(lm)
+            rv.data = [self._elenco_riga(c) for c in self.corse]
+            self._elenco_lbl_vuoto = Label(size_hint_y=None)
+            root = BoxLayout(orientation='vertical')
+            root.add_widget(self._elenco_lbl_vuoto); root.add_widget(rv)
+            self._p = Popup(title="Elenco corse", content=root, size_hint=(0.9,0.9))
+            self._elenco_rv = rv
+        self._elenco_vuoto()
+        self._p.open()
 
     def _carica(self, idx):
+        self.ui.applica()
         if 0 <= idx < len(self.corse):
+            corsa = self._get_archivio().corsa(self.corse[idx].get("_id")) or self.corse[idx]
             for k, t in self.campi.items():
-                t.text = self.corse[idx].get(k, "")
+                t.text = corsa.get(k, "")
             self.corsa_corrente = idx
         if hasattr(self, '_p'): 
             self._p.dismiss()
@@ -781,14 +3590,92 @@ class CorseScreen(Screen):
                 for t in self.campi.values(): 
                     t.text = ""
                 self.corsa_corrente = None
+            elif self.corsa_corrente is not None and self.corsa_corrente > idx:
+                self.corsa_corrente -= 1
+            self._get_archivio().elimina_corsa(self.corse[idx].get("_id"))
+            self._luoghi.togli_corsa(self.corse[idx])
+            self._elimina_traccia_corsa(self.corse[idx])
             self.corse.pop(idx)
-            if hasattr(self, '_p'): 
-                self._p.dismiss()
-            self.popup_elenco()
+            if self._elenco_rv is not None:
+                self._elenco_rv.data.pop(idx)
+                self._elenco_vuoto()
             # NUOVO: Salva backup dopo eliminazione corsa
             self._salva_backup()
 
+    # =========================================================================
+    # NUOVO: STORICO FOGLI (caricati solo su richiesta)
+    # =========================================================================
+
+    def popup_storico(self, *_):
+        righe = []
+        for f in self._get_archivio().riepilogo_fogli():
+            corrente = " (oggi)" if f["id"] == self.foglio_id else ""
+            desc = f"{f['giorno']}{corrente} N° {f['Foglio di servizio N°'] or '-'} {f['Targa']} · {f['n_corse']} corse"
+            righe.append({'foglio_id': f["id"], 'desc': desc})
+        if not righe:
+            self._msg("Nessun foglio in archivio", title="Storico")
+            return
+        rv = RecycleView(viewclass=RigaFoglio, size_hint=(1,1))
+        rv.schermo = self
+        lm = RecycleBoxLayout(orientation='vertical', spacing=dp(8), padding=dp(10),
+                              default_size=(None, dp(44)), default_size_hint=(1, None),
+                              size_hint_y=None)
+        lm.bind(minimum_height=lm.setter('height'))
+        rv.add_widget(lm)
+        rv.data = righe
+        Popup(title="Storico fogli", content=rv, size_hint=(0.95,0.9)).open()
+
+    @staticmethod
+    def _riga_statistica(titolo, t):
+        return f"{titolo}: {t['corse']} corse · {t['km']} km · {t['minuti'] // 60}h{t['minuti'] % 60:02d}"
+
+    def popup_statistiche(self, *_):
+        """Totali di oggi, del mese, per fruitore e per targa, letti dall'indice dell'archivio"""
+        archivio = self._get_archivio()
+        oggi = datetime.now().strftime("%Y-%m-%d")
+        righe = [
+            self._riga_statistica("Oggi", archivio.statistiche("giorno", oggi)),
+            self._riga_statistica(f"Mese {oggi[:7]}", archivio.statistiche("mese", oggi[:7])),
+            self._riga_statistica("Totale", archivio.statistiche("totale", "")),
+        ]
+        for titolo, dimensione in (("Per fruitore", "fruitore"), ("Per targa", "targa")):
+            righe.append("")
+            righe.append(titolo)
+            for t in archivio.statistiche(dimensione, limite=50):
+                righe.append(self._riga_statistica(self._ui_clean(t["chiave"]) or "-", t))
+        rv = RecycleView(viewclass='Label', size_hint=(1,1))
+        lm = RecycleBoxLayout(orientation='vertical', padding=dp(10),
+                              default_size=(None, dp(30)), default_size_hint=(1, None),
+                              size_hint_y=None)
+        lm.bind(minimum_height=lm.setter('height'))
+        rv.add_widget(lm)
+        rv.data = [{'text': r, 'shorten': True} for r in righe]
+        Popup(title="Statistiche", content=rv, size_hint=(0.95,0.9)).open()
+
+    def _storico_corse(self, foglio_id):
+        """Mostra in sola lettura le corse di un foglio, lette ora dall'archivio"""
+        righe = []
+        for i, c in enumerate(self._get_archivio().corse_foglio(foglio_id)):
+            r = self._elenco_riga(c)
+            orari = f"{c.get('Ora di partenza','')}-{c.get('Ora di arrivo','')}"
+            righe.append({'text': f"{i+1}. {orari} {r['chip']} {r['desc']}",
+                          'corsa_id': c["_id"], 'traccia': bool(c.get("_traccia"))})
+        if not righe:
+            righe = [{'text': "Nessuna corsa", 'corsa_id': None, 'traccia': False}]
+        rv = RecycleView(viewclass=RigaStorico, size_hint=(1,1))
+        rv.schermo = self
+        lm = RecycleBoxLayout(orientation='vertical', padding=dp(10),
+                              default_size=(None, dp(36)), default_size_hint=(1, None),
+                              size_hint_y=None)
+        lm.bind(minimum_height=lm.setter('height'))
+        rv.add_widget(lm)
+        rv.data = righe
+        intest = self._get_archivio().intestazione(foglio_id)
+        Popup(title=f"Foglio N° {intest.get('Foglio di servizio N°') or '-'} {intest.get('Data','')}",
+              content=rv, size_hint=(0.95,0.9)).open()
+
     def apri_intestazione_popup(self, *_):
+        from kivy.uix.textinput import TextInput
         app = App.get_running_app()
         dati = getattr(app, 'intestazione', {})
         labels = ["Data","Foglio di servizio N°","Targa","Nome e Cognome",
@@ -820,6 +3707,7 @@ class CorseScreen(Screen):
 
         def save_and_close(*_):
             app.intestazione = {k:v.text for k,v in inputs.items()}
+            self._get_archivio().salva_intestazione(self.foglio_id, app.intestazione)
             self._msg("Intestazione salvata.", title="Intestazione")
             pop.dismiss()
             # NUOVO: Salva backup dopo salvataggio intestazione
@@ -828,14 +3716,18 @@ class CorseScreen(Screen):
         btn.bind(on_release=save_and_close); pop.open()
 
     def inizia_corsa(self, *_):
+        self.ui.applica()   # la scelta manuale prevale sui valori GPS in attesa
         self.campi["Ora di partenza"].text = datetime.now().strftime("%H:%M")
         self._pickup_set = True
+        if self.track:
+            self._pt_salita = self.track.ultimo()
         if not self.gps_on and self._gps_available():
             self._gps_start()
         # NUOVO: Salva backup dopo inizio corsa
         self._salva_backup()
 
     def completa_corsa(self, *_):
+        self.ui.applica()
         self.campi["Ora di arrivo"].text = datetime.now().strftime("%H:%M")
         # MODIFICA: Usa calcolo con interi
         auto_val = self._anchor_value + self._km_since_anchor()
@@ -846,17 +3738,95 @@ class CorseScreen(Screen):
         except Exception:
             pass
         self._drop_set = True
+        if self.track:
+            self._pt_discesa = self.track.ultimo()
         # NUOVO: Salva backup dopo completamento corsa
         self._salva_backup()
 
-    def esporta_pdf(self, *_):
+    @staticmethod
+    def _giorno_iso(txt):
+        """'AAAA-MM-GG' o 'GG/MM/AAAA' → 'AAAA-MM-GG' (None se vuoto o non valido)"""
+        txt = (txt or "").strip()
+        for fmt in ("%Y-%m-%d", "%d/%m/%Y"):
+            try:
+                return datetime.strptime(txt, fmt).strftime("%Y-%m-%d")
+            except ValueError:
+                pass
+        return None
+
+    def popup_esporta(self, *_):
+        """Scelta del formato e dell'intervallo di giorni da esportare"""
+        from kivy.uix.textinput import TextInput
+        from kivy.uix.togglebutton import ToggleButton
+        oggi = datetime.now().strftime("%Y-%m-%d")
+        box = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(10))
+        formati = BoxLayout(size_hint_y=None, height=dp(48), spacing=dp(6))
+        scelte = {}
+        for nome, (etichetta, _est, _mime, _scrivi) in ESPORTATORI.items():
+            b = ToggleButton(text=etichetta, group="formato_esportazione", allow_no_selection=False,
+                             state="down" if nome == "pdf" else "normal")
+            scelte[nome] = b
+            formati.add_widget(b)
+        box.add_widget(formati)
+        date = GridLayout(cols=2, size_hint_y=None, height=dp(96), spacing=dp(6))
+        ti_da = TextInput(text=oggi, multiline=False)
+        ti_a = TextInput(text=oggi, multiline=False)
+        date.add_widget(Label(text="Dal giorno")); date.add_widget(ti_da)
+        date.add_widget(Label(text="Al giorno")); date.add_widget(ti_a)
+        box.add_widget(date)
+        box.add_widget(Label(text="Il PDF riguarda un solo foglio (un giorno)", font_size=sp(12)))
+        pulsanti = BoxLayout(size_hint_y=None, height=dp(48), spacing=dp(6))
+        b_ok = Button(text="Esporta", background_normal="", background_color=(0.20,0.55,0.90,1))
+        b_no = Button(text="Annulla")
+        pulsanti.add_widget(b_no); pulsanti.add_widget(b_ok)
+        box.add_widget(pulsanti)
+        pop = Popup(title="Esporta", content=box, size_hint=(0.95, 0.6))
+
+        def conferma(*_a):
+            da, a = self._giorno_iso(ti_da.text), self._giorno_iso(ti_a.text)
+            if da is None or a is None or da > a:
+                self._msg("Intervallo di giorni non valido\n(AAAA-MM-GG o GG/MM/AAAA)", title="Esporta")
+                return
+            formato = next(n for n, b in scelte.items() if b.state == "down")
+            pop.dismiss()
+            self.esporta(formato, giorno_da=da, giorno_a=a)
+
+        b_ok.bind(on_release=conferma)
+        b_no.bind(on_release=lambda *_a: pop.dismiss())
+        pop.open()
+
+    def esporta_pdf(self, *_, foglio_id=None):
+        """Avvia la generazione del PDF (foglio corrente o foglio_id) in un thread separato"""
+        self.esporta("pdf", foglio_id=foglio_id if foglio_id is not None else self.foglio_id)
+
+    def esporta(self, formato, foglio_id=None, giorno_da=None, giorno_a=None):
+        """Esporta in un thread separato le corse di un foglio o di un intervallo di giorni.
+
+        Il formato è una chiave di ESPORTATORI; il PDF richiede un solo foglio.
+        """
+        if self._export_thread is not None and self._export_thread.is_alive():
+            self._msg("Esportazione già in corso.", title="Esporta")
+            return
+        etichetta, estensione, mime_type, scrivi = ESPORTATORI[formato]
+
+        if formato == "pdf" and foglio_id is None:
+            fogli = self._get_archivio().cerca_fogli(giorno_da=giorno_da, giorno_a=giorno_a)
+            if not fogli:
+                self._msg("Nessun foglio nei giorni scelti.", title=etichetta)
+                return
+            if len(fogli) > 1:
+                self._msg("Il PDF riguarda un solo foglio:\nscegliere un solo giorno\no esportarlo dallo Storico.",
+                          title=etichetta)
+                return
+            foglio_id = fogli[0]["id"]
+
         app = App.get_running_app()
-        intest = getattr(app, "intestazione", {})
         day = datetime.now().strftime("%Y-%m-%d")
         ts  = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"Foglio_di_Viaggio_{ts}.pdf"
+        prefisso = "Foglio_di_Viaggio" if formato == "pdf" else "Corse"
+        filename = f"{prefisso}_{ts}{estensione}"
 
-        rows = [dict(r) for r in self.corse]
+        db_path = self._get_archivio().path
 
         base_app = getattr(app, "user_data_dir", ".")
         internal_dir = os.path.join(base_app, "FDV", day)
@@ -864,17 +3834,123 @@ class CorseScreen(Screen):
 
         path_app = os.path.join(internal_dir, filename)
 
+        # Popup di avanzamento con pulsante Annulla
+        from kivy.uix.progressbar import ProgressBar
+        annulla = threading.Event()
+        box = BoxLayout(orientation='vertical', spacing=dp(8), padding=dp(10))
+        lbl = Label(text=f"Generazione {etichetta}...", size_hint_y=None, height=dp(30))
+        bar = ProgressBar(max=1, value=0, size_hint_y=None, height=dp(24))
+        b_no = Button(text="Annulla", size_hint_y=None, height=dp(48),
+                      background_normal="", background_color=(0.85,0.30,0.30,1))
+        box.add_widget(lbl); box.add_widget(bar); box.add_widget(b_no)
+        pop = Popup(title=f"Esporta {etichetta}", content=box, size_hint=(0.9, 0.35), auto_dismiss=False)
+
+        def on_annulla(*_a):
+            annulla.set()
+            lbl.text = "Annullamento..."
+            b_no.disabled = True
+        b_no.bind(on_release=on_annulla)
+
+        def aggiorna(fatto, totale):
+            if totale is None:
+                # Esportazioni in streaming: il totale non è noto in anticipo
+                lbl.text = f"{fatto} corse"
+                return
+            bar.max = totale; bar.value = fatto
+            lbl.text = f"Pagina {fatto}/{totale}"
+
+        def on_page(fatto, totale):
+            # Chiamata dal worker: l'UI si aggiorna solo sul thread principale
+            Clock.schedule_once(lambda dt: aggiorna(fatto, totale), 0)
+
+        def fine(esito, errore=None):
+            pop.dismiss()
+            self._export_thread = None
+            self._export_annulla = None
+            if esito == "ok":
+                self._esporta_concluso(path_app, day, filename, mime_type=mime_type)
+            elif esito == "annullato":
+                self._msg("Esportazione annullata.", title=etichetta)
+            else:
+                self._msg(f"Errore {etichetta}:\n{errore}", title=etichetta)
+
+        def worker():
+            # Il file definitivo compare solo a esportazione completa
+            tmp = path_app + ".part"
+            archivio = None
+            try:
+                # Connessione propria del worker: le corse arrivano in streaming
+                archivio = ArchivioCorse(db_path)
+                if formato == "pdf":
+                    intest = archivio.intestazione(foglio_id)
+                    corse = archivio.corse_foglio(foglio_id)
+                else:
+                    intest = archivio.intestazione(foglio_id) if foglio_id is not None else {}
+                    corse = archivio.corse_esportazione(foglio_id, giorno_da, giorno_a)
+                scrivi(tmp, intest, corse, on_page=on_page, annulla=annulla)
+                os.replace(tmp, path_app)
+                esito, errore = "ok", None
+            except EsportazioneAnnullata:
+                esito, errore = "annullato", None
+            except Exception as e:
+                esito, errore = "errore", e
+            finally:
+                if archivio is not None:
+                    archivio.chiudi()
+            if esito != "ok":
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            Clock.schedule_once(lambda dt: fine(esito, errore), 0)
+
+        self._export_annulla = annulla
+        self._export_thread = threading.Thread(target=worker, name="fdv-export", daemon=True)
+        pop.open()
+        self._export_thread.start()
+
+    def esporta_gpx(self, *_, foglio_id=None, corsa_id=None):
+        """Esporta in GPX la traccia di una corsa (corsa_id) o di tutte le corse di un foglio"""
+        archivio = self._get_archivio()
+        if corsa_id is not None:
+            corse = [c for c in (archivio.corsa(corsa_id),) if c]
+        else:
+            corse = archivio.corse_foglio(foglio_id if foglio_id is not None else self.foglio_id)
+
+        app = App.get_running_app()
+        day = datetime.now().strftime("%Y-%m-%d")
+        filename = datetime.now().strftime("Tracce_%Y%m%d_%H%M%S.gpx")
+        internal_dir = os.path.join(getattr(app, "user_data_dir", "."), "FDV", day)
+        os.makedirs(internal_dir, exist_ok=True)
+        path_app = os.path.join(internal_dir, filename)
+
+        tracce = ((f"{c.get('Ora di partenza','')} {self._ui_clean(c.get('Luogo di partenza',''))} → "
+                   f"{self._ui_clean(c.get('Luogo di destinazione',''))}".strip(),
+                   self._punti_traccia_corsa(c))
+                  for c in corse if c.get("_traccia"))
         try:
-            build_pdf_cartaceo(path_app, intest, rows)
-        except Exception as e:
-            self._msg(f"Errore PDF:\n{e}", title="PDF")
+            scritte = scrivi_gpx(path_app + ".part", tracce)
+        except (OSError, ValueError) as e:
+            self._msg(f"Errore GPX:\n{e}", title="GPX")
+            scritte = 0
+        if not scritte:
+            try:
+                os.remove(path_app + ".part")
+            except OSError:
+                pass
+            self._msg("Nessuna traccia GPS registrata.", title="GPX")
             return
+        os.replace(path_app + ".part", path_app)
+        self._esporta_concluso(path_app, day, filename, mime_type="application/gpx+xml")
 
+    def _esporta_concluso(self, path_app, day, filename, mime_type="application/pdf"):
+        """Copia e condivide il file esportato (thread principale)"""
         share_path = path_app
         public_copy = None
 
         if platform == "android":
             try:
+                primary_external_storage_path = _servizio("storage")
                 base_ext = primary_external_storage_path() if primary_external_storage_path else "/sdcard"
                 public_dir = os.path.join(base_ext, "Download", "FDV", day)
                 os.makedirs(public_dir, exist_ok=True)
@@ -885,42 +3961,110 @@ class CorseScreen(Screen):
                 public_copy = None
                 share_path = path_app
 
-        if platform == "android" and share:
+        share = _servizio("share") if platform == "android" else None
+        if share:
             try:
                 share.share(
                     title="Foglio di Viaggio",
                     filepath=share_path,
-                    mime_type="application/pdf"
+                    mime_type=mime_type
                 )
             except Exception as e:
-                self._msg(f"Condivisione non riuscita:\n{e}\n\nFile in:\n{share_path}", title="PDF")
+                self._msg(f"Condivisione non riuscita:\n{e}\n\nFile in:\n{share_path}", title="Esporta")
         else:
             self._open_folder_desktop(path_app)
             self.last_pdf_path = public_copy or path_app
 
     # Metodi Clipboard 
     def _start_clipboard_watcher(self):
-        if self._clip_ev is None:
-            self._clip_ev = Clock.schedule_interval(self._check_clipboard, 1.5)
+        """Avvia il rilevamento appunti: listener Android, altrimenti polling"""
+        self._clip_attivo = True
+        if not self._clip_listener_tentato:
+            self._clip_listener_tentato = True
+            self._registra_listener_clipboard()
+        self._clip_intervallo = self.CLIP_POLL_MIN_S
+        if self._clip_listener is not None:
+            # Il contenuto può essere cambiato mentre eravamo in background
+            Clock.schedule_once(self._check_clipboard, 0)
+        elif self._clip_ev is None:
+            # Polling finché il listener non è registrato (o se non disponibile)
+            self._clip_ev = Clock.schedule_once(self._poll_clipboard, self._clip_intervallo)
 
     def _stop_clipboard_watcher(self):
+        self._clip_attivo = False
         if self._clip_ev is not None:
             self._clip_ev.cancel()
             self._clip_ev = None
 
-    def _check_clipboard(self, dt):
+    def _registra_listener_clipboard(self):
+        """Registra un OnPrimaryClipChangedListener sul ClipboardManager"""
         try:
-            txt = Clipboard.paste() or ""
+            from jnius import PythonJavaClass, java_method
+            from android.runnable import run_on_ui_thread
         except Exception:
             return
-        t = (txt or "").strip()
-        if not t:
-            return
-        if t == self._last_clip or t == self._last_clip_used:
+
+        screen = self
+
+        class _ClipListener(PythonJavaClass):
+            __javainterfaces__ = ['android/content/ClipboardManager$OnPrimaryClipChangedListener']
+            __javacontext__ = 'app'
+
+            @java_method('()V')
+            def onPrimaryClipChanged(self):
+                # Thread UI Android: si passa al loop di Kivy
+                Clock.schedule_once(screen._check_clipboard, 0)
+
+        @run_on_ui_thread
+        def registra():
+            try:
+                autoclass = _servizio("jnius")
+                Context = autoclass('android.content.Context')
+                activity = autoclass('org.kivy.android.PythonActivity').mActivity
+                cm = activity.getSystemService(Context.CLIPBOARD_SERVICE)
+                listener = _ClipListener()
+                cm.addPrimaryClipChangedListener(listener)
+                self._clip_listener = listener
+            except Exception as e:
+                print(f"⚠️ Listener appunti non disponibile, uso il polling: {e}")
+
+        try:
+            registra()
+        except Exception as e:
+            print(f"⚠️ Listener appunti non disponibile, uso il polling: {e}")
+
+    def _poll_clipboard(self, dt):
+        self._clip_ev = None
+        if not self._clip_attivo or self._clip_listener is not None:
             return
+        if self._check_clipboard(dt):
+            self._clip_intervallo = self.CLIP_POLL_MIN_S
+        else:
+            self._clip_intervallo = min(self._clip_intervallo * 2, self.CLIP_POLL_MAX_S)
+        self._clip_ev = Clock.schedule_once(self._poll_clipboard, self._clip_intervallo)
+
+    def _check_clipboard(self, dt):
+        """Controlla gli appunti; restituisce True se il contenuto è cambiato"""
+        if not self._clip_attivo:
+            return False
+        try:
+            txt = _servizio("clipboard").paste() or ""
+        except Exception:
+            return False
+        h = hash(txt)
+        if h == self._clip_hash:
+            return False
+        self._clip_hash = h
+        t = txt.strip()
+        if not t:
+            return True
+        ht = hash(t)
+        if ht in self._clip_gestiti:
+            return True
         if self._looks_like_uber_text(t):
-            self._last_clip = t
+            self._clip_gestiti.append(ht)
             self._show_clip_banner(t)
+        return True
 
     def _looks_like_uber_text(self, t: str) -> bool:
         s = t.strip()
@@ -929,9 +4073,10 @@ class CorseScreen(Screen):
         must_keys = ["trip #", "passenger name", "from", "destination"]
         score = sum(1 for k in must_keys if k in s_l)
 
-        import re
-        has_uuid = bool(re.search(r"trip\s*#\s*[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", s, re.I))
-        has_time = bool(re.search(r"\b\d{2}/\d{2}/\d{2}\s+\d{2}:\d{2}:\d{2}(?:\s+[A-Z]{2,5})?\b", s))
+        if score < 3:
+            return False
+        has_uuid = bool(_RE_TRIP_UUID.search(s))
+        has_time = bool(_RE_TRIP_TIME.search(s))
         has_via_uber = ("via\tuber" in s_l) or ("via uber" in s_l)
 
         return (score >= 3) and (has_uuid or has_time or has_via_uber)
@@ -953,35 +4098,77 @@ class CorseScreen(Screen):
             ok = self.import_from_text(text, silent=True)
             if ok:
                 self._msg("Campi compilati dagli appunti.", title="Importa")
-                self._last_clip_used = text
             pop.dismiss()
 
         def do_cancel(*_a):
-            self._last_clip_used = text
             pop.dismiss()
 
         b_ok.bind(on_release=do_paste)
         b_no.bind(on_release=do_cancel)
         pop.open()
 
+_fase_avvio("import_ms")
+
 class FDVApp(App):
     def build(self):
         self.intestazione = {}
         self.last_km_final = None
         if platform == "android":
+            from kivy.core.window import Window
             Window.softinput_mode = "below_target"
-            try:
-                if request_permissions and Permission:
-                    request_permissions([
-                        Permission.ACCESS_FINE_LOCATION, Permission.ACCESS_COARSE_LOCATION,
-                        Permission.READ_EXTERNAL_STORAGE, Permission.WRITE_EXTERNAL_STORAGE
-                    ])
-            except Exception:
-                pass
         sm = ScreenManager()
         self._corse_screen = CorseScreen(name="corse")
         sm.add_widget(self._corse_screen)
+        _fase_avvio("build_ms")
         return sm
 
+    def on_start(self):
+        from kivy.core.window import Window
+
+        def primo_frame(*_a):
+            Window.unbind(on_flip=primo_frame)
+            _fase_avvio("primo_frame_ms")
+            # Il resto dell'avvio gira dopo che l'utente vede la schermata
+            Clock.schedule_once(lambda dt: self._avvio_differito(), 0)
+
+        Window.bind(on_flip=primo_frame)
+
+    def _avvio_differito(self):
+        _richiedi_permessi([
+            "ACCESS_FINE_LOCATION", "ACCESS_COARSE_LOCATION",
+            "READ_EXTERNAL_STORAGE", "WRITE_EXTERNAL_STORAGE"
+        ])
+        self._corse_screen.avvio_differito()
+        _fase_avvio("interattivo_ms")
+        self._scrivi_log_avvio()
+
+    def _scrivi_log_avvio(self):
+        """Aggiunge a startup.log una riga JSON con i tempi delle fasi di avvio"""
+        try:
+            riga = {'ts': datetime.now().isoformat(), 'platform': platform, **_TEMPI_AVVIO}
+            with open(os.path.join(self.user_data_dir, "startup.log"), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(riga) + "\n")
+            print(f"⏱️ Avvio: {riga}")
+        except Exception as e:
+            print(f"⚠️ Impossibile scrivere startup.log: {e}")
+
+    def on_pause(self):
+        # In background niente controllo degli appunti
+        self._corse_screen._stop_clipboard_watcher()
+        # Android può chiudere l'app senza preavviso: tutto su disco adesso
+        self._corse_screen._flush_backup(attendi=True)
+        return True
+
+    def on_stop(self):
+        self._corse_screen._stop_backup_system()
+        self._corse_screen._salva_backup()
+        self._corse_screen._flush_backup(attendi=True)
+
+    def on_resume(self):
+        if platform == "android":
+            self._corse_screen._start_clipboard_watcher()
+
 if __name__ == "__main__":
+    if _RIGA_DI_COMANDO:
+        sys.exit(_COMANDI[sys.argv[1]](sys.argv[2:]))
     FDVApp().run()
\ No newline at end of file